@@ -0,0 +1,105 @@
+"""Per-request dispatch overhead: route table vs the old if-chain.
+
+    python bench/dispatch.py --iterations 200000
+
+Times path matching only (no sockets, no database). The legacy matcher
+replays the order of the ``if path == ...`` / ``startswith`` checks that
+do_GET/do_POST/do_DELETE used to run. The padded run registers extra
+dynamic routes to show that lookups stay flat as the table grows.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import server  # noqa: E402
+
+REQUESTS = [
+    ('GET', '/api/expenses'),
+    ('GET', '/api/auth/me'),
+    ('GET', '/api/summary'),
+    ('GET', '/api/balances'),
+    ('GET', '/api/receipts/0123456789abcdef.png'),
+    ('POST', '/api/expenses'),
+    ('POST', '/api/expenses/42/receipt'),
+    ('POST', '/api/savings/3/contribute'),
+    ('POST', '/api/balances'),
+    ('DELETE', '/api/expenses/42'),
+    ('DELETE', '/api/savings/3'),
+    ('GET', '/api/missing'),
+]
+
+
+def legacy_match(method, path):
+    """The former if-chain, reduced to the checks it ran before reaching a branch."""
+    if method == 'GET':
+        if not path.startswith('/api/auth'):
+            pass  # session lookup happened here
+        for exact in ('/api/auth/me', '/api/expenses', '/api/summary', '/api/balances',
+                      '/api/savings', '/api/admin/db-stats'):
+            if path == exact:
+                return exact
+        if path.startswith('/api/receipts/'):
+            return 'receipt'
+        return None
+    if method == 'POST':
+        for exact in ('/api/auth/register', '/api/auth/login', '/api/auth/logout'):
+            if path == exact:
+                return exact
+        for exact in ('/api/admin/users', '/api/admin/users/list', '/api/admin/users/role',
+                      '/api/expenses', '/api/expenses/bulk'):
+            if path == exact:
+                return exact
+        if path.startswith('/api/expenses/') and path.endswith('/receipt'):
+            return ('receipt', int(path.split('/')[3]))
+        for exact in ('/api/balances', '/api/savings', '/api/expense-items'):
+            if path == exact:
+                return exact
+        if path.startswith('/api/savings/') and path.endswith('/contribute'):
+            return ('contribute', int(path.split('/')[3]))
+        return None
+    if method == 'DELETE':
+        for prefix in ('/api/expenses/', '/api/expense-items/', '/api/savings/'):
+            if path.startswith(prefix):
+                return (prefix, int(path.split('/')[-1]))
+        return None
+    return None
+
+
+def time_matcher(match, iterations):
+    started = time.perf_counter()
+    for _ in range(iterations // len(REQUESTS)):
+        for method, path in REQUESTS:
+            match(method, path)
+    return (time.perf_counter() - started) / iterations * 1e9
+
+
+def padded_router(extra):
+    router = server.Router()
+    for route in server.router.routes():
+        router.add(route)
+    for i in range(extra):
+        for method in ('GET', 'POST', 'DELETE'):
+            router.add(server.Route(method, f'/api/extra{i}/{{id:int}}/thing', None))
+            router.add(server.Route(method, f'/api/extra{i}/list', None))
+    return router
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=200000)
+    parser.add_argument('--padding', type=int, default=100, help='extra routes per method for the padded run')
+    args = parser.parse_args()
+    padded = padded_router(args.padding)
+    results = [
+        ('legacy if-chain', time_matcher(legacy_match, args.iterations)),
+        ('route table', time_matcher(server.router.match, args.iterations)),
+        (f'route table +{args.padding * 2} routes/method', time_matcher(padded.match, args.iterations)),
+    ]
+    for name, ns in results:
+        print(f'{name:<32} {ns:8.0f} ns/request')
+
+
+if __name__ == '__main__':
+    main()
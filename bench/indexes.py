@@ -0,0 +1,70 @@
+"""Query plans and timings before and after the index migration.
+
+    python bench/indexes.py --expenses 1000000
+
+Seeds a synthetic database at schema version 2 (tables only), times the hot
+read queries, applies the remaining migrations and times them again.
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from seed import seed  # noqa: E402
+import server  # noqa: E402
+
+
+def queries(month):
+    return [
+        ('list month', 'SELECT * FROM expenses WHERE month_key=? ORDER BY date DESC, id DESC', (month,)),
+        ('list page', 'SELECT * FROM expenses ORDER BY date DESC, id DESC LIMIT 100', ()),
+        ('items for month',
+         'SELECT id, expense_id, name, amount FROM expense_items WHERE expense_id IN '
+         '(SELECT id FROM expenses WHERE month_key=?)', (month,)),
+        ('summary by category',
+         'SELECT category, SUM(amount), COUNT(*) FROM expenses WHERE month_key=? GROUP BY category', (month,)),
+        ('expired sessions', 'SELECT COUNT(*) FROM sessions WHERE expires_at <= datetime("now")', ()),
+    ]
+
+
+def run(conn, month, repeat):
+    results = {}
+    for name, sql, params in queries(month):
+        plan = '; '.join(r[3] for r in conn.execute('EXPLAIN QUERY PLAN ' + sql, params))
+        started = time.perf_counter()
+        for _ in range(repeat):
+            conn.execute(sql, params).fetchall()
+        results[name] = ((time.perf_counter() - started) / repeat * 1000, plan)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--expenses', type=int, default=1000000)
+    parser.add_argument('--sessions', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.db')
+        started = time.perf_counter()
+        keys = seed(path, expenses=args.expenses, sessions=args.sessions, migrate_to=2)
+        print(f'seeded {args.expenses} expenses in {time.perf_counter() - started:.1f}s')
+        month = keys[len(keys) // 2]
+        conn = sqlite3.connect(path)
+        before = run(conn, month, args.repeat)
+        started = time.perf_counter()
+        server.migrate(conn)
+        print(f'migrated to version {len(server.MIGRATIONS)} in {time.perf_counter() - started:.1f}s\n')
+        after = run(conn, month, args.repeat)
+        conn.close()
+    for name in before:
+        print(f'{name}: {before[name][0]:.2f} ms -> {after[name][0]:.2f} ms')
+        print(f'    before: {before[name][1]}')
+        print(f'    after:  {after[name][1]}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""Request latency with and without keep-alive and response compression.
+
+    python bench/latency.py --expenses 20000 --requests 300
+
+Seeds a database, then issues sequential requests against a few endpoints in
+two configurations:
+
+* ``close``: a new TCP connection per request, no Accept-Encoding, server
+  started with SERVER_KEEPALIVE_TIMEOUT=0 (the old HTTP/1.0 behaviour);
+* ``keepalive``: one persistent connection sending ``Accept-Encoding: gzip``.
+
+Prints median/p95 latency and bytes on the wire per endpoint.
+"""
+import argparse
+import http.client
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from load import free_port, login, start_server, stop_server  # noqa: E402
+from seed import seed  # noqa: E402
+
+
+def endpoints(month):
+    return [
+        ('auth/me', '/api/auth/me'),
+        ('summary', f'/api/summary?month={month}'),
+        ('page of 100', '/api/expenses?limit=100'),
+        ('month listing', f'/api/expenses?month={month}'),
+    ]
+
+
+def measure(port, cookie, path, requests, keepalive):
+    headers = {'Cookie': cookie}
+    if keepalive:
+        headers['Accept-Encoding'] = 'gzip'
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30) if keepalive else None
+    samples, wire = [], 0
+    for _ in range(requests):
+        started = time.perf_counter()
+        c = conn or http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        c.request('GET', path, headers=headers)
+        resp = c.getresponse()
+        body = resp.read()
+        if not keepalive:
+            c.close()
+        samples.append((time.perf_counter() - started) * 1000)
+        if resp.status != 200:
+            raise RuntimeError(f'{path}: HTTP {resp.status}')
+        wire = len(body)
+    if conn:
+        conn.close()
+    samples.sort()
+    return {
+        'p50_ms': round(statistics.median(samples), 3),
+        'p95_ms': round(samples[int(len(samples) * 0.95) - 1], 3),
+        'body_bytes': wire,
+    }
+
+
+def run_config(workdir, month, args, keepalive):
+    port = free_port()
+    env = {} if keepalive else {'SERVER_KEEPALIVE_TIMEOUT': '0'}
+    proc = start_server(workdir, port, env)
+    try:
+        cookie = login(port)
+        return {name: measure(port, cookie, path, args.requests, keepalive) for name, path in endpoints(month)}
+    finally:
+        stop_server(proc)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--expenses', type=int, default=20000)
+    parser.add_argument('--requests', type=int, default=300)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as workdir:
+        keys = seed(os.path.join(workdir, 'expenses.db'), expenses=args.expenses, sessions=0)
+        month = keys[len(keys) // 2]
+        results = {
+            'close': run_config(workdir, month, args, keepalive=False),
+            'keepalive': run_config(workdir, month, args, keepalive=True),
+        }
+    print(f"{'endpoint':<16}{'close p50':>11}{'p95':>9}{'bytes':>9}   {'keepalive p50':>13}{'p95':>9}{'bytes':>9}")
+    for name, _ in endpoints(month):
+        a, b = results['close'][name], results['keepalive'][name]
+        print(f"{name:<16}{a['p50_ms']:>11}{a['p95_ms']:>9}{a['body_bytes']:>9}   "
+              f"{b['p50_ms']:>13}{b['p95_ms']:>9}{b['body_bytes']:>9}")
+    print(json.dumps(results))
+
+
+if __name__ == '__main__':
+    main()
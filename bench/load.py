@@ -0,0 +1,166 @@
+"""Throughput benchmark comparing SERVER_MODE settings of server.py.
+
+Each mode gets a fresh database in a temporary directory, a logged-in admin
+session and a handful of seeded expenses. The benchmark then hammers
+``GET /api/expenses?month=`` from ``--concurrency`` client threads while
+``--slow-clients`` connections trickle an unfinished upload, the situation that
+stalls the serial loop.
+
+    python bench/load.py --modes serial,threads --requests 2000 --concurrency 16
+"""
+import argparse
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER = os.path.join(ROOT, 'server.py')
+ADMIN_USER = 'Weasley'
+ADMIN_PASSWORD = '6FjVCVYLcpm3XAiJ81gQWd'
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(workdir, port, extra_env=None):
+    env = dict(os.environ, PORT=str(port), HOST='127.0.0.1')
+    env.update(extra_env or {})
+    proc = subprocess.Popen([sys.executable, SERVER], cwd=workdir, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 15
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.2):
+                return proc
+        except OSError:
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError('server did not start')
+
+
+def stop_server(proc):
+    proc.terminate()
+    try:
+        proc.wait(15)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+
+def request(port, method, path, body=None, cookie=None):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    headers = {'Content-Type': 'application/json'}
+    if cookie:
+        headers['Cookie'] = cookie
+    conn.request(method, path, body=json.dumps(body) if body is not None else None, headers=headers)
+    resp = conn.getresponse()
+    data = resp.read()
+    conn.close()
+    return resp, data
+
+
+def login(port):
+    resp, _ = request(port, 'POST', '/api/auth/login', {'username': ADMIN_USER, 'password': ADMIN_PASSWORD})
+    cookie = resp.getheader('Set-Cookie') or ''
+    return cookie.split(';', 1)[0]
+
+
+def slow_client(port, cookie, stop):
+    # Announce a large body, then send it a few bytes at a time
+    s = socket.create_connection(('127.0.0.1', port))
+    s.sendall(b'POST /api/expenses HTTP/1.1\r\nHost: x\r\nContent-Type: application/json\r\n'
+              b'Cookie: ' + cookie.encode('ascii') + b'\r\nContent-Length: 1000000\r\n\r\n')
+    try:
+        while not stop.is_set():
+            s.sendall(b' ')
+            stop.wait(0.5)
+    except OSError:
+        pass
+    finally:
+        s.close()
+
+
+def bench_mode(mode, args):
+    port = free_port()
+    with tempfile.TemporaryDirectory() as workdir:
+        proc = start_server(workdir, port, {'SERVER_MODE': mode, 'SERVER_WORKERS': str(args.workers)})
+        try:
+            cookie = login(port)
+            for i in range(50):
+                request(port, 'POST', '/api/expenses', {
+                    'description': f'Seed {i}', 'amount': 1 + i, 'date': '2024-05-%02d' % (1 + i % 28),
+                    'category': 'food', 'payer': 'you',
+                }, cookie)
+            stop = threading.Event()
+            slow = [threading.Thread(target=slow_client, args=(port, cookie, stop), daemon=True) for _ in range(args.slow_clients)]
+            for t in slow:
+                t.start()
+            time.sleep(0.2)
+
+            counter = iter(range(args.requests))
+            lock = threading.Lock()
+            errors = [0]
+
+            def client():
+                while True:
+                    with lock:
+                        if next(counter, None) is None:
+                            return
+                    try:
+                        resp, _ = request(port, 'GET', '/api/expenses?month=2024-05', cookie=cookie)
+                        if resp.status != 200:
+                            errors[0] += 1
+                    except OSError:
+                        errors[0] += 1
+
+            started = time.perf_counter()
+            threads = [threading.Thread(target=client, daemon=True) for _ in range(args.concurrency)]
+            for t in threads:
+                t.start()
+            deadline = started + args.timeout
+            for t in threads:
+                t.join(max(0.0, deadline - time.perf_counter()))
+            elapsed = time.perf_counter() - started
+            stop.set()
+            finished = not any(t.is_alive() for t in threads)
+            return {
+                'mode': mode,
+                'requests': args.requests,
+                'concurrency': args.concurrency,
+                'slow_clients': args.slow_clients,
+                'seconds': round(elapsed, 3),
+                'req_per_sec': round(args.requests / elapsed, 1) if finished else 0.0,
+                'errors': errors[0],
+                'completed': finished,
+            }
+        finally:
+            stop_server(proc)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--modes', default='serial,threads')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--slow-clients', type=int, default=1)
+    parser.add_argument('--timeout', type=float, default=60.0,
+                        help='give up on a mode after this many seconds (serial stalls behind slow clients)')
+    args = parser.parse_args()
+    results = [bench_mode(m.strip(), args) for m in args.modes.split(',') if m.strip()]
+    for r in results:
+        status = '' if r['completed'] else '  (timed out)'
+        print(f"{r['mode']:>8}: {r['req_per_sec']:>8} req/s  {r['seconds']:>7}s  errors={r['errors']}{status}")
+    print(json.dumps(results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""Login throughput at different password-hashing costs.
+
+    python bench/login.py --settings scrypt:16384,pbkdf2:600000 --seconds 5
+
+For each setting a fresh server is started with that PASSWORD_KDF cost (the
+seeded admin is hashed with it). ``--concurrency`` clients then log in
+repeatedly while one more client polls ``GET /api/auth/me``. This shows
+whether the rest of the API keeps responding while logins are hashing.
+"""
+import argparse
+import http.client
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from load import ADMIN_PASSWORD, ADMIN_USER, free_port, login, start_server, stop_server  # noqa: E402
+
+
+def setting_env(setting):
+    algorithm, _, cost = setting.partition(':')
+    if algorithm == 'scrypt':
+        return {'PASSWORD_KDF': 'scrypt', 'SCRYPT_N': cost or '16384'}
+    if algorithm == 'pbkdf2':
+        return {'PASSWORD_KDF': 'pbkdf2', 'PBKDF2_ITERATIONS': cost or '600000'}
+    raise SystemExit(f'unknown setting {setting!r}; use scrypt:<N> or pbkdf2:<iterations>')
+
+
+def bench_setting(setting, args):
+    port = free_port()
+    body = json.dumps({'username': ADMIN_USER, 'password': ADMIN_PASSWORD})
+    with tempfile.TemporaryDirectory() as workdir:
+        proc = start_server(workdir, port, setting_env(setting))
+        try:
+            cookie = login(port)
+            stop = threading.Event()
+            logins, busy, errors, me_latency = [0], [0], [0], []
+            lock = threading.Lock()
+
+            def login_client():
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+                while not stop.is_set():
+                    conn.request('POST', '/api/auth/login', body=body, headers={'Content-Type': 'application/json'})
+                    resp = conn.getresponse()
+                    resp.read()
+                    with lock:
+                        if resp.status == 200:
+                            logins[0] += 1
+                        elif resp.status == 503:
+                            busy[0] += 1
+                        else:
+                            errors[0] += 1
+                conn.close()
+
+            def me_client():
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+                while not stop.is_set():
+                    started = time.perf_counter()
+                    conn.request('GET', '/api/auth/me', headers={'Cookie': cookie})
+                    conn.getresponse().read()
+                    me_latency.append((time.perf_counter() - started) * 1000)
+                    time.sleep(0.01)
+                conn.close()
+
+            threads = [threading.Thread(target=login_client, daemon=True) for _ in range(args.concurrency)]
+            threads.append(threading.Thread(target=me_client, daemon=True))
+            started = time.perf_counter()
+            for t in threads:
+                t.start()
+            time.sleep(args.seconds)
+            stop.set()
+            for t in threads:
+                t.join(60)
+            elapsed = time.perf_counter() - started
+            me_latency.sort()
+            return {
+                'setting': setting,
+                'logins_per_sec': round(logins[0] / elapsed, 1),
+                'busy_503': busy[0],
+                'errors': errors[0],
+                'me_p50_ms': round(statistics.median(me_latency), 2) if me_latency else None,
+                'me_p95_ms': round(me_latency[int(len(me_latency) * 0.95) - 1], 2) if me_latency else None,
+            }
+        finally:
+            stop_server(proc)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--settings', default='scrypt:4096,scrypt:16384,scrypt:65536,pbkdf2:100000,pbkdf2:600000')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=5.0)
+    args = parser.parse_args()
+    results = [bench_setting(s.strip(), args) for s in args.settings.split(',') if s.strip()]
+    for r in results:
+        print(f"{r['setting']:>16}: {r['logins_per_sec']:>7} logins/s  503s={r['busy_503']:<4} "
+              f"/api/auth/me p50={r['me_p50_ms']} ms p95={r['me_p95_ms']} ms")
+    print(json.dumps(results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""Search latency with the FTS5 index against LIKE scans, and what the index costs.
+
+    python bench/search.py --expenses 1000000
+
+Seeds a database with every migration except the search index and times
+server.search_expenses on its LIKE fallback. It then applies the search
+migration (timing the index build and the size it adds) and times the same
+searches against expense_search. Last, it times a bulk import of
+``--import-rows`` expenses into each database, to show what keeping the
+index current costs on writes.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from seed import WORDS, seed  # noqa: E402
+import server  # noqa: E402
+
+
+def searches(expenses, month):
+    year = month[:4]
+    return [
+        ('common word', {'terms': ['tesco']}),
+        ('two words', {'terms': ['coffee', 'bakery']}),
+        ('prefix', {'terms': ['pharm']}),
+        ('rare token', {'terms': [str(expenses // 3)]}),
+        ('word in month', {'terms': ['tesco'], 'month': month}),
+        ('word in date range', {'terms': ['gym'], 'first': f'{year}-01-01', 'last': f'{year}-03-31'}),
+        ('second page', {'terms': ['vet'], 'offset': 50}),
+    ]
+
+
+def time_searches(cur, expenses, month, fts, repeat):
+    results = {}
+    for name, kwargs in searches(expenses, month):
+        server.search_expenses(cur, fts=fts, **kwargs)
+        started = time.perf_counter()
+        for _ in range(repeat):
+            page = server.search_expenses(cur, fts=fts, **kwargs)
+        results[name] = ((time.perf_counter() - started) / repeat * 1000, len(page['expenses']))
+    return results
+
+
+def time_import(conn, rows, rng):
+    records = [{'description': f'{rng.choice(WORDS)} {rng.choice(WORDS)} import {i}', 'amount': 5,
+                'date': '2024-12-15', 'category': 'food', 'payer': 'you',
+                'items': [{'name': rng.choice(WORDS), 'amount': 1}] if i % 3 == 0 else []}
+               for i in range(rows)]
+    validated = [server.validate_expense(record) for record in records]
+    cur = conn.cursor()
+    started = time.perf_counter()
+    cur.execute('BEGIN IMMEDIATE')
+    server.bulk_insert_expenses(cur, validated)
+    conn.rollback()
+    return (time.perf_counter() - started) * 1000
+
+
+def db_size(conn):
+    return conn.execute('PRAGMA page_count').fetchone()[0] * conn.execute('PRAGMA page_size').fetchone()[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--expenses', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--import-rows', type=int, default=10000)
+    args = parser.parse_args()
+    target = server.MIGRATIONS.index(server._migrate_expense_search)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.db')
+        started = time.perf_counter()
+        keys = seed(path, expenses=args.expenses, sessions=0, migrate_to=target)
+        print(f'seeded {args.expenses} expenses in {time.perf_counter() - started:.1f}s')
+        month = keys[len(keys) // 2]
+        conn = server.sqlite3.connect(path, isolation_level=None)
+        cur = conn.cursor()
+        like = time_searches(cur, args.expenses, month, False, args.repeat)
+        like_import = time_import(conn, args.import_rows, random.Random(1))
+        size = db_size(conn)
+        started = time.perf_counter()
+        server.migrate(conn)
+        build = time.perf_counter() - started
+        if not server.has_search_index(cur):
+            sys.exit('this SQLite build has no FTS5; only the LIKE fallback is available')
+        conn.execute('VACUUM')
+        print(f'built expense_search in {build:.1f}s, database {size / 1e6:.0f} MB -> {db_size(conn) / 1e6:.0f} MB\n')
+        fts = time_searches(cur, args.expenses, month, True, args.repeat)
+        fts_import = time_import(conn, args.import_rows, random.Random(1))
+        conn.close()
+    print(f"{'search':<20}{'LIKE ms':>10}{'rows':>6}{'FTS ms':>10}{'rows':>6}")
+    for name in like:
+        print(f'{name:<20}{like[name][0]:>10.2f}{like[name][1]:>6}{fts[name][0]:>10.2f}{fts[name][1]:>6}')
+    print(f'\nbulk import of {args.import_rows} expenses: {like_import:.0f} ms without the index, '
+          f'{fts_import:.0f} ms with it')
+
+
+if __name__ == '__main__':
+    main()
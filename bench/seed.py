@@ -0,0 +1,90 @@
+"""Build a synthetic expenses.db for benchmarks.
+
+    python bench/seed.py /tmp/bench.db --expenses 1000000
+
+Rows are spread evenly over ``--months`` months ending 2024-12, roughly a
+third of expenses get 1-4 items, and half of the sessions are expired.
+The schema comes from server.migrate(), so seeded databases look exactly
+like ones the server created.
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import server  # noqa: E402
+
+CATEGORIES = ['food', 'utilities', 'rent', 'groceries', 'entertainment', 'transportation',
+              'credit-card', 'installments', 'apartment-installment', 'other']
+PAYERS = ['you', 'spouse']
+WORDS = ['pharmacy', 'tesco', 'bus', 'cinema', 'rent', 'electric', 'water', 'coffee', 'books',
+         'petrol', 'market', 'bakery', 'takeaway', 'gym', 'insurance', 'gift', 'school', 'vet']
+
+
+def month_keys(count, last_year=2024, last_month=12):
+    keys = []
+    y, m = last_year, last_month
+    for _ in range(count):
+        keys.append(f'{y:04d}-{m:02d}')
+        m -= 1
+        if m == 0:
+            y, m = y - 1, 12
+    return keys[::-1]
+
+
+def seed(path, expenses=10000, months=120, sessions=1000, item_ratio=0.33, migrate_to=None, rng_seed=1):
+    """Create ``path`` from scratch and fill it; returns the month keys used."""
+    if os.path.exists(path):
+        os.remove(path)
+    rng = random.Random(rng_seed)
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode=OFF')
+    conn.execute('PRAGMA synchronous=OFF')
+    # Create indexes after loading when the full schema is wanted; it is much faster
+    server.migrate(conn, target=2)
+    keys = month_keys(months)
+
+    def expense_rows():
+        for i in range(1, expenses + 1):
+            mk = keys[i % months]
+            date = f'{mk}-{rng.randint(1, 28):02d}'
+            desc = f'{rng.choice(WORDS)} {rng.choice(WORDS)} {i}'
+            yield (i, desc, round(rng.uniform(1, 200), 2), date, rng.choice(CATEGORIES), rng.choice(PAYERS), mk)
+
+    def item_rows():
+        for i in range(1, expenses + 1):
+            if rng.random() < item_ratio:
+                for _ in range(rng.randint(1, 4)):
+                    yield (i, rng.choice(WORDS), round(rng.uniform(0.5, 50), 2))
+
+    conn.execute('BEGIN')
+    conn.executemany('INSERT INTO expenses(id, description, amount, date, category, payer, month_key) '
+                     'VALUES(?,?,?,?,?,?,?)', expense_rows())
+    conn.executemany('INSERT INTO expense_items(expense_id, name, amount) VALUES(?,?,?)', item_rows())
+    conn.executemany(
+        'INSERT INTO sessions(token, user_id, created_at, expires_at) VALUES(?, 1, datetime("now"), datetime("now", ?))',
+        ((f'{i:048x}', '-1 day' if i % 2 else '+1 day') for i in range(sessions)))
+    conn.commit()
+    if migrate_to is None or migrate_to > 2:
+        server.migrate(conn, target=migrate_to)
+    conn.close()
+    return keys
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('path')
+    parser.add_argument('--expenses', type=int, default=10000)
+    parser.add_argument('--months', type=int, default=120)
+    parser.add_argument('--sessions', type=int, default=1000)
+    args = parser.parse_args()
+    started = time.perf_counter()
+    seed(args.path, args.expenses, args.months, args.sessions)
+    print(f'seeded {args.expenses} expenses into {args.path} in {time.perf_counter() - started:.1f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""CPU time and allocation of building a large GET /api/expenses?month= response.
+
+    python bench/serialize.py --rows 10000
+
+Seeds a database with one month holding ``--rows`` expenses (about a third
+with items), then, for each JSON backend, times turning that month into
+response bytes: the queries plus row mapping (expense_page) and the encoding
+on its own. Peak allocation of both is measured with tracemalloc on separate
+runs, since tracing slows everything down.
+
+``legacy`` is the previous path, ``json.dumps(payload).encode('utf-8')``;
+``json`` and ``orjson`` are server.json_bytes with JSON_BACKEND set to each.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from seed import seed  # noqa: E402
+import server  # noqa: E402
+
+
+def legacy_bytes(payload):
+    return json.dumps(payload).encode('utf-8')
+
+
+def backend_bytes(backend):
+    def encode(payload):
+        server.JSON_BACKEND = backend
+        return server.json_bytes(payload)
+    return encode
+
+
+def cpu_ms(fn, repeat):
+    fn()
+    started = time.process_time()
+    for _ in range(repeat):
+        fn()
+    return (time.process_time() - started) / repeat * 1000
+
+
+def peak_mb(fn):
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1] / 1e6
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=10000, help='expenses in the month being listed')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+    encoders = [('legacy', legacy_bytes), ('json', backend_bytes('json'))]
+    if server.orjson is not None:
+        encoders.append(('orjson', backend_bytes('orjson')))
+    else:
+        print('orjson is not installed; skipping it')
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, 'expenses.db')
+        keys = seed(path, expenses=args.rows * 12, months=12, sessions=0)
+        conn = server.sqlite3.connect(path)
+        cur = conn.cursor()
+        month = keys[-1]
+        payload = server.expense_page(cur, month)
+        print(f"{len(payload['expenses'])} expenses in {month}")
+        print(f"{'backend':<8}{'page ms':>10}{'encode ms':>11}{'bytes':>11}{'page peak MB':>14}{'encode peak MB':>16}")
+        for name, encode in encoders:
+            page = cpu_ms(lambda: encode(server.expense_page(cur, month)), args.repeat)
+            only = cpu_ms(lambda: encode(payload), args.repeat)
+            size = len(encode(payload))
+            peak = peak_mb(lambda: encode(server.expense_page(cur, month)))
+            encode_peak = peak_mb(lambda: encode(payload))
+            print(f'{name:<8}{page:>10.1f}{only:>11.1f}{size:>11}{peak:>14.1f}{encode_peak:>16.1f}')
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+"""End-to-end API benchmark over several database sizes, with JSON output for comparing commits.
+
+    python bench/suite.py --sizes 10000,100000,1000000 --concurrency 8 --requests 500 \\
+        --output results.json
+    python bench/suite.py --sizes 10000 --compare results.json
+
+For each size a database is seeded with bench/seed.py (expenses, items and
+sessions) and server.py is started on a copy of it. Every scenario then runs
+``--requests`` requests from ``--concurrency`` client threads, each holding one
+keep-alive connection, and reports p50/p95/p99 latency and throughput.
+
+Seeded databases are kept in ``--cache-dir`` when given, so repeated runs skip
+seeding; each run still starts from a fresh copy. ``--env KEY=VALUE`` passes
+settings through to the server (e.g. ``--env SERVER_WORKERS=32``).
+"""
+import argparse
+import http.client
+import itertools
+import json
+import math
+import os
+import platform
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from load import ADMIN_PASSWORD, ADMIN_USER, ROOT, free_port, login, request, start_server, stop_server  # noqa: E402
+from seed import seed  # noqa: E402
+
+
+def scenarios(months, saving_id):
+    """name -> function(i) returning (method, path, body) for the i-th request of that scenario."""
+    def month(i):
+        return months[-1 - i % 12]
+
+    return {
+        'login': lambda i: ('POST', '/api/auth/login', {'username': ADMIN_USER, 'password': ADMIN_PASSWORD}),
+        'list month': lambda i: ('GET', f'/api/expenses?month={month(i)}', None),
+        'create expense': lambda i: ('POST', '/api/expenses', {
+            'description': f'Bench {i}', 'amount': 10 + i % 90, 'date': f'{month(i)}-{1 + i % 28:02d}',
+            'category': 'groceries', 'payer': 'you',
+            'items': [{'name': 'bread', 'amount': 2.5}, {'name': 'milk', 'amount': 1.2}],
+        }),
+        'balances': lambda i: ('GET', '/api/balances', None) if i % 4 else
+                              ('POST', '/api/balances', {'month_key': month(i), 'starting_balance': 1000 + i}),
+        'savings contribute': lambda i: ('POST', f'/api/savings/{saving_id}/contribute', {'amount': 1}),
+    }
+
+
+def percentile(samples, p):
+    """Nearest-rank percentile of sorted ``samples``."""
+    return samples[max(0, math.ceil(p / 100 * len(samples)) - 1)]
+
+
+def run_scenario(port, cookie, make_request, args):
+    counter = itertools.count()
+    lock = threading.Lock()
+    latencies, statuses = [], {}
+
+    def client():
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        headers = {'Cookie': cookie, 'Content-Type': 'application/json', 'Accept-Encoding': 'gzip'}
+        mine, seen = [], {}
+        while True:
+            with lock:
+                i = next(counter)
+            if i >= args.requests:
+                break
+            method, path, body = make_request(i)
+            payload = json.dumps(body) if body is not None else None
+            started = time.perf_counter()
+            # The server may close a keep-alive connection while it sits idle (it does so whenever
+            # other connections are queued), so a failure on a reused connection is retried once
+            for _ in range(2):
+                reused = conn.sock is not None
+                try:
+                    conn.request(method, path, body=payload, headers=headers)
+                    resp = conn.getresponse()
+                    resp.read()
+                    status = resp.status
+                    break
+                except (OSError, http.client.HTTPException):
+                    conn.close()
+                    status = 'error'
+                    if not reused:
+                        break
+            mine.append((time.perf_counter() - started) * 1000)
+            seen[status] = seen.get(status, 0) + 1
+        conn.close()
+        with lock:
+            latencies.extend(mine)
+            for status, n in seen.items():
+                statuses[status] = statuses.get(status, 0) + n
+
+    threads = [threading.Thread(target=client, daemon=True) for _ in range(args.concurrency)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'seconds': round(elapsed, 3),
+        'req_per_sec': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p95_ms': round(percentile(latencies, 95), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+        'max_ms': round(latencies[-1], 3),
+        'errors': sum(n for status, n in statuses.items() if status == 'error' or status >= 400),
+        'statuses': {str(status): n for status, n in sorted(statuses.items(), key=str)},
+    }
+
+
+def seeded_copy(size, workdir, args):
+    """Put a database with ``size`` expenses at workdir/expenses.db; returns (month keys, seed seconds)."""
+    target = os.path.join(workdir, 'expenses.db')
+    cached = os.path.join(args.cache_dir, f'bench-{size}.db') if args.cache_dir else None
+    started = time.perf_counter()
+    if cached and os.path.exists(cached):
+        shutil.copyfile(cached, target)
+        conn = sqlite3.connect(target)
+        keys = [r[0] for r in conn.execute('SELECT DISTINCT month_key FROM expenses ORDER BY month_key')]
+        conn.close()
+        return keys, 0.0
+    keys = seed(target, expenses=size, months=args.months, sessions=args.sessions)
+    elapsed = time.perf_counter() - started
+    if cached:
+        os.makedirs(args.cache_dir, exist_ok=True)
+        shutil.copyfile(target, cached)
+    return keys, round(elapsed, 1)
+
+
+def bench_size(size, names, args):
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        months, seed_seconds = seeded_copy(size, workdir, args)
+        port = free_port()
+        proc = start_server(workdir, port, dict(kv.split('=', 1) for kv in args.env))
+        try:
+            cookie = login(port)
+            resp, data = request(port, 'POST', '/api/savings', {'name': 'Bench', 'target': 1e9}, cookie)
+            table = scenarios(months, json.loads(data)['saving']['id'])
+            for name in names:
+                make_request = table[name]
+                if args.warmup:
+                    run_scenario(port, cookie, make_request, argparse.Namespace(
+                        requests=args.warmup, concurrency=args.concurrency))
+                result = run_scenario(port, cookie, make_request, args)
+                results.append({'size': size, 'scenario': name, 'concurrency': args.concurrency,
+                                'seed_seconds': seed_seconds, **result})
+                print(f"{size:>9} {name:<20}{result['req_per_sec']:>9} req/s  p50={result['p50_ms']:<8} "
+                      f"p95={result['p95_ms']:<8} p99={result['p99_ms']:<8} errors={result['errors']}",
+                      file=sys.stderr)
+        finally:
+            stop_server(proc)
+    return results
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                                text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {'commit': commit, 'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(), 'cpus': os.cpu_count(),
+            'started': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())}
+
+
+def compare(results, baseline_path):
+    """Print the change against a previous --output file for every (size, scenario) both runs have."""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    old = {(r['size'], r['scenario']): r for r in baseline['results']}
+    print(f"baseline {baseline['environment'].get('commit')}: change in req/s, p50, p95, p99 (negative latency is better)")
+    for r in results:
+        b = old.get((r['size'], r['scenario']))
+        if b is None:
+            continue
+        changes = [(r[k] - b[k]) / b[k] * 100 if b[k] else 0.0
+                   for k in ('req_per_sec', 'p50_ms', 'p95_ms', 'p99_ms')]
+        print(f"{r['size']:>9} {r['scenario']:<20}" + ''.join(f'{c:>+9.1f}%' for c in changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='10000,100000', help='comma-separated expense counts to seed')
+    parser.add_argument('--scenarios', default='login,list month,create expense,balances,savings contribute')
+    parser.add_argument('--requests', type=int, default=500, help='requests per scenario')
+    parser.add_argument('--warmup', type=int, default=50, help='unmeasured requests before each scenario')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--months', type=int, default=120)
+    parser.add_argument('--sessions', type=int, default=10000)
+    parser.add_argument('--cache-dir', help='keep seeded databases here between runs')
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE', help='server environment')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--compare', metavar='JSON', help='print changes against an earlier --output file')
+    args = parser.parse_args()
+    names = [s.strip() for s in args.scenarios.split(',') if s.strip()]
+    unknown = set(names) - set(scenarios([''], 0))
+    if unknown:
+        parser.error(f'unknown scenarios: {", ".join(sorted(unknown))}')
+    results = []
+    for size in (int(s) for s in args.sizes.split(',') if s.strip()):
+        results.extend(bench_size(size, names, args))
+    report = {'environment': environment(), 'settings': {
+        'requests': args.requests, 'concurrency': args.concurrency, 'warmup': args.warmup,
+        'months': args.months, 'sessions': args.sessions, 'env': args.env}, 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report))
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
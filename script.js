@@ -66,6 +66,8 @@ const API_BASE = API_ORIGIN.replace(/\/+$/, '') + '/api';
 // App State
 let expenses = {};
 let balances = {};
+// Server-side month aggregates from /api/summary, keyed by month
+let summaries = {};
 let currentFilter = 'all';
 let currentMonth = new Date();
 
@@ -212,6 +214,8 @@ async function logout() {
     } catch (e) {
         // ignore
     }
+    disconnectChangeFeed();
+    window.currentUser = null;
     if (logoutBtn) logoutBtn.style.display = 'none';
     if (adminPanel) adminPanel.style.display = 'none';
     if (navAdminBtn) navAdminBtn.style.display = 'none';
@@ -296,6 +300,76 @@ function initApp() {
     updateBalanceDisplay();
     updateCategoryTotals();
     updateDashboard();
+    connectChangeFeed();
+}
+// Change feed: reload only what another tab or device changed, instead of polling
+let changeFeed = null;
+let reloadTimer = null;
+const pendingReloads = new Set();
+function scheduleReload(what) {
+    pendingReloads.add(what);
+    if (reloadTimer) return;
+    // Coalesce bursts (imports, quick edits) into one request per resource
+    reloadTimer = setTimeout(() => {
+        reloadTimer = null;
+        const todo = new Set(pendingReloads);
+        pendingReloads.clear();
+        // loadExpenses refreshes the dashboard as well
+        if (todo.has('expenses')) loadExpenses();
+        else if (todo.has('dashboard')) updateDashboard();
+        if (todo.has('balances')) loadBalances();
+        if (todo.has('savings') && window.currentUser?.role === 'admin') loadSavings();
+    }, 250);
+}
+function handleChange(change) {
+    const thisKey = getMonthKey(currentMonth);
+    const prevKey = getMonthKey(new Date(currentMonth.getFullYear(), currentMonth.getMonth() - 1, 1));
+    if (change.entity === 'expense') {
+        if (!change.month_key || change.month_key === thisKey) {
+            scheduleReload('expenses');
+        } else {
+            // Other months are fetched again when shown
+            delete expenses[change.month_key];
+            delete summaries[change.month_key];
+            if (change.month_key === prevKey) scheduleReload('dashboard');
+        }
+    } else if (change.entity === 'balance') {
+        if (!change.month_key || change.month_key === thisKey) scheduleReload('balances');
+        else delete balances[change.month_key];
+    } else if (change.entity === 'saving') {
+        scheduleReload('savings');
+    }
+}
+function connectChangeFeed() {
+    if (changeFeed || typeof EventSource === 'undefined') return;
+    const feed = new EventSource(`${API_BASE}/events`, { withCredentials: true });
+    changeFeed = feed;
+    feed.addEventListener('change', (e) => {
+        try {
+            handleChange(JSON.parse(e.data));
+        } catch (err) {
+            console.error('Bad change event', err);
+        }
+    });
+    // Sent when events were missed (server restart or a long disconnect)
+    feed.addEventListener('reset', () => {
+        scheduleReload('expenses');
+        scheduleReload('balances');
+        scheduleReload('savings');
+    });
+    feed.onerror = () => {
+        // The browser retries dropped streams itself; a refused one (503 when full, 401) is closed for good
+        if (feed.readyState === EventSource.CLOSED && changeFeed === feed) {
+            changeFeed = null;
+            setTimeout(() => { if (window.currentUser) connectChangeFeed(); }, 30000);
+        }
+    };
+}
+function disconnectChangeFeed() {
+    if (changeFeed) {
+        changeFeed.close();
+        changeFeed = null;
+    }
 }
 // Event Listeners
 document.addEventListener('DOMContentLoaded', async () => {
@@ -350,21 +424,7 @@ async function addExpense() {
         return;
     }
     
-    // Prepare receipt file if provided
-    let receiptPayload = {};
-    if (expenseReceipt && expenseReceipt.files && expenseReceipt.files[0]) {
-        const file = expenseReceipt.files[0];
-        const base64 = await new Promise((resolve, reject) => {
-            const r = new FileReader();
-            r.onload = () => {
-                const res = r.result.split(',')[1] || '';
-                resolve(res);
-            };
-            r.onerror = reject;
-            r.readAsDataURL(file);
-        });
-        receiptPayload = { receipt_name: file.name, receipt_base64: base64 };
-    }
+    const receiptFile = (expenseReceipt && expenseReceipt.files && expenseReceipt.files[0]) || null;
     // Collect itemized rows
     const items = [];
     if (itemizedContainer && itemizedContainer.style.display !== 'none') {
@@ -382,9 +442,19 @@ async function addExpense() {
         const res = await apiFetch(`${API_BASE}/expenses`, {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ description, amount, category, payer, date: dateStr, items, ...receiptPayload })
+            body: JSON.stringify({ description, amount, category, payer, date: dateStr, items })
         });
         if (!res.ok) throw new Error('Failed to add expense');
+        if (receiptFile) {
+            // Upload the file as-is; the server streams it to disk
+            const { expense } = await res.json();
+            const up = await apiFetch(`${API_BASE}/expenses/${expense.id}/receipt?name=${encodeURIComponent(receiptFile.name)}`, {
+                method: 'POST',
+                headers: { 'Content-Type': receiptFile.type || 'application/octet-stream' },
+                body: receiptFile
+            });
+            if (!up.ok) throw new Error('Failed to upload receipt');
+        }
         await loadExpenses();
         renderExpenses();
         updateBalanceDisplay();
@@ -473,6 +543,7 @@ function clearAllExpenses() {
     const monthKey = getMonthKey(currentMonth);
     if (confirm('Are you sure you want to clear all expenses for this month?')) {
         expenses[monthKey] = [];
+        delete summaries[monthKey];
         saveExpenses();
         renderExpenses();
         updateBalanceDisplay();
@@ -589,6 +660,14 @@ function renderExpenses() {
                 receiptLink.href = `${API_BASE}/receipts/${encodeURIComponent(expense.receipt_path)}`;
                 receiptLink.target = '_blank';
                 receiptLink.textContent = 'View receipt';
+                // Small server-side preview; PDFs and other files fall back to the link text
+                const thumb = document.createElement('img');
+                thumb.className = 'expense-receipt-thumb';
+                thumb.loading = 'lazy';
+                thumb.alt = '';
+                thumb.src = `${receiptLink.href}?size=thumb`;
+                thumb.addEventListener('error', () => thumb.remove());
+                receiptLink.appendChild(thumb);
                 expenseDetails.appendChild(receiptLink);
             }
 
@@ -646,51 +725,34 @@ function updateExpensesCounter() {
     expensesCounter.textContent = `${monthExpenses.length} expense${monthExpenses.length !== 1 ? 's' : ''} this month`;
 }
 
-function updateSummary() {
-    const monthKey = getMonthKey(currentMonth);
+// Month totals: the server aggregate when loaded, otherwise one pass over the loaded rows
+function getMonthSummary(monthKey) {
+    if (summaries[monthKey]) return summaries[monthKey];
     const monthExpenses = expenses[monthKey] || [];
-    
-    let total = 0;
-    let yourTotal = 0;
-    let spouseTotal = 0;
-    
+    const summary = { total: 0, count: monthExpenses.length, by_category: {}, by_payer: {} };
     monthExpenses.forEach(expense => {
         const amount = parseFloat(expense.amount);
-        total += amount;
-        
-        if (expense.payer === 'you') {
-            yourTotal += amount;
-        } else if (expense.payer === 'spouse') {
-            spouseTotal += amount;
-        }
+        summary.total += amount;
+        summary.by_category[expense.category] = (summary.by_category[expense.category] || 0) + amount;
+        summary.by_payer[expense.payer] = (summary.by_payer[expense.payer] || 0) + amount;
     });
+    return summary;
+}
+
+function updateSummary() {
+    const summary = getMonthSummary(getMonthKey(currentMonth));
     
-    totalAmount.textContent = `£${total.toFixed(2)}`;
-    yourAmount.textContent = `£${yourTotal.toFixed(2)}`;
-    spouseAmount.textContent = `£${spouseTotal.toFixed(2)}`;
+    totalAmount.textContent = `£${summary.total.toFixed(2)}`;
+    yourAmount.textContent = `£${(summary.by_payer.you || 0).toFixed(2)}`;
+    spouseAmount.textContent = `£${(summary.by_payer.spouse || 0).toFixed(2)}`;
 }
 
 function updateCategoryTotals() {
-    const monthKey = getMonthKey(currentMonth);
-    const monthExpenses = expenses[monthKey] || [];
+    const categories = getMonthSummary(getMonthKey(currentMonth)).by_category;
     
     // Clear previous category totals
     categoryTotals.innerHTML = '';
     
-    // Calculate totals by category
-    const categories = {};
-    
-    monthExpenses.forEach(expense => {
-        const category = expense.category;
-        const amount = parseFloat(expense.amount);
-        
-        if (!categories[category]) {
-            categories[category] = 0;
-        }
-        
-        categories[category] += amount;
-    });
-    
     // Create category total items
     for (const category in categories) {
         const categoryItem = document.createElement('div');
@@ -720,16 +782,8 @@ function updateCategoryTotals() {
     }
 }
 
-function computeTotalsByCategory(monthExpenses) {
-    const totals = {};
-    let total = 0;
-    monthExpenses.forEach(expense => {
-        const amount = parseFloat(expense.amount);
-        total += amount;
-        const cat = expense.category;
-        totals[cat] = (totals[cat] || 0) + amount;
-    });
-    return { total, byCategory: totals };
+function emptySummary() {
+    return { total: 0, count: 0, by_category: {}, by_payer: {}, daily: [] };
 }
 
 async function updateDashboard() {
@@ -738,14 +792,18 @@ async function updateDashboard() {
         const prevDate = new Date(currentMonth.getFullYear(), currentMonth.getMonth() - 1, 1);
         const prevKey = getMonthKey(prevDate);
 
-        const [thisRes, prevRes] = await Promise.all([
-            apiFetch(`${API_BASE}/expenses?month=${encodeURIComponent(thisKey)}`),
-            apiFetch(`${API_BASE}/expenses?month=${encodeURIComponent(prevKey)}`)
-        ]);
-        const thisJson = await thisRes.json();
-        const prevJson = await prevRes.json();
-        const thisTotals = computeTotalsByCategory(thisJson.expenses || []);
-        const prevTotals = computeTotalsByCategory(prevJson.expenses || []);
+        // One aggregate request for both months instead of downloading every row twice
+        const res = await apiFetch(`${API_BASE}/summary?from=${encodeURIComponent(prevKey)}&to=${encodeURIComponent(thisKey)}`);
+        if (!res.ok) throw new Error('Failed to load summary');
+        const data = await res.json();
+        summaries[thisKey] = data.months[thisKey] || emptySummary();
+        summaries[prevKey] = data.months[prevKey] || emptySummary();
+        if (totalAmount) updateSummary();
+        if (categoryTotals) updateCategoryTotals();
+        if (currentBalance) updateBalanceDisplay();
+        if (!dashThisMonth) return;
+        const thisTotals = { total: summaries[thisKey].total, byCategory: summaries[thisKey].by_category };
+        const prevTotals = { total: summaries[prevKey].total, byCategory: summaries[prevKey].by_category };
 
         dashThisMonth.textContent = `£${thisTotals.total.toFixed(2)}`;
         dashPrevMonth.textContent = `£${prevTotals.total.toFixed(2)}`;
@@ -791,12 +849,7 @@ async function updateDashboard() {
 function updateBalanceDisplay() {
     const monthKey = getMonthKey(currentMonth);
     const startBalance = balances[monthKey] || 0;
-    const monthExpenses = expenses[monthKey] || [];
-    
-    let totalExpenses = 0;
-    monthExpenses.forEach(expense => {
-        totalExpenses += parseFloat(expense.amount);
-    });
+    const totalExpenses = getMonthSummary(monthKey).total;
     
     const remainingBalance = startBalance - totalExpenses;
     
@@ -846,6 +899,8 @@ async function loadExpenses() {
         if (!res.ok) throw new Error('Failed to load expenses');
         const data = await res.json();
         expenses[monthKey] = data.expenses || [];
+        // Rows just changed; use them until updateDashboard brings a fresh aggregate
+        delete summaries[monthKey];
         updateSummary();
         updateCategoryTotals();
         updateDashboard();
@@ -1045,42 +1100,19 @@ function importData(event) {
         try {
             const text = e.target.result;
             if (file.name.toLowerCase().endsWith('.csv') || (file.type && file.type.includes('csv'))) {
-                const rows = text.split(/\r?\n/).filter(l => l.trim().length);
-                if (rows.length < 2) throw new Error('CSV must have headers and data');
-                const headers = rows[0].split(',').map(h => h.trim().toLowerCase());
-                const idx = {
-                    description: headers.indexOf('description'),
-                    amount: headers.indexOf('amount'),
-                    date: headers.indexOf('date'),
-                    category: headers.indexOf('category'),
-                    payer: headers.indexOf('payer')
-                };
-                if (Object.values(idx).some(v => v === -1)) {
+                const header = (text.split(/\r?\n/, 1)[0] || '').split(',').map(h => h.trim().toLowerCase());
+                if (['description', 'amount', 'date', 'category', 'payer'].some(h => !header.includes(h))) {
                     alert('CSV headers must include description, amount, date, category, payer');
                     return;
                 }
-                let success = 0, failed = 0;
-                for (let i = 1; i < rows.length; i++) {
-                    const cols = rows[i].split(',').map(c => c.trim());
-                    if (cols.length < headers.length) continue;
-                    const payload = {
-                        description: cols[idx.description],
-                        amount: parseFloat(cols[idx.amount]),
-                        date: cols[idx.date],
-                        category: cols[idx.category],
-                        payer: cols[idx.payer]
-                    };
-                    if (!payload.description || isNaN(payload.amount) || !payload.date || !payload.category || !payload.payer) {
-                        failed++;
-                        continue;
-                    }
-                    try {
-                        const res = await apiFetch(`${API_BASE}/expenses`, {
-                            method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify(payload)
-                        });
-                        if (res.ok) success++; else failed++;
-                    } catch { failed++; }
-                }
+                // One bulk request; the server validates each row and reports failures
+                const res = await apiFetch(`${API_BASE}/expenses/bulk`, {
+                    method: 'POST', headers: { 'Content-Type': 'text/csv' }, body: text
+                });
+                const result = await res.json().catch(() => ({}));
+                if (!res.ok) throw new Error(result.error || 'Bulk import failed');
+                const success = result.inserted || 0;
+                const failed = result.failed || 0;
                 await loadExpenses();
                 renderExpenses();
                 updateBalanceDisplay();
@@ -1096,6 +1128,7 @@ function importData(event) {
                 }
                 expenses = data.expenses;
                 balances = data.balances;
+                summaries = {};
                 saveExpenses();
                 saveBalances();
                 renderExpenses();
@@ -4,14 +4,1070 @@ import os
 import base64
 import secrets
 import hashlib
+import hmac
+import queue
+import signal
+import threading
+import time
+import calendar
+import re
+import io
+import csv
+import mimetypes
+import tempfile
+import sys
+import gzip
+import zlib
+import bisect
+import math
+import random
+import cProfile
+import pstats
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from http.server import HTTPServer, BaseHTTPRequestHandler
-from urllib.parse import urlparse, parse_qs
+from urllib.parse import urlparse, parse_qs, unquote
+from email.utils import formatdate, parsedate_to_datetime
+
+try:
+    # Optional: enables ?size= previews on /api/receipts
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = ImageOps = None
+
+try:
+    # Optional: adds "br" to Accept-Encoding negotiation for JSON responses
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    # Optional: encodes JSON responses several times faster than the json module
+    import orjson
+except ImportError:
+    orjson = None
 
 DB_PATH = 'expenses.db'
 
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
+# Applied once to every connection the manager opens
+DB_PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA foreign_keys=ON',
+    'PRAGMA busy_timeout=5000',
+    f"PRAGMA mmap_size={int(os.environ.get('DB_MMAP_SIZE', str(256 * 1024 * 1024)))}",
+    f"PRAGMA cache_size=-{int(os.environ.get('DB_CACHE_KB', '16384'))}",
+)
+
+
+class QueryStats(threading.local):
+    """SQLite statements run and time spent on the current thread since the last reset()."""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        # "METHOD /path" of the request being served, for slow-query records
+        self.request = None
+
+    def reset(self, request=None):
+        self.count = 0
+        self.seconds = 0.0
+        self.request = request
+
+
+query_stats = QueryStats()
+
+
+class RequestProfiler:
+    """Slow-request and slow-query log, with optional cProfile sampling of requests.
+
+    Requests slower than ``slow_request_seconds`` and statements slower than
+    ``slow_query_seconds`` are appended to a ring buffer of the last ``size``
+    records. When ``sample_rate`` is above zero, that fraction of requests
+    runs under cProfile, and slow ones carry the top of the profile sorted by
+    cumulative time.
+    """
+
+    def __init__(self, sample_rate=0.0, slow_request_ms=500, slow_query_ms=100, size=200, top=25):
+        self.sample_rate = sample_rate
+        self.slow_request_seconds = slow_request_ms / 1000
+        self.slow_query_seconds = slow_query_ms / 1000
+        self.top = top
+        self.sampled = 0
+        # Another profiler was already active (only one may run at a time on 3.12+)
+        self.skipped = 0
+        self._records = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def configure(self, sample_rate=None, slow_request_ms=None, slow_query_ms=None):
+        if sample_rate is not None:
+            if not 0 <= sample_rate <= 1:
+                raise ValueError('sample_rate must be between 0 and 1')
+            self.sample_rate = sample_rate
+        if slow_request_ms is not None:
+            if slow_request_ms < 0:
+                raise ValueError('slow_request_ms must not be negative')
+            self.slow_request_seconds = slow_request_ms / 1000
+        if slow_query_ms is not None:
+            if slow_query_ms < 0:
+                raise ValueError('slow_query_ms must not be negative')
+            self.slow_query_seconds = slow_query_ms / 1000
+
+    def start(self):
+        """A running cProfile.Profile if this request was sampled, else None."""
+        if not self.sample_rate or random.random() >= self.sample_rate:
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            with self._lock:
+                self.skipped += 1
+            return None
+        with self._lock:
+            self.sampled += 1
+        return profile
+
+    def _add(self, record):
+        record['at'] = formatdate(usegmt=True)
+        with self._lock:
+            self._records.append(record)
+
+    def request_done(self, request, route, status, seconds, db_queries, db_seconds, profile=None):
+        if profile is not None:
+            profile.disable()
+        if seconds < self.slow_request_seconds:
+            return
+        record = {'kind': 'request', 'request': request, 'route': route, 'status': status,
+                  'ms': round(seconds * 1000, 3), 'db_queries': db_queries, 'db_ms': round(db_seconds * 1000, 3)}
+        if profile is not None:
+            out = io.StringIO()
+            pstats.Stats(profile, stream=out).strip_dirs().sort_stats('cumulative').print_stats(self.top)
+            record['profile'] = out.getvalue()
+        self._add(record)
+
+    def query_done(self, sql, seconds):
+        self._add({'kind': 'query', 'request': query_stats.request, 'sql': ' '.join(str(sql).split())[:1000],
+                   'ms': round(seconds * 1000, 3)})
+
+    def records(self, kind=None):
+        with self._lock:
+            records = list(self._records)
+        if kind:
+            records = [r for r in records if r['kind'] == kind]
+        return records
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+
+    def stats(self):
+        return {'sample_rate': self.sample_rate, 'slow_request_ms': self.slow_request_seconds * 1000,
+                'slow_query_ms': self.slow_query_seconds * 1000, 'size': self._records.maxlen,
+                'records': len(self._records), 'sampled': self.sampled, 'skipped': self.skipped}
+
+
+profiler = RequestProfiler(
+    sample_rate=float(os.environ.get('PROFILE_SAMPLE_RATE', '0')),
+    slow_request_ms=float(os.environ.get('SLOW_REQUEST_MS', '500')),
+    slow_query_ms=float(os.environ.get('SLOW_QUERY_MS', '100')),
+    size=int(os.environ.get('SLOW_LOG_SIZE', '200')),
+)
+
+
+def _query_done(sql, started, statements):
+    elapsed = time.perf_counter() - started
+    query_stats.count += statements
+    query_stats.seconds += elapsed
+    if elapsed >= profiler.slow_query_seconds:
+        profiler.query_done(sql, elapsed)
+
+
+class TimedCursor(sqlite3.Cursor):
+    # SQL of the last execute, so slow fetches can be attributed to it
+    sql = None
+
+    # Rows are stepped lazily, so fetches are timed as well as execute
+    def execute(self, sql, *args):
+        self.sql = sql
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, *args)
+        finally:
+            _query_done(sql, started, 1)
+
+    def executemany(self, sql, *args):
+        self.sql = sql
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, *args)
+        finally:
+            _query_done(sql, started, 1)
+
+    def fetchone(self):
+        started = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            _query_done(self.sql, started, 0)
+
+    def fetchmany(self, *args):
+        started = time.perf_counter()
+        try:
+            return super().fetchmany(*args)
+        finally:
+            _query_done(self.sql, started, 0)
+
+    def fetchall(self):
+        started = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            _query_done(self.sql, started, 0)
+
+
+class TimedConnection(sqlite3.Connection):
+    """Connection whose cursors report into query_stats and the slow-query log."""
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    # The C implementations of these bypass cursor(), so route them through it
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+    def commit(self):
+        started = time.perf_counter()
+        try:
+            super().commit()
+        finally:
+            _query_done('COMMIT', started, 0)
+
+
+class ConnectionManager:
+    """Keeps one long-lived SQLite connection per thread.
+
+    Server threads are a fixed pool, so the number of open connections is
+    bounded by the worker count. Connections are configured with DB_PRAGMAS
+    when opened and then reused for every later request on that thread.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._conns = {}
+        self.opened = 0
+        self.reused = 0
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, factory=TimedConnection)
+        for pragma in DB_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def get(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            with self._lock:
+                self.reused += 1
+            return conn
+        conn = self.connect()
+        self._local.conn = conn
+        with self._lock:
+            self.opened += 1
+            self._conns[threading.get_ident()] = conn
+        return conn
+
+    def rollback(self):
+        """Discard any transaction left open on this thread's connection."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and conn.in_transaction:
+            conn.rollback()
+
+    def close_all(self):
+        with self._lock:
+            conns = list(self._conns.values())
+            self._conns.clear()
+        for conn in conns:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                'path': self.path,
+                'open_connections': len(self._conns),
+                'opened': self.opened,
+                'reused': self.reused,
+                'pragmas': list(DB_PRAGMAS),
+            }
+
+
+db = ConnectionManager(DB_PATH)
+
+
+class _WriteOp:
+    __slots__ = ('fn', 'args', 'request', 'queued', 'done', 'result', 'error', 'statements', 'seconds')
+
+    def __init__(self, fn, args, request):
+        self.fn = fn
+        self.args = args
+        self.request = request
+        self.queued = time.perf_counter()
+        # Held until the writer has committed (or failed) this op
+        self.done = threading.Lock()
+        self.done.acquire()
+        self.result = None
+        self.error = None
+        # SQLite work done for this op on the writer thread, its share of the commit included
+        self.statements = 0
+        self.seconds = 0.0
+
+
+# Bucket upper bounds for the writer's histograms
+WRITE_BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+WRITE_COMMIT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+
+class DbWriter:
+    """The one thread that writes to the database.
+
+    Handlers pass a function to ``submit``; the writer calls it with a cursor
+    inside a transaction and hands back its return value (or exception) once
+    that transaction has committed. Ops already queued, plus any arriving
+    within ``window`` seconds, share one transaction and one commit, up to
+    ``max_batch`` ops. Each op runs under its own SAVEPOINT, so one that raises
+    is undone without failing the rest of its batch.
+
+    Op functions must not commit or roll back themselves, and should not wait
+    on anything slow (network reads, password hashing) since every other write
+    waits behind them.
+    """
+
+    def __init__(self, max_batch=64, window=0.0):
+        self.max_batch = max_batch
+        self.window = window
+        self.ops = 0
+        self.failed = 0
+        self.batches = 0
+        self.commit_failures = 0
+        self.queue_seconds = 0.0
+        self.batch_buckets = [0] * (len(WRITE_BATCH_BUCKETS) + 1)
+        self.commit_buckets = [0] * (len(WRITE_COMMIT_BUCKETS) + 1)
+        self.commit_seconds = 0.0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._stopped = False
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if not self._stopped:
+                self._start_locked()
+
+    def _start_locked(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=10.0):
+        """Commit whatever is queued, then end the thread; later submits raise RuntimeError."""
+        with self._lock:
+            # _thread stays set, so ops still draining can nest submits inline
+            thread = self._thread if not self._stopped else None
+            self._stopped = True
+            if thread is not None:
+                self._queue.put(None)
+        if thread is not None:
+            thread.join(timeout)
+
+    def submit(self, fn, *args):
+        """Run ``fn(cur, *args)`` on the writer; returns its result after the commit, or raises its error."""
+        if threading.current_thread() is self._thread:
+            # Already inside a batch; nesting through the queue would deadlock
+            return fn(self._cur, *args)
+        op = _WriteOp(fn, args, query_stats.request)
+        with self._lock:
+            if self._stopped:
+                raise RuntimeError('Database writer is stopped')
+            self._start_locked()
+            # Under the lock, so nothing lands behind the stop() sentinel
+            self._queue.put(op)
+        op.done.acquire()
+        # Counted for the submitting request, as if its statements had run on this thread
+        query_stats.count += op.statements
+        query_stats.seconds += op.seconds
+        if op.error is not None:
+            raise op.error
+        return op.result
+
+    def _run(self):
+        conn = db.get()
+        self._cur = conn.cursor()
+        while True:
+            op = self._queue.get()
+            if op is None:
+                return
+            batch = [op]
+            stopping = False
+            deadline = time.perf_counter() + self.window
+            while len(batch) < self.max_batch:
+                try:
+                    remaining = deadline - time.perf_counter()
+                    op = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if op is None:
+                    stopping = True
+                    break
+                batch.append(op)
+            self._execute(conn, batch)
+            if stopping:
+                return
+
+    def _execute(self, conn, batch):
+        cur = self._cur
+        started = time.perf_counter()
+        try:
+            cur.execute('BEGIN IMMEDIATE')
+            for op in batch:
+                query_stats.reset(op.request)
+                cur.execute('SAVEPOINT write_op')
+                try:
+                    op.result = op.fn(cur, *op.args)
+                except Exception as e:
+                    op.error = e
+                    # If this fails too, the handler below fails the whole batch
+                    cur.execute('ROLLBACK TO write_op')
+                cur.execute('RELEASE write_op')
+                op.statements, op.seconds = query_stats.count, query_stats.seconds
+            query_stats.reset()
+            conn.commit()
+            for op in batch:
+                op.statements += query_stats.count
+                op.seconds += query_stats.seconds
+        except Exception as e:
+            # The transaction itself failed (commit, savepoint handling, ...): nothing in it was kept
+            for op in batch:
+                op.result = None
+                op.error = op.error or e
+            try:
+                conn.rollback()
+            except sqlite3.Error as rollback_error:
+                print(f'Database writer could not roll back a failed batch: {rollback_error}', file=sys.stderr)
+            with self._lock:
+                self.commit_failures += 1
+        finally:
+            query_stats.reset()
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.ops += len(batch)
+            self.failed += sum(1 for op in batch if op.error is not None)
+            self.batches += 1
+            self.queue_seconds += sum(started - op.queued for op in batch)
+            self.batch_buckets[bisect.bisect_left(WRITE_BATCH_BUCKETS, len(batch))] += 1
+            self.commit_buckets[bisect.bisect_left(WRITE_COMMIT_BUCKETS, elapsed)] += 1
+            self.commit_seconds += elapsed
+        for op in batch:
+            op.done.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'running': self._thread is not None and not self._stopped,
+                'queued': self._queue.qsize(),
+                'max_batch': self.max_batch,
+                'window_ms': self.window * 1000,
+                'ops': self.ops,
+                'failed': self.failed,
+                'batches': self.batches,
+                'commit_failures': self.commit_failures,
+                'avg_batch_size': round(self.ops / self.batches, 2) if self.batches else None,
+                'avg_commit_ms': round(self.commit_seconds / self.batches * 1000, 3) if self.batches else None,
+                'avg_queue_ms': round(self.queue_seconds / self.ops * 1000, 3) if self.ops else None,
+                'batch_size_buckets': dict(zip([str(b) for b in WRITE_BATCH_BUCKETS] + ['+Inf'],
+                                               self.batch_buckets)),
+                'commit_seconds_buckets': dict(zip([str(b) for b in WRITE_COMMIT_BUCKETS] + ['+Inf'],
+                                                   self.commit_buckets)),
+            }
+
+    def prometheus(self):
+        with self._lock:
+            batch, commit = list(self.batch_buckets), list(self.commit_buckets)
+            ops, batches, commit_seconds, queue_seconds = self.ops, self.batches, self.commit_seconds, self.queue_seconds
+            failed = self.failed
+        lines = ['# HELP sqlite_write_batch_size Write ops group-committed per transaction.',
+                 '# TYPE sqlite_write_batch_size histogram']
+        prometheus_histogram(lines, 'sqlite_write_batch_size', '', WRITE_BATCH_BUCKETS, batch, ops, batches)
+        lines += ['# HELP sqlite_write_commit_seconds Time from BEGIN to COMMIT of each write batch.',
+                  '# TYPE sqlite_write_commit_seconds histogram']
+        prometheus_histogram(lines, 'sqlite_write_commit_seconds', '', WRITE_COMMIT_BUCKETS, commit,
+                             commit_seconds, batches)
+        lines += ['# HELP sqlite_write_queue_seconds_total Time write ops spent queued for the writer.',
+                  '# TYPE sqlite_write_queue_seconds_total counter',
+                  f'sqlite_write_queue_seconds_total {queue_seconds:.6f}',
+                  '# HELP sqlite_write_ops_failed_total Write ops that raised and were rolled back.',
+                  '# TYPE sqlite_write_ops_failed_total counter',
+                  f'sqlite_write_ops_failed_total {failed}']
+        return '\n'.join(lines) + '\n'
+
+
+writer = DbWriter(
+    max_batch=int(os.environ.get('WRITE_BATCH_MAX', '64')),
+    window=float(os.environ.get('WRITE_BATCH_WINDOW_MS', '0')) / 1000,
+)
+
+class Session:
+    __slots__ = ('user_id', 'username', 'role', 'expires_at')
+
+    def __init__(self, user_id, username, role, expires_at):
+        self.user_id = user_id
+        self.username = username
+        self.role = role
+        self.expires_at = expires_at
+
+
+class SessionCache:
+    """Bounded LRU of session token -> Session.
+
+    Entries are dropped when the session itself expires or after ``ttl``
+    seconds, whichever comes first, so changes made directly in the database
+    are picked up within ``ttl``. Logout and role changes invalidate eagerly.
+    """
+
+    def __init__(self, max_size=4096, ttl=300.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is not None:
+                session, cached_until = entry
+                if now < cached_until and now < session.expires_at:
+                    self._entries.move_to_end(token)
+                    self.hits += 1
+                    return session
+                del self._entries[token]
+            self.misses += 1
+            return None
+
+    def put(self, token, user_id, username, role, expires_at):
+        """Cache a session row; ``expires_at`` is SQLite's UTC 'YYYY-MM-DD HH:MM:SS'."""
+        session = Session(user_id, username, role, calendar.timegm(time.strptime(expires_at, '%Y-%m-%d %H:%M:%S')))
+        with self._lock:
+            self._entries[token] = (session, time.time() + self.ttl)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return session
+
+    def invalidate(self, token):
+        with self._lock:
+            self._entries.pop(token, None)
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            for token in [t for t, (sess, _) in self._entries.items() if sess.user_id == user_id]:
+                del self._entries[token]
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries), 'max_size': self.max_size, 'ttl': self.ttl,
+                    'hits': self.hits, 'misses': self.misses}
+
+
+session_cache = SessionCache(
+    max_size=int(os.environ.get('SESSION_CACHE_SIZE', '4096')),
+    ttl=float(os.environ.get('SESSION_CACHE_TTL', '300')),
+)
+
+
+class SignedSessions:
+    """Stateless session tokens verified without touching SQLite.
+
+    A token is ``base64url(JSON [user_id, username, role, issued, expires, nonce])``
+    followed by ``.`` and an HMAC-SHA256 of that text; the nonce keeps two
+    logins in the same second from sharing a token. Logout and role
+    changes can only be enforced in memory (revoked tokens and a per-user
+    not-before time), which a restart forgets, so keep lifetimes short where
+    that matters.
+    """
+
+    def __init__(self, secret):
+        self._key = secret.encode('utf-8')
+        self._lock = threading.Lock()
+        self._revoked = {}
+        self._not_before = {}
+
+    def _sign(self, payload):
+        mac = hmac.new(self._key, payload, hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(mac).rstrip(b'=')
+
+    def issue(self, user_id, username, role, ttl):
+        # Issued at full clock resolution, so a login right after revoke_user() is not caught by it
+        now = time.time()
+        payload = base64.urlsafe_b64encode(
+            json.dumps([user_id, username, role, now, int(now + ttl), secrets.token_hex(4)],
+                       separators=(',', ':')).encode('utf-8')
+        ).rstrip(b'=')
+        return (payload + b'.' + self._sign(payload)).decode('ascii')
+
+    def verify(self, token):
+        """Return the Session a valid, unexpired, unrevoked token stands for, else None."""
+        payload, _, mac = token.encode('ascii', 'replace').partition(b'.')
+        if not mac or not hmac.compare_digest(mac, self._sign(payload)):
+            return None
+        try:
+            user_id, username, role, issued, expires, _ = json.loads(
+                base64.urlsafe_b64decode(payload + b'=' * (-len(payload) % 4)))
+        except (TypeError, ValueError):
+            return None
+        if expires <= time.time():
+            return None
+        with self._lock:
+            if token in self._revoked or issued <= self._not_before.get(user_id, 0):
+                return None
+        return Session(user_id, username, role, expires)
+
+    def revoke(self, token):
+        session = self.verify(token)
+        if session is not None:
+            with self._lock:
+                self._revoked[token] = session.expires_at
+
+    def revoke_user(self, user_id):
+        """Reject every token issued to ``user_id`` up to now."""
+        with self._lock:
+            self._not_before[user_id] = time.time()
+
+    def prune(self):
+        now = time.time()
+        with self._lock:
+            for token in [t for t, expires in self._revoked.items() if expires <= now]:
+                del self._revoked[token]
+
+    def stats(self):
+        with self._lock:
+            return {'revoked': len(self._revoked), 'users_not_before': len(self._not_before)}
+
+
+# 'db' keeps a sessions row per login; 'signed' issues stateless HMAC tokens
+SESSION_MODE = os.environ.get('SESSION_MODE', 'db').strip().lower()
+if SESSION_MODE not in ('db', 'signed'):
+    raise ValueError(f'Unknown SESSION_MODE: {SESSION_MODE}')
+if SESSION_MODE == 'signed' and not os.environ.get('SESSION_SECRET'):
+    print('SESSION_SECRET is not set; signed sessions will not survive a restart')
+signed_sessions = SignedSessions(os.environ.get('SESSION_SECRET') or secrets.token_hex(32))
+
+
+class SessionJanitor:
+    """Background thread that deletes expired sessions rows in small batches.
+
+    Each batch is its own short write transaction, so logins never queue
+    behind one large DELETE.
+    """
+
+    def __init__(self, interval=300.0, batch_size=1000):
+        self.interval = interval
+        self.batch_size = batch_size
+        self._stop = threading.Event()
+        self._thread = None
+        self.runs = 0
+        self.deleted = 0
+        self.last_error = None
+
+    def start(self):
+        if self._thread is None and self.interval > 0:
+            self._thread = threading.Thread(target=self._run, name='session-janitor', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(5)
+
+    def _delete_batch(self, cur):
+        cur.execute('DELETE FROM sessions WHERE token IN (SELECT token FROM sessions '
+                    'WHERE expires_at <= datetime("now") LIMIT ?)', (self.batch_size,))
+        return cur.rowcount
+
+    def run_once(self):
+        """Delete every session expired by now; returns how many rows went."""
+        deleted = 0
+        while not self._stop.is_set():
+            batch = writer.submit(self._delete_batch)
+            deleted += batch
+            if batch < self.batch_size:
+                break
+            # Let waiting writers in between batches
+            self._stop.wait(0.01)
+        signed_sessions.prune()
+        self.runs += 1
+        self.deleted += deleted
+        return deleted
+
+    def _run(self):
+        # First pass right away clears whatever piled up while the server was down
+        while True:
+            try:
+                self.run_once()
+                self.last_error = None
+            except Exception as e:
+                # Keep the thread alive: a dead janitor lets expired sessions pile up unnoticed
+                self.last_error = f'{type(e).__name__}: {e}'
+                print(f'Session janitor run failed: {self.last_error}', file=sys.stderr)
+                try:
+                    db.rollback()
+                except sqlite3.Error:
+                    pass
+            if self._stop.wait(self.interval):
+                return
+
+    def stats(self):
+        return {'interval': self.interval, 'batch_size': self.batch_size, 'runs': self.runs,
+                'deleted': self.deleted, 'last_error': self.last_error}
+
+
+session_janitor = SessionJanitor(
+    interval=float(os.environ.get('SESSION_JANITOR_INTERVAL', '300')),
+    batch_size=int(os.environ.get('SESSION_JANITOR_BATCH', '1000')),
+)
+
+
+class DataVersions:
+    """Change stamps for cached reads: one per table, plus one per month for expenses.
+
+    Stamps come from a single counter, so the version of a range of months is
+    the largest stamp inside it. Writers bump *after* committing, and readers
+    take the version *before* querying, so data filed under a version is never
+    older than that version. A reader that runs between a commit and its bump
+    may file the new data under the old version; that entry is only served
+    until the bump, after which every reader gets the new version and misses.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clock = 0
+        self._latest = {}
+        self._whole = {}
+        self._months = {}
+
+    def bump(self, table, months=None):
+        """Record a committed write to ``table``; ``months=None`` means it may touch any month."""
+        with self._lock:
+            self._clock += 1
+            self._latest[table] = self._clock
+            if months is None:
+                self._whole[table] = self._clock
+            else:
+                per_month = self._months.setdefault(table, {})
+                for mk in months:
+                    per_month[mk] = self._clock
+
+    def version(self, table, first=None, last=None):
+        """Stamp for the whole table, or for the inclusive month range ``first``..``last``."""
+        with self._lock:
+            if first is None:
+                return self._latest.get(table, 0)
+            stamp = self._whole.get(table, 0)
+            for mk, month_stamp in self._months.get(table, {}).items():
+                if first <= mk <= last and month_stamp > stamp:
+                    stamp = month_stamp
+            return stamp
+
+
+data_versions = DataVersions()
+
+
+class EventSubscriber:
+    __slots__ = ('queue', 'role')
+
+    def __init__(self, role):
+        # Frames to send; None ends the stream once everything before it is sent
+        self.queue = queue.Queue()
+        self.role = role
+
+
+class EventBus:
+    """Fans change notifications out to /api/events subscribers.
+
+    Every stream holds a worker thread, so at most ``max_subscribers`` may be
+    open. A subscriber that falls ``queue_size`` events behind is dropped; the
+    last ``backlog`` events are kept so a client reconnecting with
+    Last-Event-ID gets what it missed, or a ``reset`` event when it is too far
+    behind (or the server restarted) and should reload everything.
+    """
+
+    def __init__(self, max_subscribers=8, backlog=256, queue_size=256):
+        self.max_subscribers = max_subscribers
+        self.queue_size = queue_size
+        self.published = 0
+        self.dropped = 0
+        self.rejected = 0
+        self._next_id = 0
+        self._recent = deque(maxlen=backlog)
+        self._subscribers = set()
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def publish(self, entity, action, id=None, month_key=None, roles=None):
+        """Announce a committed change; ``roles`` limits who is told about it."""
+        payload = {'entity': entity, 'action': action, 'id': id, 'month_key': month_key}
+        with self._lock:
+            self._next_id += 1
+            event_id = self._next_id
+            frame = b'id: %s-%d\nevent: change\ndata: %s\n\n' % (BOOT_ID.encode('ascii'), event_id, json_bytes(payload))
+            roles = frozenset(roles) if roles else None
+            self._recent.append((event_id, roles, frame))
+            self.published += 1
+            for sub in list(self._subscribers):
+                if roles is not None and sub.role not in roles:
+                    continue
+                if sub.queue.qsize() >= self.queue_size:
+                    self._drop(sub)
+                    continue
+                sub.queue.put(frame)
+
+    def _drop(self, sub):
+        self._subscribers.discard(sub)
+        sub.queue.put(None)
+        self.dropped += 1
+
+    def subscribe(self, role, last_event_id=None):
+        """``(subscriber, frames to replay)``, or None when the bus is full or closed."""
+        with self._lock:
+            if self._closed or len(self._subscribers) >= self.max_subscribers:
+                self.rejected += 1
+                return None
+            sub = EventSubscriber(role)
+            self._subscribers.add(sub)
+            return sub, self._replay(role, last_event_id)
+
+    def _replay(self, role, last_event_id):
+        if not last_event_id:
+            return []
+        boot, _, seen = last_event_id.partition('-')
+        try:
+            seen = int(seen)
+        except ValueError:
+            seen = -1
+        # Anything we no longer hold (or ids from before a restart) means the client missed events
+        oldest = self._recent[0][0] if self._recent else self._next_id + 1
+        if boot != BOOT_ID or not 0 <= seen <= self._next_id or seen + 1 < oldest:
+            return [b'event: reset\ndata: {}\n\n']
+        return [frame for event_id, roles, frame in self._recent
+                if event_id > seen and (roles is None or role in roles)]
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self._subscribers.discard(sub)
+
+    def close(self):
+        """End every open stream; used on shutdown."""
+        with self._lock:
+            self._closed = True
+            for sub in list(self._subscribers):
+                self._subscribers.discard(sub)
+                sub.queue.put(None)
+
+    def stats(self):
+        with self._lock:
+            return {'subscribers': len(self._subscribers), 'max_subscribers': self.max_subscribers,
+                    'published': self.published, 'dropped': self.dropped, 'rejected': self.rejected}
+
+
+SERVER_WORKERS = int(os.environ.get('SERVER_WORKERS', '16'))
+# Each open stream holds a worker, so by default at most half of them serve /api/events
+SSE_MAX_SUBSCRIBERS = int(os.environ.get('SSE_MAX_SUBSCRIBERS', str(max(1, SERVER_WORKERS // 2))))
+# Seconds between keep-alive comments; also how often a stream rechecks its session
+SSE_HEARTBEAT = float(os.environ.get('SSE_HEARTBEAT', '15'))
+events = EventBus(
+    max_subscribers=SSE_MAX_SUBSCRIBERS,
+    backlog=int(os.environ.get('SSE_BACKLOG', '256')),
+    queue_size=int(os.environ.get('SSE_QUEUE_SIZE', '256')),
+)
+
+
+class CachedBody:
+    __slots__ = ('etag', 'body', 'encoded')
+
+    def __init__(self, etag, body):
+        self.etag = etag
+        self.body = body
+        # Compressed variants, filled in the first time a client asks for one
+        self.encoded = {}
+
+
+class ResponseCache:
+    """Byte-bounded LRU of serialized read responses, keyed by request target and data version.
+
+    Entries for old versions are never looked up again and simply age out.
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, entry):
+        # Don't let one huge listing flush everything else
+        if len(entry.body) > self.max_bytes // 8:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old.body)
+            self._entries[key] = entry
+            self.size += len(entry.body)
+            while self.size > self.max_bytes:
+                _, dropped = self._entries.popitem(last=False)
+                self.size -= len(dropped.body)
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self.size, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses}
+
+
+response_cache = ResponseCache(int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', str(32 * 1024 * 1024))))
+# ETags embed this so versions restarting at zero after a restart never match old copies
+BOOT_ID = secrets.token_hex(4)
+
+class KdfBusy(Exception):
+    """Raised when too many password hashes are already queued."""
+
+
+class PasswordHasher:
+    """Salted scrypt or PBKDF2 password hashes, computed on a small dedicated thread pool.
+
+    Stored hashes carry their algorithm and cost (``scrypt$n$r$p$<hex>`` or
+    ``pbkdf2_sha256$iterations$<hex>``) next to the row's salt, so the cost can
+    be raised later: verify() flags rows made with other settings, and rows
+    from the old single-round SHA-256 scheme, as needing a rehash. Both KDFs
+    release the GIL, so hashing runs alongside request handling. A request
+    waiting on a hash still holds its HTTP worker, so at most ``max_pending``
+    hashes may be queued or running before KdfBusy is raised.
+    """
+
+    def __init__(self, algorithm='scrypt', scrypt_n=2 ** 14, scrypt_r=8, scrypt_p=1,
+                 pbkdf2_iterations=600000, workers=2, max_pending=32):
+        if algorithm == 'scrypt':
+            self.scheme = f'scrypt${scrypt_n}${scrypt_r}${scrypt_p}'
+        elif algorithm == 'pbkdf2':
+            self.scheme = f'pbkdf2_sha256${pbkdf2_iterations}'
+        else:
+            raise ValueError(f'Unknown PASSWORD_KDF: {algorithm}')
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self._pool = None
+        self._lock = threading.Lock()
+        self._dummy = None
+        self.hashed = 0
+        self.rehashed = 0
+        self.rejected = 0
+
+    @staticmethod
+    def _derive(scheme, password, salt):
+        params = scheme.split('$')
+        if params[0] == 'scrypt':
+            n, r, p = (int(v) for v in params[1:4])
+            key = hashlib.scrypt(password.encode('utf-8'), salt=salt.encode('utf-8'), n=n, r=r, p=p,
+                                 maxmem=2 * 128 * n * r * p + 1024 * 1024, dklen=32)
+        elif params[0] == 'pbkdf2_sha256':
+            key = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt.encode('utf-8'), int(params[1]))
+        else:
+            raise ValueError(f'Unknown password scheme: {params[0]}')
+        return f'{scheme}${key.hex()}'
+
+    def _run(self, fn, *args):
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise KdfBusy()
+            self.pending += 1
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix='kdf')
+        try:
+            return self._pool.submit(fn, *args).result()
+        finally:
+            with self._lock:
+                self.pending -= 1
+
+    def hash(self, password, rehash=False):
+        """Return ``(password_hash, salt)`` for a new password, or a rehashed one with ``rehash=True``."""
+        salt = secrets.token_hex(16)
+        password_hash = self._run(self._derive, self.scheme, password, salt)
+        with self._lock:
+            self.hashed += 1
+            if rehash:
+                self.rehashed += 1
+        return password_hash, salt
+
+    def verify(self, password, stored, salt):
+        """Return ``(matches, needs_rehash)``.
+
+        With ``stored=None`` a throwaway hash is checked instead, so unknown
+        usernames take as long as wrong passwords.
+        """
+        if stored is None:
+            if self._dummy is None:
+                self._dummy = self.hash(secrets.token_hex(16))
+            stored, salt = self._dummy
+            self._run(self._derive, self.scheme, password, salt)
+            return False, False
+        if '$' not in stored:
+            # Legacy: one round of sha256(salt + password)
+            calc = hashlib.sha256((salt + password).encode('utf-8')).hexdigest()
+            return hmac.compare_digest(calc, stored), True
+        scheme = stored.rsplit('$', 1)[0]
+        calc = self._run(self._derive, scheme, password, salt)
+        return hmac.compare_digest(calc, stored), scheme != self.scheme
+
+    def stats(self):
+        return {'scheme': self.scheme, 'workers': self.workers, 'max_pending': self.max_pending,
+                'pending': self.pending, 'hashed': self.hashed, 'rehashed': self.rehashed, 'rejected': self.rejected}
+
+
+passwords = PasswordHasher(
+    algorithm=os.environ.get('PASSWORD_KDF', 'scrypt').strip().lower(),
+    scrypt_n=int(os.environ.get('SCRYPT_N', str(2 ** 14))),
+    scrypt_r=int(os.environ.get('SCRYPT_R', '8')),
+    scrypt_p=int(os.environ.get('SCRYPT_P', '1')),
+    pbkdf2_iterations=int(os.environ.get('PBKDF2_ITERATIONS', '600000')),
+    workers=int(os.environ.get('KDF_WORKERS', str(min(4, os.cpu_count() or 1)))),
+    # Logins past this get a 503 rather than tie up the workers left over from /api/events
+    max_pending=int(os.environ.get('KDF_MAX_PENDING', str(max(1, (SERVER_WORKERS - SSE_MAX_SUBSCRIBERS) // 4)))),
+)
+
+ALLOWED_ROLES = {'user', 'viewer', 'editor', 'admin'}
+
+def _migrate_base_schema(cur):
     cur.execute(
         '''CREATE TABLE IF NOT EXISTS expenses (
                id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -24,14 +1080,6 @@ def init_db():
                receipt_path TEXT
            )'''
     )
-    # Ensure receipt_path exists for legacy databases
-    try:
-        cur.execute('PRAGMA table_info(expenses)')
-        cols = [r[1] for r in cur.fetchall()]
-        if 'receipt_path' not in cols:
-            cur.execute('ALTER TABLE expenses ADD COLUMN receipt_path TEXT')
-    except Exception:
-        pass
     cur.execute(
         '''CREATE TABLE IF NOT EXISTS balances (
                month_key TEXT PRIMARY KEY,
@@ -69,14 +1117,6 @@ def init_db():
                created_at TEXT NOT NULL
            )'''
     )
-    # Ensure role column exists for legacy databases
-    try:
-        cur.execute('PRAGMA table_info(users)')
-        ucols = [r[1] for r in cur.fetchall()]
-        if 'role' not in ucols:
-            cur.execute('ALTER TABLE users ADD COLUMN role TEXT NOT NULL DEFAULT "user"')
-    except Exception:
-        pass
     cur.execute(
         '''CREATE TABLE IF NOT EXISTS sessions (
                token TEXT PRIMARY KEY,
@@ -86,14 +1126,125 @@ def init_db():
                FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE
            )'''
     )
+
+def _migrate_legacy_columns(cur):
+    # Databases created before user_version was tracked may predate these columns
+    cur.execute('PRAGMA table_info(expenses)')
+    if 'receipt_path' not in [r[1] for r in cur.fetchall()]:
+        cur.execute('ALTER TABLE expenses ADD COLUMN receipt_path TEXT')
+    cur.execute('PRAGMA table_info(users)')
+    if 'role' not in [r[1] for r in cur.fetchall()]:
+        cur.execute('ALTER TABLE users ADD COLUMN role TEXT NOT NULL DEFAULT "user"')
+
+def _migrate_indexes(cur):
+    # Month listing (WHERE month_key=? ORDER BY date DESC, id DESC) and daily totals
+    cur.execute('DROP INDEX IF EXISTS idx_expenses_month_date_amount')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_expenses_month_date_id ON expenses(month_key, date, id, amount)')
+    # Unfiltered history listing
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_expenses_date_id ON expenses(date, id)')
+    # Covering indexes for the /api/summary GROUP BY queries
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_expenses_month_category ON expenses(month_key, category, amount)')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_expenses_month_payer ON expenses(month_key, payer, amount)')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_expense_items_expense ON expense_items(expense_id)')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions(expires_at)')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions(user_id)')
+    cur.execute('ANALYZE')
+
+def _migrate_month_rollups(cur):
+    # One row per (month, dimension, key); see ROLLUP_SOURCES for the dimensions
+    cur.execute(
+        '''CREATE TABLE IF NOT EXISTS month_rollups (
+               month_key TEXT NOT NULL,
+               dimension TEXT NOT NULL,
+               key TEXT NOT NULL,
+               total REAL NOT NULL,
+               count INTEGER NOT NULL,
+               PRIMARY KEY (month_key, dimension, key)
+           ) WITHOUT ROWID'''
+    )
+    rebuild_rollups(cur)
+
+def _migrate_compact_sessions(cur):
+    # Cluster sessions on the token itself; a rowid table keeps a second b-tree just for the primary key
+    cur.execute(
+        '''CREATE TABLE sessions_new (
+               token TEXT PRIMARY KEY,
+               user_id INTEGER NOT NULL,
+               created_at TEXT NOT NULL,
+               expires_at TEXT NOT NULL,
+               FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE
+           ) WITHOUT ROWID'''
+    )
+    # Expired rows are not worth copying
+    cur.execute('INSERT INTO sessions_new SELECT token, user_id, created_at, expires_at FROM sessions '
+                'WHERE expires_at > datetime("now")')
+    cur.execute('DROP TABLE sessions')
+    cur.execute('ALTER TABLE sessions_new RENAME TO sessions')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions(expires_at)')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions(user_id)')
+
+def _migrate_expense_search(cur):
+    # Without FTS5 in this SQLite build, search falls back to LIKE scans (see search_expenses)
+    try:
+        cur.execute(
+            '''CREATE VIRTUAL TABLE expense_search USING fts5(
+                   description, category, payer, items,
+                   tokenize = 'unicode61 remove_diacritics 2',
+                   prefix = '2 3'
+               )'''
+        )
+    except sqlite3.OperationalError:
+        return
+    # rowid is the expense id; items holds the expense's item names separated by spaces.
+    # Write paths keep it current with index_expenses, as they do month_rollups; per-row
+    # triggers would flush FTS5's pending terms on every statement and make bulk imports ~6x slower
+    rebuild_search_index(cur)
+
+def _migrate_drop_summary_indexes(cur):
+    # /api/summary reads month_rollups now; only rebuild-rollups and check-rollups still group
+    # expenses by category or payer, and those full scans don't need two indexes kept on every write
+    cur.execute('DROP INDEX IF EXISTS idx_expenses_month_category')
+    cur.execute('DROP INDEX IF EXISTS idx_expenses_month_payer')
+
+# Schema history. PRAGMA user_version records how many of these have been
+# applied; append new steps, never edit or reorder existing ones.
+MIGRATIONS = [
+    _migrate_base_schema,
+    _migrate_legacy_columns,
+    _migrate_indexes,
+    _migrate_month_rollups,
+    _migrate_compact_sessions,
+    _migrate_expense_search,
+    _migrate_drop_summary_indexes,
+]
+
+def migrate(conn, target=None):
+    """Apply pending MIGRATIONS (up to ``target``), each in its own transaction."""
+    target = len(MIGRATIONS) if target is None else target
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    for step in range(version, target):
+        cur = conn.cursor()
+        cur.execute('BEGIN IMMEDIATE')
+        try:
+            MIGRATIONS[step](cur)
+            cur.execute(f'PRAGMA user_version={step + 1}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return max(version, target)
+
+def init_db():
+    conn = db.connect()
+    migrate(conn)
+    cur = conn.cursor()
     # Seed admin user if not exists
     try:
         cur.execute('SELECT id FROM users WHERE username=?', ('Weasley',))
         row = cur.fetchone()
         if not row:
-            admin_salt = secrets.token_hex(16)
             admin_pwd = '6FjVCVYLcpm3XAiJ81gQWd'
-            admin_hash = hashlib.sha256((admin_salt + admin_pwd).encode('utf-8')).hexdigest()
+            admin_hash, admin_salt = passwords.hash(admin_pwd)
             cur.execute('INSERT INTO users(username, password_hash, salt, role, created_at) VALUES(?,?,?,?,datetime("now"))',
                         ('Weasley', admin_hash, admin_salt, 'admin'))
     except Exception:
@@ -113,662 +1264,2458 @@ def dictify_expense(row):
         'receipt_path': row[7] if len(row) > 7 else None,
     }
 
-class Handler(BaseHTTPRequestHandler):
-    def _cors(self):
-        origin = self.headers.get('Origin')
-        if origin:
-            self.send_header('Access-Control-Allow-Origin', origin)
-            self.send_header('Access-Control-Allow-Credentials', 'true')
-        else:
-            self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, DELETE, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+# GET /api/expenses without ?month= is paged by default
+DEFAULT_PAGE_SIZE = 500
+MAX_PAGE_SIZE = 5000
+# Stay well below SQLITE_MAX_VARIABLE_NUMBER (999 on older builds)
+ITEMS_IN_BATCH = 500
 
-    def _set_cookie(self, name, value, max_age=None):
-        if max_age is None:
-            # Session cookie (expires when the browser closes)
-            self.send_header('Set-Cookie', f'{name}={value}; Path=/; HttpOnly; SameSite=Lax')
-        else:
-            self.send_header('Set-Cookie', f'{name}={value}; Path=/; Max-Age={max_age}; HttpOnly; SameSite=Lax')
+def encode_cursor(row):
+    """Opaque keyset cursor for the (date, id) of the last row on a page."""
+    return base64.urlsafe_b64encode(json.dumps([row[3], row[0]]).encode('utf-8')).decode('ascii')
 
-    def _clear_cookie(self, name):
-        self.send_header('Set-Cookie', f'{name}=; Path=/; Max-Age=0; HttpOnly; SameSite=Lax')
+def decode_cursor(value):
+    if not value:
+        return None
+    try:
+        date, eid = json.loads(base64.urlsafe_b64decode(value.encode('ascii')))
+        return str(date), int(eid)
+    except Exception:
+        raise ValueError('Invalid cursor')
 
-    def _get_session_user(self):
-        cookie = self.headers.get('Cookie') or ''
-        token = None
-        for part in cookie.split(';'):
-            kv = part.strip().split('=', 1)
-            if len(kv) == 2 and kv[0] == 'session':
-                token = kv[1]
-                break
-        if not token:
-            return None
-        conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
-        cur.execute('SELECT user_id FROM sessions WHERE token=? AND expires_at > datetime("now")', (token,))
-        row = cur.fetchone()
-        conn.close()
-        if not row:
-            return None
-        return row[0]
+def expense_page_query(month=None, after=None, limit=None):
+    """SQL for expenses newest first, optionally by month, after a cursor, limited."""
+    where, params = [], []
+    if month:
+        where.append('month_key=?')
+        params.append(month)
+    if after:
+        where.append('(date, id) < (?, ?)')
+        params.extend(after)
+    sql = 'SELECT * FROM expenses'
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    sql += ' ORDER BY date DESC, id DESC'
+    if limit:
+        sql += ' LIMIT ?'
+        params.append(limit)
+    return sql, params
 
-    def _send_json(self, payload, status=200):
-        self.send_response(status)
-        self._cors()
-        self.send_header('Content-Type', 'application/json')
-        self.end_headers()
-        self.wfile.write(json.dumps(payload).encode('utf-8'))
+def fetch_items(cur, expense_ids):
+    """Map expense id -> list of item dicts, querying in bounded IN (...) batches."""
+    items_map = {}
+    for i in range(0, len(expense_ids), ITEMS_IN_BATCH):
+        batch = expense_ids[i:i + ITEMS_IN_BATCH]
+        qmarks = ','.join('?' for _ in batch)
+        cur.execute(f'SELECT id, expense_id, name, amount FROM expense_items WHERE expense_id IN ({qmarks})', batch)
+        for iid, eid, name, amount in cur.fetchall():
+            items_map.setdefault(eid, []).append({'id': iid, 'name': name, 'amount': amount})
+    return items_map
+
+def expense_export_query(first=None, last=None):
+    """SQL for expenses dated ``first``..``last`` inclusive (either may be None), oldest first."""
+    where, params = [], []
+    if first:
+        where.append('date >= ?')
+        params.append(first)
+    if last:
+        where.append('date <= ?')
+        params.append(last)
+    sql = 'SELECT * FROM expenses'
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    return sql + ' ORDER BY date, id', params
+
+def iter_expenses(conn, month=None, after=None, limit=None, batch=ITEMS_IN_BATCH):
+    """Yield expense dicts with items, newest first, holding at most ``batch`` rows at a time."""
+    sql, params = expense_page_query(month, after, limit)
+    return iter_expense_rows(conn, sql, params, batch)
+
+def iter_expense_rows(conn, sql, params, batch=ITEMS_IN_BATCH):
+    """Yield the expenses ``sql`` selects as dicts with items, fetching ``batch`` rows at a time."""
+    cur = conn.cursor()
+    items_cur = conn.cursor()
+    try:
+        cur.execute(sql, params)
+        while True:
+            rows = cur.fetchmany(batch)
+            if not rows:
+                return
+            items_map = fetch_items(items_cur, [r[0] for r in rows])
+            for r in rows:
+                exp = dictify_expense(r)
+                exp['items'] = items_map.get(r[0], [])
+                yield exp
+    finally:
+        cur.close()
+        items_cur.close()
+
+def expense_page(cur, month=None, after=None, limit=None):
+    """One page of expenses with their items, as sent by GET /api/expenses."""
+    sql, params = expense_page_query(month, after, limit + 1 if limit else None)
+    cur.execute(sql, params)
+    rows = cur.fetchall()
+    next_cursor = None
+    if limit and len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1])
+    # Fetch items for these expenses
+    items_map = fetch_items(cur, [r[0] for r in rows])
+    expenses_payload = []
+    for r in rows:
+        exp = dictify_expense(r)
+        exp['items'] = items_map.get(exp['id'], [])
+        expenses_payload.append(exp)
+    return {'expenses': expenses_payload, 'next_cursor': next_cursor}
+
+MONTH_KEY_RE = re.compile(r'^\d{4}-(0[1-9]|1[0-2])$')
+
+# GET /api/export: format -> Content-Type. CSV has one row per expense, its items
+# packed into the last column as "name: amount; ...". Column names are the ones
+# POST /api/expenses/bulk reads, so an export can be imported again (without items)
+EXPORT_FORMATS = {'csv': 'text/csv; charset=utf-8', 'ndjson': 'application/x-ndjson'}
+EXPORT_CSV_COLUMNS = ('id', 'date', 'description', 'amount', 'category', 'payer', 'month_key', 'receipt_path')
+
+# GET /api/expenses/search
+SEARCH_PAGE_SIZE = 50
+# Column weights for bm25(), in expense_search column order: description, category, payer, items
+SEARCH_WEIGHTS = (10.0, 2.0, 1.0, 5.0)
+SEARCH_TOKEN_RE = re.compile(r'\w+')
+DATE_RE = re.compile(r'^\d{4}-(0[1-9]|1[0-2])-(0[1-9]|[12]\d|3[01])$')
+
+def search_terms(text):
+    """Word tokens of a search box string, lower-cased; punctuation and FTS operators are dropped."""
+    return [t.lower() for t in SEARCH_TOKEN_RE.findall(text or '')]
+
+def fts_query(terms):
+    """FTS5 MATCH expression requiring every term, the last one as a prefix (search-as-you-type)."""
+    quoted = [f'"{t}"' for t in terms]
+    quoted[-1] += '*'
+    return ' '.join(quoted)
+
+def encode_offset_cursor(offset):
+    return base64.urlsafe_b64encode(json.dumps({'offset': offset}).encode('utf-8')).decode('ascii')
+
+def decode_offset_cursor(value):
+    if not value:
+        return 0
+    try:
+        offset = int(json.loads(base64.urlsafe_b64decode(value.encode('ascii')))['offset'])
+    except Exception:
+        raise ValueError('Invalid cursor')
+    if offset < 0:
+        raise ValueError('Invalid cursor')
+    return offset
+
+def has_search_index(cur):
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='expense_search'")
+    return cur.fetchone() is not None
+
+def search_query(terms, month=None, first=None, last=None, limit=SEARCH_PAGE_SIZE, offset=0, fts=True):
+    """SQL for a page of expenses matching ``terms``, each row followed by its bm25 score (NULL for LIKE)."""
+    filters, filter_params = [], []
+    if month:
+        filters.append('e.month_key = ?')
+        filter_params.append(month)
+    if first:
+        filters.append('e.date >= ?')
+        filter_params.append(first)
+    if last:
+        filters.append('e.date <= ?')
+        filter_params.append(last)
+    bm25 = f'bm25(expense_search, {", ".join(map(str, SEARCH_WEIGHTS))})'
+    if fts and not filters:
+        # Rank and page inside the FTS table so only the page's rows are looked up in expenses
+        sql = (f'SELECT e.*, f.score FROM (SELECT rowid, {bm25} AS score FROM expense_search '
+               'WHERE expense_search MATCH ? ORDER BY score, rowid DESC LIMIT ? OFFSET ?) f '
+               'JOIN expenses e ON e.id = f.rowid ORDER BY f.score, e.id DESC')
+        return sql, [fts_query(terms), limit, offset]
+    if fts:
+        sql = f'SELECT e.*, {bm25} AS score FROM expense_search JOIN expenses e ON e.id = expense_search.rowid'
+        where, params = ['expense_search MATCH ?'], [fts_query(terms)]
+        order = 'score, e.id DESC'
+    else:
+        sql = 'SELECT e.*, NULL AS score FROM expenses e'
+        where, params = [], []
+        for term in terms:
+            pattern = f"%{term.replace('_', '!_')}%"
+            where.append("(e.description LIKE ? ESCAPE '!' OR e.category LIKE ? ESCAPE '!' "
+                         "OR e.payer LIKE ? ESCAPE '!' OR EXISTS (SELECT 1 FROM expense_items i "
+                         "WHERE i.expense_id = e.id AND i.name LIKE ? ESCAPE '!'))")
+            params.extend([pattern] * 4)
+        order = 'e.date DESC, e.id DESC'
+    sql += ' WHERE ' + ' AND '.join(where + filters) + f' ORDER BY {order} LIMIT ? OFFSET ?'
+    return sql, params + filter_params + [limit, offset]
+
+def search_expenses(cur, terms, month=None, first=None, last=None, limit=SEARCH_PAGE_SIZE, offset=0, fts=None):
+    """One page of expenses matching every search term, best match first.
+
+    Uses the expense_search FTS5 index when the database has one (``fts``
+    forces the choice) and otherwise falls back to LIKE scans ordered newest
+    first. ``first``/``last`` bound the date inclusively. Each expense gets a
+    ``score``, higher for better matches, or None from the LIKE fallback.
+    """
+    if fts is None:
+        fts = has_search_index(cur)
+    sql, params = search_query(terms, month, first, last, limit + 1, offset, fts)
+    cur.execute(sql, params)
+    rows = cur.fetchall()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_offset_cursor(offset + limit)
+    items_map = fetch_items(cur, [r[0] for r in rows])
+    expenses_payload = []
+    for r in rows:
+        exp = dictify_expense(r[:-1])
+        exp['items'] = items_map.get(exp['id'], [])
+        # bm25() is lower for better matches
+        exp['score'] = round(-r[-1], 4) if r[-1] is not None else None
+        expenses_payload.append(exp)
+    return {'expenses': expenses_payload, 'next_cursor': next_cursor}
+
+def validate_expense(data):
+    """Normalise one expense payload for insertion.
+
+    Returns ``(fields, items)`` where ``fields`` matches the column order
+    description, amount, date, category, payer, month_key and ``items`` is a
+    list of ``(name, amount)``. Raises ValueError with a client-facing message.
+    """
+    if not isinstance(data, dict):
+        raise ValueError('Expected an object')
+    desc = data.get('description')
+    amt = data.get('amount')
+    date = data.get('date')
+    cat = data.get('category')
+    payer = data.get('payer')
+    if not all([desc, amt is not None and amt != '', date, cat, payer]):
+        raise ValueError('Missing fields')
+    for field, value in (('description', desc), ('date', date), ('category', cat), ('payer', payer)):
+        if not isinstance(value, str):
+            raise ValueError(f'Invalid {field}')
+    if not DATE_RE.fullmatch(date):
+        raise ValueError('Invalid date, expected YYYY-MM-DD')
+    amount = parse_amount(amt)
+    if amount is None:
+        raise ValueError('Invalid amount')
+    month_key = f"{date[:7]}"
+    raw_items = data.get('items')
+    if raw_items is None:
+        raw_items = []
+    elif not isinstance(raw_items, list):
+        raise ValueError('items must be a list')
+    items = []
+    for it in raw_items:
+        name = it.get('name') if isinstance(it, dict) else None
+        iam = it.get('amount') if isinstance(it, dict) else None
+        if name and iam is not None:
+            if not isinstance(name, str):
+                raise ValueError('Invalid item name')
+            item_amount = parse_amount(iam)
+            if item_amount is None:
+                raise ValueError('Invalid item amount')
+            items.append((name, item_amount))
+    return (desc, amount, date, cat, payer, month_key), items
+
+def parse_amount(value):
+    """A finite float from a JSON number or numeric string, else None."""
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        return None
+    try:
+        amount = float(value)
+    except ValueError:
+        return None
+    return amount if math.isfinite(amount) else None
+
+class BodyReader(io.RawIOBase):
+    """Raw stream over exactly ``length`` bytes of a request body."""
+
+    def __init__(self, rfile, length):
+        self.rfile = rfile
+        self.remaining = length
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self.remaining <= 0:
+            return 0
+        data = self.rfile.read(min(len(b), self.remaining))
+        b[:len(data)] = data
+        self.remaining -= len(data)
+        return len(data)
+
+def iter_ndjson(stream):
+    """Yield one parsed value per non-blank line; bad lines yield the ValueError."""
+    for line in stream:
+        if line.strip():
+            try:
+                yield json.loads(line)
+            except ValueError as e:
+                yield ValueError(f'Invalid JSON: {e}')
+
+def iter_json_array(stream, chunk_size=64 * 1024):
+    """Yield the elements of a top-level JSON array without reading it all at once.
+
+    Raises ValueError for anything but one array: missing or doubled commas,
+    a trailing comma, or content after the closing bracket.
+    """
+    decoder = json.JSONDecoder()
+    # 'start': before '['; 'first': after '['; 'value': a value is due; 'sep': ',' or ']' is due; 'end': after ']'
+    buf, pos, eof, state = '', 0, False, 'start'
+    while True:
+        while pos < len(buf) and buf[pos] in ' \t\r\n':
+            pos += 1
+        if pos >= len(buf):
+            if eof:
+                if state == 'end':
+                    return
+                raise ValueError('Unexpected end of JSON array')
+            chunk = stream.read(chunk_size)
+            buf, pos, eof = buf[pos:] + chunk, 0, not chunk
+            continue
+        ch = buf[pos]
+        if state == 'end':
+            raise ValueError('Unexpected data after the JSON array')
+        if state == 'start':
+            if ch != '[':
+                raise ValueError('Expected a JSON array')
+            state = 'first'
+            pos += 1
+        elif ch == ']' and state in ('first', 'sep'):
+            state = 'end'
+            pos += 1
+        elif ch == ',' and state == 'sep':
+            state = 'value'
+            pos += 1
+        elif state == 'sep':
+            raise ValueError("Expected ',' or ']' in JSON array")
+        elif ch in ',]':
+            raise ValueError('Expected a value in JSON array')
+        else:
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError as e:
+                if eof:
+                    raise ValueError(f'Invalid JSON: {e}')
+                value, end = None, len(buf)
+            if end >= len(buf) and not eof:
+                # Value may be cut off at the buffer edge; read more and retry
+                chunk = stream.read(chunk_size)
+                buf, pos, eof = buf[pos:] + chunk, 0, not chunk
+                continue
+            pos = end
+            state = 'sep'
+            yield value
+
+RECEIPTS_DIR = 'receipts'
+RECEIPT_MAX_BYTES = int(os.environ.get('RECEIPT_MAX_BYTES', str(20 * 1024 * 1024)))
+RECEIPT_EXT_RE = re.compile(r'^\.[a-z0-9]{1,8}$')
+
+def iter_body_chunks(rfile, length, chunk_size=64 * 1024):
+    """Yield exactly ``length`` bytes from ``rfile`` in chunks; raises on a short body."""
+    remaining = length
+    while remaining > 0:
+        chunk = rfile.read(min(chunk_size, remaining))
+        if not chunk:
+            raise ValueError('Request body ended early')
+        remaining -= len(chunk)
+        yield chunk
+
+def receipt_extension(filename, content_type):
+    """File extension for a stored receipt, from the client filename or its Content-Type."""
+    ext = os.path.splitext(os.path.basename(filename or ''))[1].lower()
+    if RECEIPT_EXT_RE.match(ext):
+        return ext
+    ctype = (content_type or '').split(';', 1)[0].strip().lower()
+    ext = mimetypes.guess_extension(ctype) if ctype and ctype != 'application/octet-stream' else None
+    return ext if ext and RECEIPT_EXT_RE.match(ext) else ''
+
+def store_receipt(chunks, ext=''):
+    """Write ``chunks`` under RECEIPTS_DIR named by their SHA-256.
+
+    Data goes to a temporary file while it is hashed, so memory use is one
+    chunk regardless of file size. Identical content maps to the same file
+    and is stored once. Returns ``(name, sha256, size, already_existed)``.
+    """
+    os.makedirs(RECEIPTS_DIR, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=RECEIPTS_DIR, prefix='.upload-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                digest.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+        name = digest.hexdigest() + ext
+        final_path = os.path.join(RECEIPTS_DIR, name)
+        existed = os.path.exists(final_path)
+        if existed:
+            os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, final_path)
+        return name, digest.hexdigest(), size, existed
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+CONTENT_ADDRESSED_RE = re.compile(r'^[0-9a-f]{64}(\.[a-z0-9]{1,8})?$')
+# Previews of content-addressed receipts: <sha256>.<size>.jpg
+PREVIEW_NAME_RE = re.compile(r'^([0-9a-f]{64})\.([a-z]+)\.jpg$')
+# (path, size, mtime_ns) -> (etag, content type) for receipts not named by their hash
+_receipt_meta_cache = OrderedDict()
+_receipt_meta_lock = threading.Lock()
+
+def sniff_content_type(head, name):
+    """Content type from a file's leading bytes, falling back to its extension."""
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png'
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        return 'image/gif'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    if head.startswith(b'%PDF-'):
+        return 'application/pdf'
+    if head[4:8] == b'ftyp' and head[8:12] in (b'heic', b'heix', b'mif1', b'msf1'):
+        return 'image/heic'
+    if head[:2] == b'BM':
+        return 'image/bmp'
+    if head[:4] in (b'II*\x00', b'MM\x00*'):
+        return 'image/tiff'
+    return mimetypes.guess_type(name)[0] or 'application/octet-stream'
+
+def receipt_meta(fpath, f, st):
+    """Return ``(etag, content_type, immutable)`` for an open receipt file.
+
+    Content-addressed names already carry the hash used as the strong ETag.
+    Older files are hashed once and remembered until their size or mtime
+    changes.
+    """
+    name = os.path.basename(fpath)
+    head = os.pread(f.fileno(), 16, 0)
+    if CONTENT_ADDRESSED_RE.match(name):
+        return '"' + name[:64] + '"', sniff_content_type(head, name), True
+    preview = PREVIEW_NAME_RE.match(name)
+    if preview:
+        return f'"{preview.group(1)}.{preview.group(2)}"', 'image/jpeg', True
+    key = (fpath, st.st_size, st.st_mtime_ns)
+    with _receipt_meta_lock:
+        cached = _receipt_meta_cache.get(key)
+    if cached is None:
+        digest = hashlib.sha256()
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            digest.update(chunk)
+        cached = ('"' + digest.hexdigest() + '"', sniff_content_type(head, name))
+        with _receipt_meta_lock:
+            _receipt_meta_cache[key] = cached
+            while len(_receipt_meta_cache) > 1024:
+                _receipt_meta_cache.popitem(last=False)
+    return cached[0], cached[1], False
+
+def not_modified(headers, etag, mtime):
+    """True when the request's validators show the client's copy is current."""
+    if_none_match = headers.get('If-None-Match')
+    if if_none_match is not None:
+        tags = [t.strip() for t in if_none_match.split(',')]
+        return '*' in tags or etag in tags or ('W/' + etag) in tags
+    if_modified_since = headers.get('If-Modified-Since')
+    if if_modified_since:
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+def parse_range(header, size):
+    """Parse a single ``bytes=`` range into inclusive ``(start, end)``.
+
+    Returns None when the header should be ignored (malformed or multiple
+    ranges, which are served as a full 200) and 'unsatisfiable' for 416.
+    """
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+    first, sep, last = spec.strip().partition('-')
+    if not sep:
+        return None
+    try:
+        if first == '':
+            suffix = int(last)
+            if suffix <= 0:
+                return 'unsatisfiable'
+            return max(0, size - suffix), size - 1
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size:
+        return 'unsatisfiable'
+    if start > end:
+        return None
+    return start, min(end, size - 1)
+
+PREVIEW_SIZES = {'thumb': 200, 'preview': 800}
+PREVIEWABLE_TYPES = {'image/jpeg', 'image/png', 'image/gif', 'image/webp', 'image/bmp', 'image/tiff'}
+
+
+class PreviewCache:
+    """Reduced-size JPEG previews of receipts, built by one background thread.
+
+    Previews live in ``<receipts>/previews`` as ``<receipt stem>.<size>.jpg``.
+    Each access refreshes a file's atime, and once the directory grows past
+    ``max_bytes`` the least recently accessed previews are deleted. Without
+    Pillow nothing is generated and callers serve the original.
+    """
+
+    def __init__(self, receipts_dir, max_bytes, max_queue=256):
+        self.dir = os.path.join(receipts_dir, 'previews')
+        self.max_bytes = max_bytes
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        self.generated = 0
+        self.evicted = 0
+        self.failed = 0
+
+    @property
+    def enabled(self):
+        return Image is not None
+
+    def path_for(self, name, size):
+        return os.path.join(self.dir, f'{os.path.splitext(name)[0]}.{size}.jpg')
+
+    def can_preview(self, fpath):
+        if not self.enabled:
+            return False
+        with open(fpath, 'rb') as f:
+            return sniff_content_type(f.read(16), fpath) in PREVIEWABLE_TYPES
+
+    def touch(self, path):
+        # atime only: mtime stays stable so validators do not change
+        try:
+            os.utime(path, (time.time(), os.stat(path).st_mtime))
+        except OSError:
+            pass
+
+    def enqueue(self, name):
+        """Schedule every preview size for receipt ``name``; never blocks."""
+        if not self.enabled:
+            return
+        with self._lock:
+            if name in self._pending:
+                return
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='receipt-previews', daemon=True)
+                self._thread.start()
+            try:
+                self._queue.put_nowait(name)
+            except queue.Full:
+                # Dropped; the next ?size= request schedules it again
+                return
+            self._pending.add(name)
+
+    def _run(self):
+        while True:
+            name = self._queue.get()
+            try:
+                self._generate(name)
+                self._evict()
+            except Exception:
+                self.failed += 1
+            finally:
+                with self._lock:
+                    self._pending.discard(name)
+
+    def _generate(self, name):
+        src = os.path.join(RECEIPTS_DIR, name)
+        if not os.path.isfile(src) or not self.can_preview(src):
+            return
+        os.makedirs(self.dir, exist_ok=True)
+        with Image.open(src) as original:
+            original = ImageOps.exif_transpose(original)
+            for size, px in PREVIEW_SIZES.items():
+                dest = self.path_for(name, size)
+                if os.path.exists(dest):
+                    continue
+                im = original.copy()
+                im.thumbnail((px, px))
+                if im.mode not in ('RGB', 'L'):
+                    im = im.convert('RGB')
+                fd, tmp_path = tempfile.mkstemp(dir=self.dir, prefix='.preview-')
+                with os.fdopen(fd, 'wb') as f:
+                    im.save(f, 'JPEG', quality=80, optimize=True)
+                os.replace(tmp_path, dest)
+                self.generated += 1
+
+    def _evict(self):
+        entries = []
+        total = 0
+        with os.scandir(self.dir) as it:
+            for entry in it:
+                if entry.is_file() and not entry.name.startswith('.'):
+                    st = entry.stat()
+                    entries.append((st.st_atime, st.st_size, entry.path))
+                    total += st.st_size
+        if total <= self.max_bytes:
+            return
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+                self.evicted += 1
+            except OSError:
+                pass
+
+    def stats(self):
+        return {'enabled': self.enabled, 'pending': len(self._pending), 'generated': self.generated,
+                'evicted': self.evicted, 'failed': self.failed, 'max_bytes': self.max_bytes}
+
+
+previews = PreviewCache(RECEIPTS_DIR, int(os.environ.get('PREVIEW_CACHE_MAX_BYTES', str(256 * 1024 * 1024))))
+
+BULK_BATCH_SIZE = 1000
+BULK_CONTENT_TYPES = ('text/csv', 'application/csv', 'application/x-ndjson', 'application/jsonl',
+                      'application/ndjson', 'application/json', '')
+# Uploads up to this size are buffered in memory before they are parsed; larger ones go to a temp file
+BULK_SPOOL_MEMORY = 1024 * 1024
+# Cap on per-row errors echoed back; the failed count is always exact
+BULK_MAX_ERRORS = 100
+
+def bulk_records(body, ctype):
+    """Iterate the records of a bulk upload; a malformed document raises ValueError part way."""
+    if ctype in ('text/csv', 'application/csv'):
+        records = csv.DictReader(body)
+        if records.fieldnames:
+            # Headers match the way the client checks them: any case, surrounding spaces ignored
+            records.fieldnames = [f.strip().lower() for f in records.fieldnames]
+        # A CSV items column (as /api/export writes it) is text, not item objects; it is not imported
+        return (dict(r, items=None) for r in records)
+    if ctype in ('application/x-ndjson', 'application/jsonl', 'application/ndjson'):
+        return iter_ndjson(body)
+    return iter_json_array(body)
+
+def bulk_insert_expenses(cur, rows):
+    """Insert validated ``(fields, items)`` rows with executemany; run it as a writer op.
+
+    Expense ids are assigned up front, which is safe because only the writer
+    inserts, so items can be batched alongside their expenses. Returns the
+    number of expenses inserted.
+    """
+    cur.execute("SELECT MAX(COALESCE((SELECT seq FROM sqlite_sequence WHERE name='expenses'), 0), "
+                "COALESCE((SELECT MAX(id) FROM expenses), 0))")
+    first_id = cur.fetchone()[0] + 1
+    expense_rows = [(expense_id,) + fields for expense_id, (fields, _) in enumerate(rows, start=first_id)]
+    cur.executemany('INSERT INTO expenses(id, description, amount, date, category, payer, month_key) '
+                    'VALUES(?,?,?,?,?,?,?)', expense_rows)
+    cur.executemany('INSERT INTO expense_items(expense_id, name, amount) VALUES(?,?,?)',
+                    [(expense_id, name, amount)
+                     for expense_id, (_, items) in enumerate(rows, start=first_id) for name, amount in items])
+    apply_rollup_deltas(cur, rollup_deltas(row[2:] for row in expense_rows))
+    if rows:
+        index_expenses(cur, first_id, first_id + len(rows) - 1)
+    return len(rows)
+
+def import_expenses(records):
+    """Validate ``records`` on this thread and insert the good ones through the writer.
+
+    Rows go to the writer BULK_BATCH_SIZE at a time, so other writes are not
+    held up behind a large import. Each chunk commits on its own: callers
+    check that the whole document parses first, so a malformed one inserts
+    nothing. Invalid rows are skipped and reported.
+    """
+    started = time.perf_counter()
+    inserted, failed, errors, rows = 0, 0, [], []
+    try:
+        for rownum, record in enumerate(records, start=1):
+            try:
+                if isinstance(record, ValueError):
+                    raise record
+                rows.append(validate_expense(record))
+            except ValueError as e:
+                failed += 1
+                if len(errors) < BULK_MAX_ERRORS:
+                    errors.append({'row': rownum, 'error': str(e)})
+                continue
+            if len(rows) >= BULK_BATCH_SIZE:
+                inserted += writer.submit(bulk_insert_expenses, rows)
+                rows = []
+        if rows:
+            inserted += writer.submit(bulk_insert_expenses, rows)
+    finally:
+        if inserted:
+            data_versions.bump('expenses')
+            # Rows may span any months, so subscribers reload what they show
+            events.publish('expense', 'imported')
+    elapsed = time.perf_counter() - started
+    return {
+        'inserted': inserted,
+        'failed': failed,
+        'errors': errors,
+        'seconds': round(elapsed, 3),
+        'rows_per_sec': round(inserted / elapsed, 1) if elapsed > 0 else None,
+    }
+
+# Aggregates of expenses per month, as (dimension, key expression); 'total' has the empty key
+ROLLUP_SOURCES = (
+    ('total', "''"),
+    ('category', "COALESCE(category, '')"),
+    ('payer', "COALESCE(payer, '')"),
+    ('date', "COALESCE(date, '')"),
+)
+ROLLUP_SOURCE_SQL = ' UNION ALL '.join(
+    f"SELECT month_key, '{dimension}', {key}, SUM(amount), COUNT(*) FROM expenses "
+    f"WHERE month_key IS NOT NULL GROUP BY month_key, {key}"
+    for dimension, key in ROLLUP_SOURCES
+)
+
+def rollup_deltas(rows, sign=1, deltas=None):
+    """Accumulate ``sign`` times each expense into ``{(month, dimension, key): [total, count]}``.
+
+    ``rows`` are ``(amount, date, category, payer, month_key)``, the tail of
+    both an expenses row and validate_expense's fields.
+    """
+    if deltas is None:
+        deltas = {}
+    for amount, date, category, payer, mk in rows:
+        for key in ((mk, 'total', ''), (mk, 'category', category or ''),
+                    (mk, 'payer', payer or ''), (mk, 'date', date or '')):
+            delta = deltas.get(key)
+            if delta is None:
+                deltas[key] = [sign * amount, sign]
+            else:
+                delta[0] += sign * amount
+                delta[1] += sign
+    return deltas
+
+def apply_rollup_deltas(cur, deltas):
+    """Fold ``deltas`` into month_rollups; call inside the transaction that changed the expenses."""
+    cur.executemany(
+        'INSERT INTO month_rollups(month_key, dimension, key, total, count) VALUES(?,?,?,?,?) '
+        'ON CONFLICT(month_key, dimension, key) DO UPDATE SET '
+        'total = total + excluded.total, count = count + excluded.count',
+        [(mk, dim, key, total, count) for (mk, dim, key), (total, count) in deltas.items()])
+    # Groups that just lost their last expense
+    cur.executemany('DELETE FROM month_rollups WHERE month_key=? AND dimension=? AND key=? AND count <= 0',
+                    [key for key, (_, count) in deltas.items() if count < 0])
+
+def rebuild_rollups(cur):
+    """Recompute month_rollups from the expenses table; returns the number of rows written."""
+    cur.execute('DELETE FROM month_rollups')
+    cur.execute('INSERT INTO month_rollups(month_key, dimension, key, total, count) ' + ROLLUP_SOURCE_SQL)
+    return cur.rowcount
+
+def check_rollups(cur, tolerance=0.005):
+    """Compare month_rollups with a fresh aggregate of expenses; returns a list of mismatches."""
+    cur.execute(ROLLUP_SOURCE_SQL)
+    expected = {(mk, dim, key): (total, count) for mk, dim, key, total, count in cur.fetchall()}
+    cur.execute('SELECT month_key, dimension, key, total, count FROM month_rollups')
+    actual = {(mk, dim, key): (total, count) for mk, dim, key, total, count in cur.fetchall()}
+    problems = []
+    for group in sorted(expected.keys() | actual.keys()):
+        want = expected.get(group, (0, 0))
+        got = actual.get(group, (0, 0))
+        if want[1] != got[1] or abs(want[0] - got[0]) > tolerance:
+            mk, dim, key = group
+            problems.append({'month_key': mk, 'dimension': dim, 'key': key,
+                             'expected': {'total': want[0], 'count': want[1]},
+                             'actual': {'total': got[0], 'count': got[1]}})
+    return problems
+
+# expense_search rows for the expenses with ids in [?, ?], items joined by spaces
+SEARCH_INDEX_SQL = '''INSERT INTO expense_search(rowid, description, category, payer, items)
+    SELECT e.id, e.description, e.category, e.payer,
+           COALESCE((SELECT group_concat(name, ' ') FROM expense_items WHERE expense_id = e.id), '')
+    FROM expenses e WHERE e.id BETWEEN ? AND ?'''
+
+def index_expenses(cur, first, last=None):
+    """Bring expense_search up to date for expense ids ``first``..``last``; call inside the writing transaction.
+
+    Entries of deleted expenses in the range are dropped, so this covers
+    inserts, edits (items included) and deletes. Does nothing when the
+    database has no search index.
+    """
+    if last is None:
+        last = first
+    if not has_search_index(cur):
+        return
+    cur.execute('DELETE FROM expense_search WHERE rowid BETWEEN ? AND ?', (first, last))
+    cur.execute(SEARCH_INDEX_SQL, (first, last))
+
+def rebuild_search_index(cur):
+    """Refill expense_search from expenses and their items; returns the number of expenses indexed."""
+    cur.execute('DELETE FROM expense_search')
+    cur.execute(
+        '''INSERT INTO expense_search(rowid, description, category, payer, items)
+           SELECT e.id, e.description, e.category, e.payer, COALESCE(i.names, '')
+           FROM expenses e
+           LEFT JOIN (SELECT expense_id, group_concat(name, ' ') AS names
+                      FROM expense_items GROUP BY expense_id) i ON i.expense_id = e.id'''
+    )
+    indexed = cur.rowcount
+    cur.execute("INSERT INTO expense_search(expense_search) VALUES('optimize')")
+    return indexed
+
+
+def monthly_summary(cur, first, last):
+    """Totals for month keys ``first``..``last`` (inclusive), read from month_rollups.
+
+    Each month costs one row per category, payer and day, however many
+    expenses it holds. Sums are rounded to cents since the rollups are
+    maintained incrementally in floating point.
+    """
+    months = {}
+    cur.execute('SELECT month_key, dimension, key, total, count FROM month_rollups '
+                'WHERE month_key BETWEEN ? AND ? ORDER BY month_key, dimension, key', (first, last))
+    for mk, dimension, key, total, count in cur.fetchall():
+        m = months.get(mk)
+        if m is None:
+            m = months[mk] = {'total': 0, 'count': 0, 'by_category': {}, 'by_payer': {}, 'daily': []}
+        total = round(total, 2)
+        if dimension == 'total':
+            m['total'] = total
+            m['count'] = count
+        elif dimension == 'category':
+            m['by_category'][key] = total
+        elif dimension == 'payer':
+            m['by_payer'][key] = total
+        elif dimension == 'date':
+            m['daily'].append({'date': key, 'total': total, 'count': count})
+    return {
+        'from': first,
+        'to': last,
+        'total': round(sum(m['total'] for m in months.values()), 2),
+        'count': sum(m['count'] for m in months.values()),
+        'months': months,
+    }
+
+# JSON bodies below this size are not worth compressing
+COMPRESS_MIN_BYTES = int(os.environ.get('COMPRESS_MIN_BYTES', '1024'))
+COMPRESS_LEVEL = int(os.environ.get('COMPRESS_LEVEL', '6'))
+RESPONSE_ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+# Streams are compressed incrementally, which only the zlib codec does here
+STREAM_ENCODINGS = ('gzip',)
+# Unread request bodies up to this size are discarded so the connection can be reused
+DRAIN_MAX_BYTES = 64 * 1024
+
+def accepted_encoding(header, codings=RESPONSE_ENCODINGS):
+    """First of ``codings`` the Accept-Encoding header allows, or None."""
+    if not header:
+        return None
+    offered = {}
+    for part in header.split(','):
+        coding, _, params = part.partition(';')
+        q = 1.0
+        params = params.strip().lower()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        offered[coding.strip().lower()] = q
+    default = offered.get('*', 0.0)
+    for coding in codings:
+        if offered.get(coding, default) > 0:
+            return coding
+    return None
+
+# 'orjson' (the default when it is installed) or 'json'
+JSON_BACKEND = os.environ.get('JSON_BACKEND', 'orjson' if orjson is not None else 'json').strip().lower()
+if JSON_BACKEND not in ('orjson', 'json'):
+    raise ValueError(f'Unknown JSON_BACKEND: {JSON_BACKEND}')
+if JSON_BACKEND == 'orjson' and orjson is None:
+    print('JSON_BACKEND=orjson but orjson is not installed; using the json module')
+    JSON_BACKEND = 'json'
+_json_encoder = json.JSONEncoder(separators=(',', ':'))
+
+def json_bytes(payload):
+    """Encode a response payload straight to compact UTF-8 JSON bytes."""
+    if JSON_BACKEND == 'orjson':
+        # Non-string keys are stringified the way json.dumps does it
+        return orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS)
+    return _json_encoder.encode(payload).encode('utf-8')
+
+def compress_body(data, coding):
+    if coding == 'br':
+        return brotli.compress(data, quality=min(COMPRESS_LEVEL, 11))
+    return gzip.compress(data, compresslevel=COMPRESS_LEVEL, mtime=0)
+
+# Front-end files served by the API process itself, relative to STATIC_ROOT; SERVE_STATIC=0 turns it off
+SERVE_STATIC = os.environ.get('SERVE_STATIC', '1') != '0'
+STATIC_EXTENSIONS = frozenset({'.html', '.js', '.css', '.jpg', '.jpeg', '.png', '.gif', '.webp', '.svg', '.ico',
+                               '.woff', '.woff2'})
+STATIC_DIRS = ('assets',)
+STATIC_COMPRESSIBLE = frozenset({'.html', '.js', '.css', '.svg'})
+# Fingerprinted URLs (?v=<hash>) change whenever the file does, so they may be cached for a year
+STATIC_IMMUTABLE = 'public, max-age=31536000, immutable'
+STATIC_REVALIDATE = 'public, no-cache'
+# Relative src/href attributes in the served HTML, rewritten to fingerprinted URLs
+STATIC_REF_RE = re.compile(r'''((?:src|href)=["'])([^"'?#:]+)(["'])''')
+# Pages served from here talk to this same origin rather than the separately hosted API
+STATIC_SAME_ORIGIN = b'<script>window.API_BASE_URL = window.location.origin;</script>'
+
+
+class StaticAsset:
+    __slots__ = ('path', 'content_type', 'body', 'digest', 'etag', 'encoded')
+
+    def __init__(self, path, content_type, body):
+        self.path = path
+        self.content_type = content_type
+        self.body = body
+        self.digest = hashlib.sha256(body).hexdigest()[:16]
+        # Weak, since the gzip and identity responses share it
+        self.etag = f'W/"{self.digest}"'
+        # Precompressed variants, only those smaller than the original
+        self.encoded = {}
+
+
+class StaticAssets:
+    """The front-end files, read, fingerprinted and precompressed once at startup.
+
+    Every asset gets a content-hash ETag. HTML pages are rewritten so their
+    references to other assets carry ``?v=<hash>``; those URLs are served
+    with a year-long immutable Cache-Control while the pages themselves are
+    revalidated on each load, which the ETag answers with a 304. Files are
+    not watched: restart the server to pick up changes.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._assets = {}
+
+    def load(self):
+        """Read every asset under ``root``; returns the URL paths to register."""
+        files = [name for name in sorted(os.listdir(self.root)) if os.path.isfile(os.path.join(self.root, name))]
+        for directory in STATIC_DIRS:
+            for dirpath, _, names in os.walk(os.path.join(self.root, directory)):
+                rel = os.path.relpath(dirpath, self.root)
+                files.extend(os.path.join(rel, name).replace(os.sep, '/') for name in sorted(names))
+        files = [f for f in files if os.path.splitext(f)[1].lower() in STATIC_EXTENSIONS]
+        # Pages last, so the fingerprints they embed are already known
+        files.sort(key=lambda f: f.endswith('.html'))
+        for rel in files:
+            with open(os.path.join(self.root, rel), 'rb') as f:
+                body = f.read()
+            ext = os.path.splitext(rel)[1].lower()
+            if ext == '.html':
+                body = self._rewrite_page(rel, body)
+            ctype = mimetypes.guess_type(rel)[0] or 'application/octet-stream'
+            if ctype.startswith('text/') or ctype == 'application/javascript':
+                ctype += '; charset=utf-8'
+            asset = StaticAsset('/' + rel, ctype, body)
+            if ext in STATIC_COMPRESSIBLE and len(body) >= COMPRESS_MIN_BYTES:
+                for coding in RESPONSE_ENCODINGS:
+                    compressed = (brotli.compress(body, quality=11) if coding == 'br'
+                                  else gzip.compress(body, compresslevel=9, mtime=0))
+                    if len(compressed) < len(body):
+                        asset.encoded[coding] = compressed
+            self._assets[asset.path] = asset
+        if '/index.html' in self._assets:
+            self._assets['/'] = self._assets['/index.html']
+        return list(self._assets)
+
+    def _rewrite_page(self, rel, html):
+        base = os.path.dirname(rel)
+
+        def fingerprint(m):
+            target = os.path.normpath(os.path.join(base, m.group(2))).replace(os.sep, '/')
+            asset = self._assets.get('/' + target)
+            if asset is None or target.endswith('.html'):
+                return m.group(0)
+            return f'{m.group(1)}{m.group(2)}?v={asset.digest}{m.group(3)}'
+
+        html = STATIC_REF_RE.sub(fingerprint, html.decode('utf-8'))
+        return html.encode('utf-8').replace(b'<head>', b'<head>\n    ' + STATIC_SAME_ORIGIN, 1)
+
+    def get(self, path):
+        return self._assets.get(path)
+
+static_assets = StaticAssets(os.environ.get('STATIC_ROOT') or os.path.dirname(os.path.abspath(__file__)))
+
+
+# Upper bounds, in seconds, of the request latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Label for requests that matched no route, so probing random paths cannot grow the table
+UNMATCHED_ROUTE = '(unmatched)'
+
+
+def prometheus_histogram(lines, name, labels, bounds, buckets, total, count):
+    """Append a Prometheus histogram from per-bucket counts (the last one is +Inf) to ``lines``."""
+    prefix = labels + ',' if labels else ''
+    running = 0
+    for bound, n in zip([repr(b) for b in bounds] + ['+Inf'], buckets):
+        running += n
+        lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {running}')
+    suffix = f'{{{labels}}}' if labels else ''
+    lines.append(f'{name}_sum{suffix} {total:.6f}' if isinstance(total, float) else f'{name}_sum{suffix} {total}')
+    lines.append(f'{name}_count{suffix} {count}')
+
+
+class _RouteMetrics:
+    __slots__ = ('count', 'statuses', 'buckets', 'seconds', 'db_queries', 'db_seconds')
+
+    def __init__(self, buckets):
+        self.count = 0
+        self.statuses = {}
+        # Per-bucket counts, made cumulative when exported; the last one is +Inf
+        self.buckets = [0] * (buckets + 1)
+        self.seconds = 0.0
+        self.db_queries = 0
+        self.db_seconds = 0.0
+
+
+class Metrics:
+    """Request counters and latency histograms per route, plus SQLite time spent serving them.
+
+    Recording a request costs one bisect and one lock acquisition; all
+    formatting is deferred to the export methods.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.started = time.time()
+        self.in_flight = 0
+        self._routes = {}
+        self._lock = threading.Lock()
+
+    def begin(self):
+        with self._lock:
+            self.in_flight += 1
+
+    def observe(self, method, route, status, seconds, db_queries, db_seconds):
+        slot = bisect.bisect_left(self.buckets, seconds)
+        key = (method, route)
+        with self._lock:
+            self.in_flight -= 1
+            entry = self._routes.get(key)
+            if entry is None:
+                entry = self._routes[key] = _RouteMetrics(len(self.buckets))
+            entry.count += 1
+            entry.statuses[status] = entry.statuses.get(status, 0) + 1
+            entry.buckets[slot] += 1
+            entry.seconds += seconds
+            entry.db_queries += db_queries
+            entry.db_seconds += db_seconds
+
+    def _snapshot(self):
+        with self._lock:
+            rows = [(method, route, e.count, dict(e.statuses), list(e.buckets), e.seconds, e.db_queries, e.db_seconds)
+                    for (method, route), e in self._routes.items()]
+            return self.in_flight, sorted(rows)
+
+    def as_json(self):
+        in_flight, rows = self._snapshot()
+        routes = []
+        for method, route, count, statuses, buckets, seconds, db_queries, db_seconds in rows:
+            cumulative, running = [], 0
+            for n in buckets:
+                running += n
+                cumulative.append(running)
+            routes.append({
+                'method': method, 'route': route, 'count': count,
+                'statuses': {str(status): n for status, n in sorted(statuses.items())},
+                'latency': {'sum_seconds': round(seconds, 6), 'buckets': cumulative},
+                'db': {'queries': db_queries, 'seconds': round(db_seconds, 6),
+                       'queries_per_request': round(db_queries / count, 2),
+                       'ms_per_request': round(db_seconds / count * 1000, 3)},
+            })
+        return {'uptime_seconds': round(time.time() - self.started, 1), 'in_flight': in_flight,
+                'buckets': list(self.buckets) + ['+Inf'], 'routes': routes}
+
+    def as_prometheus(self):
+        """Prometheus text exposition format (version 0.0.4)."""
+        in_flight, rows = self._snapshot()
+        lines = [
+            '# HELP process_start_time_seconds Start time of the process since the Unix epoch.',
+            '# TYPE process_start_time_seconds gauge',
+            f'process_start_time_seconds {self.started:.3f}',
+            '# HELP http_requests_in_flight Requests currently being handled.',
+            '# TYPE http_requests_in_flight gauge',
+            f'http_requests_in_flight {in_flight}',
+            '# HELP http_requests_total Requests handled, by route and response status.',
+            '# TYPE http_requests_total counter',
+        ]
+        for method, route, _, statuses, _, _, _, _ in rows:
+            for status, n in sorted(statuses.items()):
+                lines.append(f'http_requests_total{{method="{method}",route="{route}",status="{status}"}} {n}')
+        lines += ['# HELP http_request_duration_seconds Time from reading the request line to the last byte of the response.',
+                  '# TYPE http_request_duration_seconds histogram']
+        for method, route, count, _, buckets, seconds, _, _ in rows:
+            prometheus_histogram(lines, 'http_request_duration_seconds', f'method="{method}",route="{route}"',
+                                 self.buckets, buckets, seconds, count)
+        lines += ['# HELP sqlite_queries_total SQLite statements executed while handling requests.',
+                  '# TYPE sqlite_queries_total counter']
+        for method, route, _, _, _, _, db_queries, _ in rows:
+            lines.append(f'sqlite_queries_total{{method="{method}",route="{route}"}} {db_queries}')
+        lines += ['# HELP sqlite_query_seconds_total Time spent in SQLite executes, fetches and commits while handling requests.',
+                  '# TYPE sqlite_query_seconds_total counter']
+        for method, route, _, _, _, _, _, db_seconds in rows:
+            lines.append(f'sqlite_query_seconds_total{{method="{method}",route="{route}"}} {db_seconds:.6f}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+# Role sets used by route declarations
+EDITOR_ROLES = ('editor', 'admin')
+ADMIN_ROLES = ('admin',)
+
+
+class Route:
+    """One registered endpoint and the checks the dispatcher runs before calling it."""
+
+    __slots__ = ('method', 'pattern', 'handler', 'roles', 'auth', 'json_body')
+
+    def __init__(self, method, pattern, handler, roles=None, auth=True, json_body=False):
+        self.method = method
+        self.pattern = pattern
+        self.handler = handler
+        # None means any signed-in user
+        self.roles = frozenset(roles) if roles else None
+        self.auth = auth
+        self.json_body = json_body
+
+
+def _int_segment(segment):
+    # int() alone would also take "+5", " 5" and non-ASCII digits
+    if not (segment.isascii() and segment.isdigit()):
+        raise ValueError(segment)
+    return int(segment)
+
+
+def _str_segment(segment):
+    if not segment:
+        raise ValueError(segment)
+    return unquote(segment)
+
+
+class _RouteNode:
+    __slots__ = ('children', 'param', 'route')
+
+    def __init__(self):
+        self.children = {}
+        # (name, converter, child node) for a {placeholder} segment
+        self.param = None
+        self.route = None
+
+
+class Router:
+    """Method + path lookup for Handler.
+
+    Literal paths live in a dict keyed by (method, path). Paths with
+    ``{name}`` or ``{name:int}`` segments go into a per-method segment tree,
+    so matching costs one split plus a dict step per segment however many
+    routes are registered. Literal segments win over placeholders and there
+    is no backtracking.
+    """
+
+    PARAM_RE = re.compile(r'^\{(\w+)(?::(int|str))?\}$')
+    CONVERTERS = {'int': _int_segment, 'str': _str_segment}
+
+    def __init__(self):
+        self._exact = {}
+        self._trees = {}
+
+    def route(self, method, pattern, roles=None, auth=True, json_body=False):
+        def register(handler):
+            self.add(Route(method, pattern, handler, roles, auth, json_body))
+            return handler
+        return register
+
+    def add(self, route):
+        if '{' not in route.pattern:
+            self._exact[(route.method, route.pattern)] = route
+            return
+        node = self._trees.setdefault(route.method, _RouteNode())
+        for segment in route.pattern.split('/'):
+            m = self.PARAM_RE.match(segment)
+            if m is None:
+                node = node.children.setdefault(segment, _RouteNode())
+                continue
+            name, convert = m.group(1), self.CONVERTERS[m.group(2) or 'str']
+            if node.param is None:
+                node.param = (name, convert, _RouteNode())
+            elif node.param[:2] != (name, convert):
+                raise ValueError(f'Conflicting placeholder in {route.pattern}')
+            node = node.param[2]
+        if node.route is not None:
+            raise ValueError(f'Duplicate route {route.method} {route.pattern}')
+        node.route = route
+
+    def match(self, method, path):
+        """Return ``(route, params)`` or None."""
+        route = self._exact.get((method, path))
+        if route is not None:
+            return route, {}
+        node = self._trees.get(method)
+        if node is None:
+            return None
+        params = {}
+        for segment in path.split('/'):
+            child = node.children.get(segment)
+            if child is None:
+                if node.param is None:
+                    return None
+                name, convert, child = node.param
+                try:
+                    params[name] = convert(segment)
+                except ValueError:
+                    return None
+            node = child
+        if node.route is None:
+            return None
+        return node.route, params
+
+    def routes(self):
+        yield from self._exact.values()
+        stack = list(self._trees.values())
+        while stack:
+            node = stack.pop()
+            if node.route is not None:
+                yield node.route
+            stack.extend(node.children.values())
+            if node.param is not None:
+                stack.append(node.param[2])
+
+
+router = Router()
+
+
+class Handler(BaseHTTPRequestHandler):
+    # Persistent connections; every response carries Content-Length or chunked framing
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes; don't let Nagle hold the second one back
+    disable_nagle_algorithm = True
+    # Drop clients that stall mid-request instead of holding a worker forever
+    timeout = float(os.environ.get('SERVER_REQUEST_TIMEOUT', '30'))
+
+    def _cors(self):
+        origin = self.headers.get('Origin')
+        if origin:
+            self.send_header('Access-Control-Allow-Origin', origin)
+            self.send_header('Access-Control-Allow-Credentials', 'true')
+        else:
+            self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Access-Control-Allow-Methods', 'GET, POST, DELETE, OPTIONS')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+
+    def _cookie(self, name, value, max_age=None):
+        """Set-Cookie header value; without ``max_age`` the cookie ends with the browser session."""
+        if max_age is None:
+            return f'{name}={value}; Path=/; HttpOnly; SameSite=Lax'
+        return f'{name}={value}; Path=/; Max-Age={max_age}; HttpOnly; SameSite=Lax'
+
+    def _session_token(self):
+        cookie = self.headers.get('Cookie') or ''
+        for part in cookie.split(';'):
+            kv = part.strip().split('=', 1)
+            if len(kv) == 2 and kv[0] == 'session':
+                return kv[1]
+        return None
+
+    def _get_session(self):
+        """Resolve the request's session once, from the cache when possible."""
+        if hasattr(self, '_session'):
+            return self._session
+        token = self._session_token()
+        session = None
+        if token and SESSION_MODE == 'signed':
+            session = signed_sessions.verify(token)
+        elif token:
+            session = session_cache.get(token)
+            if session is None:
+                conn = db.get()
+                cur = conn.cursor()
+                cur.execute(
+                    '''SELECT s.user_id, u.username, u.role, s.expires_at
+                       FROM sessions s JOIN users u ON u.id = s.user_id
+                       WHERE s.token=? AND s.expires_at > datetime("now")''',
+                    (token,))
+                row = cur.fetchone()
+                if row:
+                    session = session_cache.put(token, row[0], row[1], row[2], row[3])
+        self._session = session
+        return session
+
+    def send_response(self, code, message=None):
+        self._status = code
+        super().send_response(code, message)
+
+    def send_header(self, keyword, value):
+        if keyword.lower() == 'connection':
+            self._connection_header = True
+        super().send_header(keyword, value)
+
+    def end_headers(self):
+        body_stream = self.__dict__.get('body_stream')
+        if (not self._keepalive or not self.server.keep_connections()
+                or (body_stream is not None and body_stream.remaining > DRAIN_MAX_BYTES)):
+            # Too much unread body to drain (see _discard_body), or the worker is wanted elsewhere,
+            # so say up front that we will close
+            self.close_connection = True
+        if not getattr(self, '_connection_header', False):
+            if self.close_connection:
+                self.send_header('Connection', 'close')
+            elif self.request_version == 'HTTP/1.0':
+                self.send_header('Connection', 'keep-alive')
+        self._connection_header = False
+        super().end_headers()
+
+    def _send_json(self, payload, status=200, headers=()):
+        self._send_body(json_bytes(payload), 'application/json', status, headers)
+
+    def _send_body(self, body, content_type, status=200, headers=(), encoded=None):
+        """Send a complete body with Content-Length, compressed when large and the client allows it.
+
+        ``encoded`` is an optional dict that memoizes compressed variants of ``body``.
+        """
+        compressible = len(body) >= COMPRESS_MIN_BYTES
+        coding = accepted_encoding(self.headers.get('Accept-Encoding')) if compressible else None
+        if coding:
+            compressed = encoded.get(coding) if encoded is not None else None
+            if compressed is None:
+                compressed = compress_body(body, coding)
+                if encoded is not None:
+                    encoded[coding] = compressed
+            body = compressed
+        self.send_response(status)
+        self._cors()
+        self.send_header('Content-Type', content_type)
+        if compressible:
+            self.send_header('Vary', 'Accept-Encoding')
+        if coding:
+            self.send_header('Content-Encoding', coding)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_cached_json(self, version, build):
+        """Send ``build()`` as JSON, reusing the serialized body while ``version`` is unchanged.
+
+        ``version`` must be read before ``build`` queries (see DataVersions).
+
+        Responses carry an ETag derived from the version and the request
+        target, so clients that revalidate with If-None-Match get a bodiless
+        304 without a query, and never for another page or month.
+        """
+        target = hashlib.sha256(self.path.encode('utf-8')).hexdigest()[:12]
+        etag = f'W/"{BOOT_ID}-{version}-{target}"'
+        headers = (('ETag', etag), ('Cache-Control', 'private, no-cache'))
+        if not_modified(self.headers, etag, None):
+            self.send_response(304)
+            self._cors()
+            for name, value in headers:
+                self.send_header(name, value)
+            self.end_headers()
+            return
+        key = (self.path, version)
+        entry = response_cache.get(key)
+        if entry is None:
+            entry = CachedBody(etag, json_bytes(build()))
+            response_cache.put(key, entry)
+        self._send_body(entry.body, 'application/json', headers=headers, encoded=entry.encoded)
+
+    def _send_receipt(self, fpath, cache_control=None):
+        """Serve a receipt with validators, Range support and zero-copy body transfer."""
+        with open(fpath, 'rb') as f:
+            st = os.fstat(f.fileno())
+            etag, ctype, immutable = receipt_meta(fpath, f, st)
+            last_modified = formatdate(st.st_mtime, usegmt=True)
+            if cache_control is None:
+                cache_control = 'private, max-age=31536000, immutable' if immutable else 'private, no-cache'
+
+            if not_modified(self.headers, etag, st.st_mtime):
+                self.send_response(304)
+                self._cors()
+                self.send_header('ETag', etag)
+                self.send_header('Last-Modified', last_modified)
+                self.send_header('Cache-Control', cache_control)
+                self.end_headers()
+                return
+
+            size = st.st_size
+            byte_range = None
+            range_header = self.headers.get('Range')
+            if_range = self.headers.get('If-Range')
+            if range_header and (not if_range or if_range.strip() == etag):
+                byte_range = parse_range(range_header, size)
+                if byte_range == 'unsatisfiable':
+                    self.send_response(416)
+                    self._cors()
+                    self.send_header('Content-Range', f'bytes */{size}')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+            start, end = byte_range or (0, size - 1)
+            length = max(0, end - start + 1)
+
+            self.send_response(206 if byte_range else 200)
+            self._cors()
+            self.send_header('Content-Type', ctype)
+            self.send_header('Content-Length', str(length))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', last_modified)
+            self.send_header('Cache-Control', cache_control)
+            if byte_range:
+                self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+            self.end_headers()
+            if length:
+                # socket.sendfile uses os.sendfile where available and copes with socket timeouts
+                self.wfile.flush()
+                self.connection.sendfile(f, start, length)
+
+    def _send_static(self, asset):
+        """Serve a preloaded front-end file, precompressed when the client allows it."""
+        if self.query.get('v', [None])[0] == asset.digest:
+            cache_control = STATIC_IMMUTABLE
+        else:
+            cache_control = STATIC_REVALIDATE
+        if not_modified(self.headers, asset.etag, None):
+            self.send_response(304)
+            self.send_header('ETag', asset.etag)
+            self.send_header('Cache-Control', cache_control)
+            self.end_headers()
+            return
+        coding = accepted_encoding(self.headers.get('Accept-Encoding'), tuple(asset.encoded)) if asset.encoded else None
+        body = asset.encoded[coding] if coding else asset.body
+        self.send_response(200)
+        self.send_header('Content-Type', asset.content_type)
+        if asset.encoded:
+            self.send_header('Vary', 'Accept-Encoding')
+        if coding:
+            self.send_header('Content-Encoding', coding)
+        self.send_header('ETag', asset.etag)
+        self.send_header('Cache-Control', cache_control)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _start_stream(self, content_type, status=200, headers=()):
+        """Send headers for a body of unknown length.
+
+        HTTP/1.1 clients get chunked framing and keep their connection; older
+        clients get the body delimited by closing the connection. The body is
+        gzipped on the fly when the client accepts it.
+        """
+        self._chunked = self.request_version == 'HTTP/1.1'
+        coding = accepted_encoding(self.headers.get('Accept-Encoding'), STREAM_ENCODINGS)
+        self._compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 31) if coding else None
+        if not self._chunked:
+            self.close_connection = True
+        self.send_response(status)
+        self._cors()
+        self.send_header('Content-Type', content_type)
+        self.send_header('Vary', 'Accept-Encoding')
+        if coding:
+            self.send_header('Content-Encoding', coding)
+        if self._chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+
+    def _write_chunk(self, data):
+        if self._compressor is not None:
+            data = self._compressor.compress(data)
+        if not data:
+            return
+        if self._chunked:
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        else:
+            self.wfile.write(data)
+
+    def _end_stream(self):
+        if self._compressor is not None:
+            tail = self._compressor.flush()
+            self._compressor = None
+            self._write_chunk(tail)
+        if self._chunked:
+            self.wfile.write(b'0\r\n\r\n')
+
+    def _stream_expenses(self, fmt, month, after, limit, chunk_size=64 * 1024):
+        # Rows are encoded one at a time and flushed in ~64 KB chunks
+        ndjson = fmt == 'ndjson'
+        self._start_stream('application/x-ndjson' if ndjson else 'application/json')
+        buf = bytearray() if ndjson else bytearray(b'{"expenses":[')
+        first = True
+        for exp in iter_expenses(db.get(), month, after, limit):
+            if ndjson:
+                buf += json_bytes(exp)
+                buf += b'\n'
+            else:
+                if not first:
+                    buf += b','
+                buf += json_bytes(exp)
+            first = False
+            if len(buf) >= chunk_size:
+                # Written (or compressed) before returning, so the buffer can be reused without a copy
+                self._write_chunk(buf)
+                buf.clear()
+        if not ndjson:
+            buf += b']}'
+        self._write_chunk(buf)
+        self._end_stream()
+
+    def _stream_export(self, fmt, first, last, chunk_size=64 * 1024):
+        # Like _stream_expenses: one cursor read in fetchmany batches, ~64 KB chunks on the wire
+        filename = f"expenses-{first or 'start'}-{last or 'end'}.{fmt}"
+        self._start_stream(EXPORT_FORMATS[fmt], headers=[
+            ('Content-Disposition', f'attachment; filename="{filename}"')])
+        sql, params = expense_export_query(first, last)
+        rows = iter_expense_rows(db.get(), sql, params)
+        if fmt == 'ndjson':
+            buf = bytearray()
+            for exp in rows:
+                buf += json_bytes(exp)
+                buf += b'\n'
+                if len(buf) >= chunk_size:
+                    self._write_chunk(buf)
+                    buf.clear()
+            self._write_chunk(buf)
+        else:
+            text = io.StringIO()
+            out = csv.writer(text)
+            out.writerow(EXPORT_CSV_COLUMNS + ('items',))
+            for exp in rows:
+                out.writerow([exp[c] for c in EXPORT_CSV_COLUMNS] +
+                             ['; '.join(f"{it['name']}: {it['amount']}" for it in exp['items'])])
+                if text.tell() >= chunk_size:
+                    self._write_chunk(text.getvalue().encode('utf-8'))
+                    text.seek(0)
+                    text.truncate()
+            self._write_chunk(text.getvalue().encode('utf-8'))
+        self._end_stream()
 
     def _read_body(self):
-        length = int(self.headers.get('Content-Length', 0))
-        if length == 0:
+        if self.body_stream.remaining <= 0:
             return {}
-        raw = self.rfile.read(length)
+        raw = self.body_stream.read()
+        try:
+            return json.loads(raw.decode('utf-8'))
+        except Exception:
+            return {}
+
+    def handle(self):
+        # Only the pooled server has workers to spare for keep-alive; the serial loop closes after each response
+        idle_timeout = getattr(self.server, 'idle_timeout', None)
+        self._keepalive = idle_timeout is not None and self.server.keepalive_timeout > 0
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection:
+            # Wait briefly for the next request, then hand the worker back
+            self.connection.settimeout(idle_timeout())
+            try:
+                if not self.rfile.peek(1):
+                    break
+            except OSError:
+                break
+            self.connection.settimeout(self.timeout)
+            self.handle_one_request()
+
+    def handle_one_request(self):
+        # Per-request state; a connection may carry more than one request
+        self.__dict__.pop('_session', None)
+        self.__dict__.pop('_chunked', None)
+        self.__dict__.pop('body_stream', None)
+        try:
+            super().handle_one_request()
+        finally:
+            # Early returns must not leave a transaction open on the shared connection
+            db.rollback()
+
+    def _dispatch(self, method):
+        """Frame the request body, route the request and keep the connection in a reusable state."""
+        started = time.perf_counter()
+        request = f'{method} {self.path}'
+        query_stats.reset(request)
+        metrics.begin()
+        # 0 stays recorded if the client went away before a status line was sent
+        self._status = 0
+        self._route_pattern = UNMATCHED_ROUTE
+        # Long-lived streams turn this off so they are not reported as slow requests
+        self._log_slow = True
+        profile = profiler.start()
+        try:
+            self._frame_and_route(method)
+        finally:
+            elapsed = time.perf_counter() - started
+            if self._log_slow:
+                profiler.request_done(request, self._route_pattern, self._status, elapsed,
+                                      query_stats.count, query_stats.seconds, profile)
+            elif profile is not None:
+                profile.disable()
+            metrics.observe(method, self._route_pattern, self._status, elapsed,
+                            query_stats.count, query_stats.seconds)
+            query_stats.reset()
+
+    def _frame_and_route(self, method):
+        if 'Transfer-Encoding' in self.headers:
+            # Chunked request bodies are not parsed, so nothing after this one could be framed
+            self.close_connection = True
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.close_connection = True
+            self._send_json({'error': 'Invalid Content-Length'}, status=400)
+            return
+        self.body_stream = BodyReader(self.rfile, length)
+        try:
+            self._route(method)
+        finally:
+            self._discard_body()
+
+    def _discard_body(self):
+        """Drop whatever part of the request body the handler did not read."""
+        stream = self.body_stream
+        if self.close_connection or stream.remaining <= 0:
+            return
+        if stream.remaining > DRAIN_MAX_BYTES:
+            self.close_connection = True
+            return
+        while stream.remaining > 0:
+            if not stream.read(stream.remaining):
+                self.close_connection = True
+                return
+
+    def _route(self, method):
+        """Route the request and run the shared auth, role, body and error handling around it."""
+        parsed = urlparse(self.path)
+        match = router.match(method, parsed.path)
+        if match is None:
+            self._send_json({'error': 'Not found'}, status=404)
+            return
+        route, params = match
+        self._route_pattern = route.pattern
+        self.query = parse_qs(parsed.query)
+        if route.auth:
+            session = self._get_session()
+            if session is None:
+                self._send_json({'error': 'Unauthorized'}, status=401)
+                return
+            if route.roles is not None and session.role not in route.roles:
+                self._send_json({'error': 'Forbidden'}, status=403)
+                return
+        try:
+            self.body = self._read_body() if route.json_body else None
+            route.handler(self, **params)
+        except Exception as e:
+            db.rollback()
+            if '_chunked' in self.__dict__:
+                # Headers are already out; all we can do is cut the stream short
+                self.close_connection = True
+                return
+            self._send_json({'error': str(e)}, status=500)
+
+    def do_OPTIONS(self):
+        self.send_response(200)
+        self._cors()
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+    # Front-end; run() registers this for each path static_assets.load() returns
+
+    def static_file(self):
+        self._send_static(static_assets.get(urlparse(self.path).path))
+
+    # Auth
+
+    @router.route('POST', '/api/auth/register', auth=False)
+    def register(self):
+        # Public registration disabled
+        self._send_json({'error': 'Registration disabled'}, status=403)
+
+    @router.route('POST', '/api/auth/login', auth=False, json_body=True)
+    def login(self):
+        data = self.body
+        username = (data.get('username') or '').strip()
+        password = (data.get('password') or '').strip()
+        remember = bool(data.get('remember'))
+        cur = db.get().cursor()
+        cur.execute('SELECT id, password_hash, salt, username, role FROM users WHERE username=?', (username,))
+        row = cur.fetchone()
+        uid, pwd_hash, salt, username, role = row or (None, None, None, None, None)
+        new_hash = None
+        try:
+            ok, stale = passwords.verify(password, pwd_hash, salt)
+            if ok and stale:
+                # Upgrade legacy or outdated-cost hashes while we have the plaintext
+                new_hash = passwords.hash(password, rehash=True)
+        except KdfBusy:
+            self._send_json({'error': 'Too many logins in progress'}, status=503, headers=[('Retry-After', '1')])
+            return
+        if not ok:
+            self._send_json({'error': 'Invalid credentials'}, status=401)
+            return
+        token = None if SESSION_MODE == 'signed' else secrets.token_hex(24)
+
+        def record_login(cur):
+            if new_hash:
+                cur.execute('UPDATE users SET password_hash=?, salt=? WHERE id=?', (new_hash[0], new_hash[1], uid))
+            if token:
+                # Short session expiry unless remembered; the cookie is then a session cookie
+                cur.execute('INSERT INTO sessions(token, user_id, created_at, expires_at) '
+                            'VALUES(?, ?, datetime("now"), datetime("now", ?))',
+                            (token, uid, '+30 days' if remember else '+12 hours'))
+
+        if new_hash or token:
+            writer.submit(record_login)
+        if SESSION_MODE == 'signed':
+            token = signed_sessions.issue(uid, username, role, 2592000 if remember else 12 * 3600)
+        cookie = self._cookie('session', token, None if not remember else 2592000)
+        self._send_json({'success': True}, headers=[('Set-Cookie', cookie)])
+
+    @router.route('POST', '/api/auth/logout', auth=False)
+    def logout(self):
+        # Remove session if present
+        token = self._session_token()
+        if token and SESSION_MODE == 'signed':
+            signed_sessions.revoke(token)
+        elif token:
+            writer.submit(lambda cur: cur.execute('DELETE FROM sessions WHERE token=?', (token,)).rowcount)
+            session_cache.invalidate(token)
+        self._send_json({'success': True}, headers=[('Set-Cookie', self._cookie('session', '', 0))])
+
+    @router.route('GET', '/api/auth/me', auth=False)
+    def me(self):
+        session = self._get_session()
+        if session is None:
+            self._send_json({'authenticated': False}, status=401)
+            return
+        self._send_json({'authenticated': True, 'user': {'id': session.user_id, 'username': session.username, 'role': session.role}})
+
+    # Admin
+
+    @router.route('POST', '/api/admin/users', roles=ADMIN_ROLES, json_body=True)
+    def create_user(self):
+        data = self.body
+        username = (data.get('username') or '').strip()
+        password = (data.get('password') or '').strip()
+        role = (data.get('role') or 'user').strip().lower()
+        if not username or not password:
+            self._send_json({'error': 'Missing username or password'}, status=400)
+            return
+        # Validate role
+        if role not in ALLOWED_ROLES:
+            self._send_json({'error': 'Invalid role'}, status=400)
+            return
+        # Basic strong password check
+        has_letter = any(c.isalpha() for c in password)
+        has_digit = any(c.isdigit() for c in password)
+        if len(password) < 12 or not (has_letter and has_digit):
+            self._send_json({'error': 'Password must be at least 12 chars with letters and digits'}, status=400)
+            return
+        # Create user
+        try:
+            pwd_hash, salt = passwords.hash(password)
+        except KdfBusy:
+            self._send_json({'error': 'Too many password operations in progress'}, status=503,
+                            headers=[('Retry-After', '1')])
+            return
+        try:
+            new_id = writer.submit(lambda cur: cur.execute(
+                'INSERT INTO users(username, password_hash, salt, role, created_at) VALUES(?,?,?,?,datetime("now"))',
+                (username, pwd_hash, salt, role)).lastrowid)
+        except sqlite3.IntegrityError:
+            self._send_json({'error': 'Username already exists'}, status=409)
+            return
+        self._send_json({'success': True, 'user_id': new_id}, status=201)
+
+    @router.route('POST', '/api/admin/users/list', roles=ADMIN_ROLES)
+    def list_users(self):
+        cur = db.get().cursor()
+        cur.execute('SELECT id, username, role, created_at FROM users ORDER BY id ASC')
+        users = [{'id': r[0], 'username': r[1], 'role': r[2], 'created_at': r[3]} for r in cur.fetchall()]
+        self._send_json({'users': users})
+
+    @router.route('POST', '/api/admin/users/role', roles=ADMIN_ROLES, json_body=True)
+    def change_role(self):
+        data = self.body
+        role = (data.get('role') or '').strip().lower()
+        if role not in ALLOWED_ROLES:
+            self._send_json({'error': 'Invalid role'}, status=400)
+            return
+        try:
+            target_id = int(data.get('user_id'))
+        except (TypeError, ValueError):
+            self._send_json({'error': 'Missing or invalid user_id'}, status=400)
+            return
+        updated = writer.submit(lambda cur: cur.execute('UPDATE users SET role=? WHERE id=?', (role, target_id)).rowcount)
+        if updated == 0:
+            self._send_json({'error': 'User not found'}, status=404)
+            return
+        # Cached sessions and signed tokens still carry the old role
+        session_cache.invalidate_user(target_id)
+        signed_sessions.revoke_user(target_id)
+        self._send_json({'success': True, 'user_id': target_id, 'role': role})
+
+    @router.route('GET', '/api/admin/db-stats', roles=ADMIN_ROLES)
+    def db_stats(self):
+        self._send_json({'pool': db.stats(), 'session_cache': session_cache.stats(), 'previews': previews.stats(),
+                         'response_cache': response_cache.stats(), 'passwords': passwords.stats(),
+                         'sessions': {'mode': SESSION_MODE, 'janitor': session_janitor.stats(),
+                                      'signed': signed_sessions.stats()},
+                         'events': events.stats(), 'writer': writer.stats()})
+
+    @router.route('GET', '/api/admin/metrics', roles=ADMIN_ROLES)
+    def get_metrics(self):
+        """Prometheus text by default; ?format=json for the same data as JSON."""
+        if self.query.get('format', [None])[0] == 'json':
+            self._send_json(dict(metrics.as_json(), writer=writer.stats()))
+            return
+        text = metrics.as_prometheus() + writer.prometheus()
+        self._send_body(text.encode('utf-8'), 'text/plain; version=0.0.4; charset=utf-8')
+
+    @router.route('GET', '/api/admin/profiling', roles=ADMIN_ROLES)
+    def get_profiling(self):
+        """Profiler settings and the slow-request/slow-query ring buffer, newest last; ?kind=request|query filters."""
+        kind = self.query.get('kind', [None])[0]
+        self._send_json({'settings': profiler.stats(), 'records': profiler.records(kind)})
+
+    @router.route('POST', '/api/admin/profiling', roles=ADMIN_ROLES, json_body=True)
+    def set_profiling(self):
+        data = self.body
+        try:
+            profiler.configure(**{k: float(data[k]) for k in ('sample_rate', 'slow_request_ms', 'slow_query_ms')
+                                  if data.get(k) is not None})
+        except (TypeError, ValueError) as e:
+            self._send_json({'error': str(e)}, status=400)
+            return
+        if data.get('clear'):
+            profiler.clear()
+        self._send_json({'settings': profiler.stats()})
+
+    # Change feed
+
+    @router.route('GET', '/api/events')
+    def event_stream(self):
+        """Server-sent events: one ``change`` event per committed write, ``reset`` when events were missed."""
+        if getattr(self.server, 'idle_timeout', None) is None:
+            # A stream would hold the serial server's only thread
+            self._send_json({'error': 'Event stream requires SERVER_MODE=threads'}, status=503)
+            return
+        subscription = events.subscribe(self._session.role, self.headers.get('Last-Event-ID'))
+        if subscription is None:
+            self._send_json({'error': 'Too many event streams'}, status=503,
+                            headers=(('Retry-After', str(int(SSE_HEARTBEAT * 2))),))
+            return
+        sub, replay = subscription
+        self._log_slow = False
+        # The body ends when the connection does
+        self.close_connection = True
+        try:
+            self.send_response(200)
+            self._cors()
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            # Reverse proxies must not buffer the stream
+            self.send_header('X-Accel-Buffering', 'no')
+            self.end_headers()
+            self.wfile.write(b'retry: 5000\n\n' + b''.join(replay))
+            while True:
+                try:
+                    frame = sub.queue.get(timeout=SSE_HEARTBEAT)
+                except queue.Empty:
+                    # Logout, expiry or a role change ends the stream; the client reconnects and re-authenticates
+                    self.__dict__.pop('_session', None)
+                    session = self._get_session()
+                    if session is None or session.role != sub.role:
+                        return
+                    self.wfile.write(b': ping\n\n')
+                    continue
+                if frame is None:
+                    return
+                self.wfile.write(frame)
+        except OSError:
+            # Client went away
+            pass
+        finally:
+            events.unsubscribe(sub)
+
+    # Expenses
+
+    @router.route('GET', '/api/expenses')
+    def list_expenses(self):
+        qs = self.query
+        month = qs.get('month', [None])[0]
+        stream = qs.get('stream', [None])[0]
+        try:
+            if stream not in (None, 'ndjson', 'json'):
+                raise ValueError('stream must be ndjson or json')
+            after = decode_cursor(qs.get('cursor', [None])[0])
+            limit = qs.get('limit', [None])[0]
+            if limit is not None:
+                limit = int(limit)
+                if not 0 < limit <= MAX_PAGE_SIZE:
+                    raise ValueError(f'limit must be between 1 and {MAX_PAGE_SIZE}')
+            elif not month and not stream:
+                limit = DEFAULT_PAGE_SIZE
+        except ValueError as e:
+            self._send_json({'error': str(e)}, status=400)
+            return
+        if stream:
+            self._stream_expenses(stream, month, after, limit)
+            return
+        version = data_versions.version('expenses', month, month) if month else data_versions.version('expenses')
+        self._send_cached_json(version, lambda: expense_page(db.get().cursor(), month, after, limit))
+
+    @router.route('GET', '/api/expenses/search')
+    def search(self):
+        # ?q= words to find, with optional month=YYYY-MM, from=/to=YYYY-MM-DD, limit and cursor
+        qs = self.query
+        terms = search_terms(qs.get('q', [''])[0])
+        month = qs.get('month', [None])[0]
+        first = qs.get('from', [None])[0]
+        last = qs.get('to', [None])[0]
         try:
-            return json.loads(raw.decode('utf-8'))
-        except Exception:
-            return {}
+            if not terms:
+                raise ValueError('q must contain at least one word')
+            if month and not MONTH_KEY_RE.match(month):
+                raise ValueError('month must be YYYY-MM')
+            if any(d and not DATE_RE.match(d) for d in (first, last)):
+                raise ValueError('from and to must be YYYY-MM-DD')
+            offset = decode_offset_cursor(qs.get('cursor', [None])[0])
+            limit = int(qs.get('limit', [SEARCH_PAGE_SIZE])[0])
+            if not 0 < limit <= MAX_PAGE_SIZE:
+                raise ValueError(f'limit must be between 1 and {MAX_PAGE_SIZE}')
+        except ValueError as e:
+            self._send_json({'error': str(e)}, status=400)
+            return
+        version = data_versions.version('expenses', month, month) if month else data_versions.version('expenses')
+        self._send_cached_json(version, lambda: search_expenses(
+            db.get().cursor(), terms, month, first, last, limit, offset))
 
-    def do_OPTIONS(self):
-        self.send_response(200)
-        self._cors()
-        self.end_headers()
+    @router.route('POST', '/api/expenses', roles=EDITOR_ROLES, json_body=True)
+    def create_expense(self):
+        data = self.body
+        try:
+            fields, item_rows = validate_expense(data)
+        except ValueError as e:
+            self._send_json({'error': str(e)}, status=400)
+            return
+        receipt_name = data.get('receipt_name')
+        receipt_base64 = data.get('receipt_base64')
+        receipt_path = None
+        # Handle receipt if provided (legacy base64 field; prefer POST /api/expenses/<id>/receipt).
+        # The file is stored before the write so the writer never waits on it.
+        if receipt_base64 and receipt_name:
+            try:
+                receipt_path, _, _, _ = store_receipt(
+                    [base64.b64decode(receipt_base64)], receipt_extension(receipt_name, None))
+            except Exception as e:
+                # If receipt fails, continue without blocking
+                pass
 
-    def do_GET(self):
-        parsed = urlparse(self.path)
-        path = parsed.path
-        qs = parse_qs(parsed.query)
-        # Auth: allow auth endpoints without session, require for others
-        if not path.startswith('/api/auth'):
-            uid = self._get_session_user()
-            if uid is None:
-                self._send_json({'error': 'Unauthorized'}, status=401)
-                return
-        # Auth endpoints
-        if path == '/api/auth/me':
-            uid = self._get_session_user()
-            if uid is None:
-                self._send_json({'authenticated': False}, status=401)
-                return
-            conn = sqlite3.connect(DB_PATH)
-            cur = conn.cursor()
-            cur.execute('SELECT id, username, role FROM users WHERE id=?', (uid,))
+        def insert(cur):
+            cur.execute('INSERT INTO expenses(description, amount, date, category, payer, month_key, receipt_path) '
+                        'VALUES(?,?,?,?,?,?,?)', fields + (receipt_path,))
+            new_id = cur.lastrowid
+            cur.executemany('INSERT INTO expense_items(expense_id, name, amount) VALUES(?,?,?)',
+                            [(new_id, name, amount) for name, amount in item_rows])
+            apply_rollup_deltas(cur, rollup_deltas([fields[1:]]))
+            index_expenses(cur, new_id)
+            cur.execute('SELECT * FROM expenses WHERE id=?', (new_id,))
+            return cur.fetchone()
+
+        row = writer.submit(insert)
+        data_versions.bump('expenses', [fields[5]])
+        events.publish('expense', 'created', row[0], fields[5])
+        if receipt_path:
+            previews.enqueue(receipt_path)
+        exp = dictify_expense(row)
+        exp['items'] = [{'name': name, 'amount': amount} for name, amount in item_rows]
+        self._send_json({'expense': exp}, status=201)
+
+    @router.route('POST', '/api/expenses/bulk', roles=EDITOR_ROLES)
+    def bulk_import(self):
+        if 'Content-Length' not in self.headers:
+            self._send_json({'error': 'Content-Length required'}, status=411)
+            return
+        ctype = (self.headers.get('Content-Type') or '').split(';', 1)[0].strip().lower()
+        if ctype not in BULK_CONTENT_TYPES:
+            self._send_json({'error': f'Unsupported Content-Type: {ctype}'}, status=415)
+            return
+        # Read the whole upload first: it is parsed twice, and writes must not wait on the network
+        length = self.body_stream.remaining
+        spool = io.BytesIO() if length <= BULK_SPOOL_MEMORY else tempfile.TemporaryFile()
+        try:
+            for chunk in iter_body_chunks(self.body_stream, length):
+                spool.write(chunk)
+        except ValueError as e:
+            spool.close()
+            self.close_connection = True
+            self._send_json({'error': str(e), 'inserted': 0}, status=400)
+            return
+        spool.seek(0)
+        body = io.TextIOWrapper(spool, encoding='utf-8-sig', newline='')
+        try:
+            # A parse-only pass first: imports commit chunk by chunk, so a malformed document must fail up front
+            for _ in bulk_records(body, ctype):
+                pass
+            body.seek(0)
+            result = import_expenses(bulk_records(body, ctype))
+        except ValueError as e:
+            self._send_json({'error': str(e), 'inserted': 0}, status=400)
+            return
+        finally:
+            body.close()
+        self._send_json(result, status=200 if not result['failed'] else 207)
+
+    @router.route('DELETE', '/api/expenses/{expense_id:int}', roles=EDITOR_ROLES)
+    def delete_expense(self, expense_id):
+        def delete(cur):
+            cur.execute('SELECT amount, date, category, payer, month_key FROM expenses WHERE id=?', (expense_id,))
+            row = cur.fetchone()
+            if row:
+                cur.execute('DELETE FROM expenses WHERE id=?', (expense_id,))
+                apply_rollup_deltas(cur, rollup_deltas([row], sign=-1))
+                index_expenses(cur, expense_id)
+            return row
+
+        row = writer.submit(delete)
+        if row:
+            data_versions.bump('expenses', [row[4]])
+            events.publish('expense', 'deleted', expense_id, row[4])
+        self._send_json({'success': True})
+
+    @router.route('POST', '/api/expense-items', roles=EDITOR_ROLES, json_body=True)
+    def create_item(self):
+        data = self.body
+        name = (data.get('name') or '').strip()
+        try:
+            expense_id = int(data.get('expense_id'))
+            amount = float(data.get('amount'))
+        except (TypeError, ValueError):
+            expense_id, amount = None, None
+        if not expense_id or not name or not amount or amount <= 0:
+            self._send_json({'error': 'Invalid item payload'}, status=400)
+            return
+
+        def insert(cur):
+            cur.execute('SELECT month_key FROM expenses WHERE id=?', (expense_id,))
+            row = cur.fetchone()
+            if row is None:
+                return None, None
+            cur.execute('INSERT INTO expense_items(expense_id, name, amount) VALUES(?,?,?)', (expense_id, name, amount))
+            item_id = cur.lastrowid
+            index_expenses(cur, expense_id)
+            return row, item_id
+
+        row, item_id = writer.submit(insert)
+        if row is None:
+            self._send_json({'error': 'Expense not found'}, status=404)
+            return
+        data_versions.bump('expenses', [row[0]])
+        events.publish('expense', 'updated', expense_id, row[0])
+        self._send_json({'item': {'id': item_id, 'expense_id': expense_id, 'name': name, 'amount': amount}}, status=201)
+
+    @router.route('DELETE', '/api/expense-items/{item_id:int}', roles=EDITOR_ROLES)
+    def delete_item(self, item_id):
+        def delete(cur):
+            cur.execute('SELECT e.month_key, e.id FROM expense_items i JOIN expenses e ON e.id = i.expense_id '
+                        'WHERE i.id=?', (item_id,))
             row = cur.fetchone()
-            conn.close()
-            if not row:
-                self._send_json({'authenticated': False}, status=401)
+            cur.execute('DELETE FROM expense_items WHERE id=?', (item_id,))
+            deleted = cur.rowcount
+            if row:
+                index_expenses(cur, row[1])
+            return row, deleted
+
+        row, deleted = writer.submit(delete)
+        if deleted:
+            data_versions.bump('expenses', [row[0]] if row else None)
+            events.publish('expense', 'updated', row[1] if row else None, row[0] if row else None)
+        self._send_json({'success': True})
+
+    @router.route('GET', '/api/export')
+    def export(self):
+        # ?from=YYYY-MM-DD&to=YYYY-MM-DD (both optional, inclusive) and format=csv|ndjson
+        qs = self.query
+        first = qs.get('from', [None])[0]
+        last = qs.get('to', [None])[0]
+        fmt = qs.get('format', ['csv'])[0]
+        if fmt not in EXPORT_FORMATS:
+            self._send_json({'error': 'format must be csv or ndjson'}, status=400)
+            return
+        if any(d and not DATE_RE.match(d) for d in (first, last)) or (first and last and first > last):
+            self._send_json({'error': 'Expected from=YYYY-MM-DD and to=YYYY-MM-DD, from not after to'}, status=400)
+            return
+        self._stream_export(fmt, first, last)
+
+    @router.route('GET', '/api/summary')
+    def summary(self):
+        # Either ?month=YYYY-MM or an inclusive ?from=YYYY-MM&to=YYYY-MM range
+        qs = self.query
+        month = qs.get('month', [None])[0]
+        first = qs.get('from', [month])[0]
+        last = qs.get('to', [month or first])[0]
+        if not first or not MONTH_KEY_RE.match(first) or not MONTH_KEY_RE.match(last or '') or first > last:
+            self._send_json({'error': 'Expected month=YYYY-MM or from=YYYY-MM&to=YYYY-MM'}, status=400)
+            return
+        self._send_cached_json(data_versions.version('expenses', first, last),
+                               lambda: monthly_summary(db.get().cursor(), first, last))
+
+    # Receipts
+
+    @router.route('POST', '/api/expenses/{expense_id:int}/receipt', roles=EDITOR_ROLES)
+    def upload_receipt(self, expense_id):
+        if 'Content-Length' not in self.headers:
+            self._send_json({'error': 'Content-Length required'}, status=411)
+            return
+        length = int(self.headers['Content-Length'])
+        if length <= 0:
+            self._send_json({'error': 'Empty receipt'}, status=400)
+            return
+        if length > RECEIPT_MAX_BYTES:
+            self.close_connection = True
+            self._send_json({'error': 'Receipt too large'}, status=413)
+            return
+        cur = db.get().cursor()
+        cur.execute('SELECT month_key FROM expenses WHERE id=?', (expense_id,))
+        row = cur.fetchone()
+        if not row:
+            self._send_json({'error': 'Expense not found'}, status=404)
+            return
+        ext = receipt_extension(self.query.get('name', [None])[0], self.headers.get('Content-Type'))
+        name, digest, size, existed = store_receipt(iter_body_chunks(self.body_stream, length), ext)
+        writer.submit(lambda cur: cur.execute('UPDATE expenses SET receipt_path=? WHERE id=?', (name, expense_id)).rowcount)
+        data_versions.bump('expenses', [row[0]])
+        events.publish('expense', 'updated', expense_id, row[0])
+        previews.enqueue(name)
+        self._send_json({'expense_id': expense_id, 'receipt_path': name, 'sha256': digest,
+                         'size': size, 'deduplicated': existed}, status=201)
+
+    @router.route('GET', '/api/receipts/{fname}')
+    def get_receipt(self, fname):
+        fpath = os.path.join(RECEIPTS_DIR, fname)
+        # Only plain files directly inside the receipts directory
+        if fname != os.path.basename(fname) or fname.startswith('.') or not os.path.isfile(fpath):
+            self._send_json({'error': 'Receipt not found'}, status=404)
+            return
+        size = self.query.get('size', [None])[0]
+        if size is not None and size not in PREVIEW_SIZES:
+            self._send_json({'error': f"size must be one of {', '.join(PREVIEW_SIZES)}"}, status=400)
+            return
+        if size and previews.can_preview(fpath):
+            ppath = previews.path_for(fname, size)
+            if os.path.isfile(ppath):
+                previews.touch(ppath)
+                self._send_receipt(ppath)
                 return
-            self._send_json({'authenticated': True, 'user': {'id': row[0], 'username': row[1], 'role': row[2]}})
+            # Not built yet: schedule it and send the original without letting it be cached as the preview
+            previews.enqueue(fname)
+            self._send_receipt(fpath, cache_control='no-store')
             return
-        if path == '/api/expenses':
-            month = qs.get('month', [None])[0]
-            conn = sqlite3.connect(DB_PATH)
-            cur = conn.cursor()
-            if month:
-                cur.execute('SELECT * FROM expenses WHERE month_key=? ORDER BY date DESC, id DESC', (month,))
-            else:
-                cur.execute('SELECT * FROM expenses ORDER BY date DESC, id DESC')
-            rows = cur.fetchall()
-            # Fetch items for these expenses
-            exp_ids = [r[0] for r in rows]
-            items_map = {}
-            if exp_ids:
-                qmarks = ','.join('?' for _ in exp_ids)
-                cur.execute(f'SELECT id, expense_id, name, amount FROM expense_items WHERE expense_id IN ({qmarks})', exp_ids)
-                for iid, eid, name, amount in cur.fetchall():
-                    items_map.setdefault(eid, []).append({'id': iid, 'name': name, 'amount': amount})
-            conn.close()
-            expenses_payload = []
-            for r in rows:
-                exp = dictify_expense(r)
-                exp['items'] = items_map.get(exp['id'], [])
-                expenses_payload.append(exp)
-            self._send_json({'expenses': expenses_payload})
-            return
-        if path == '/api/balances':
-            month = qs.get('month', [None])[0]
-            conn = sqlite3.connect(DB_PATH)
-            cur = conn.cursor()
+        self._send_receipt(fpath)
+
+    # Balances
+
+    @router.route('GET', '/api/balances')
+    def get_balances(self):
+        month = self.query.get('month', [None])[0]
+
+        def build():
+            cur = db.get().cursor()
             if month:
                 cur.execute('SELECT starting_balance, updated_at FROM balances WHERE month_key=?', (month,))
                 row = cur.fetchone()
-                conn.close()
                 if row:
-                    self._send_json({'month_key': month, 'starting_balance': row[0], 'updated_at': row[1]})
-                else:
-                    self._send_json({'month_key': month, 'starting_balance': 0, 'updated_at': None})
-            else:
-                cur.execute('SELECT month_key, starting_balance, updated_at FROM balances')
-                rows = cur.fetchall()
-                conn.close()
-                self._send_json({'balances': [{'month_key': r[0], 'starting_balance': r[1], 'updated_at': r[2]} for r in rows]})
-            return
-        if path == '/api/savings':
-            # Only admins can view savings per role policy
-            conn = sqlite3.connect(DB_PATH)
-            cur = conn.cursor()
-            uid = self._get_session_user()
-            cur.execute('SELECT role FROM users WHERE id=?', (uid,))
-            rrow = cur.fetchone()
-            if not rrow or rrow[0] != 'admin':
-                conn.close()
-                self._send_json({'error': 'Forbidden'}, status=403)
-                return
+                    return {'month_key': month, 'starting_balance': row[0], 'updated_at': row[1]}
+                return {'month_key': month, 'starting_balance': 0, 'updated_at': None}
+            cur.execute('SELECT month_key, starting_balance, updated_at FROM balances')
+            rows = cur.fetchall()
+            return {'balances': [{'month_key': r[0], 'starting_balance': r[1], 'updated_at': r[2]} for r in rows]}
+
+        self._send_cached_json(data_versions.version('balances'), build)
+
+    @router.route('POST', '/api/balances', roles=ADMIN_ROLES, json_body=True)
+    def set_balance(self):
+        data = self.body
+        month_key = data.get('month_key')
+        starting_balance = data.get('starting_balance')
+        if month_key is None or starting_balance is None:
+            self._send_json({'error': 'Missing fields'}, status=400)
+            return
+        starting_balance = float(starting_balance)
+
+        def upsert(cur):
+            # Portable upsert: update first, then insert if no row
+            cur.execute('UPDATE balances SET starting_balance=?, updated_at=datetime("now") WHERE month_key=?',
+                        (starting_balance, month_key))
+            if cur.rowcount == 0:
+                cur.execute('INSERT INTO balances(month_key, starting_balance, updated_at) VALUES(?,?,datetime("now"))',
+                            (month_key, starting_balance))
+            cur.execute('SELECT starting_balance, updated_at FROM balances WHERE month_key=?', (month_key,))
+            return cur.fetchone()
+
+        row = writer.submit(upsert)
+        data_versions.bump('balances')
+        events.publish('balance', 'updated', month_key=month_key)
+        self._send_json({'month_key': month_key, 'starting_balance': row[0], 'updated_at': row[1]}, status=200)
+
+    # Savings (admin only per role policy)
+
+    @router.route('GET', '/api/savings', roles=ADMIN_ROLES)
+    def list_savings(self):
+        def build():
+            cur = db.get().cursor()
             cur.execute('SELECT id, name, target, current, created_at FROM savings ORDER BY id DESC')
             rows = cur.fetchall()
-            conn.close()
-            self._send_json({'savings': [
+            return {'savings': [
                 {'id': r[0], 'name': r[1], 'target': r[2], 'current': r[3], 'created_at': r[4]}
-            for r in rows]})
+            for r in rows]}
+
+        self._send_cached_json(data_versions.version('savings'), build)
+
+    @router.route('POST', '/api/savings', roles=ADMIN_ROLES, json_body=True)
+    def create_saving(self):
+        data = self.body
+        name = data.get('name')
+        target = data.get('target')
+        if not name or target is None:
+            self._send_json({'error': 'Missing fields'}, status=400)
             return
-        # Serve receipt files
-        if path.startswith('/api/receipts/'):
-            # Protect receipts behind auth
-            uid = self._get_session_user()
-            if uid is None:
-                self._send_json({'error': 'Unauthorized'}, status=401)
-                return
-            fname = path.split('/api/receipts/', 1)[1]
-            fpath = os.path.join('receipts', fname)
-            if not os.path.isfile(fpath):
-                self._send_json({'error': 'Receipt not found'}, status=404)
-                return
-            try:
-                with open(fpath, 'rb') as f:
-                    data = f.read()
-                self.send_response(200)
-                self._cors()
-                # Generic content type
-                self.send_header('Content-Type', 'application/octet-stream')
-                self.end_headers()
-                self.wfile.write(data)
-                return
-            except Exception as e:
-                self._send_json({'error': str(e)}, status=500)
-                return
-        self._send_json({'error': 'Not found'}, status=404)
+        target = float(target)
 
-    def do_POST(self):
-        parsed = urlparse(self.path)
-        path = parsed.path
-        # Defer body parsing to individual handlers to allow per-route error handling
-        data = None
-        # Auth endpoints
-        if path == '/api/auth/register':
-            try:
-                # Public registration disabled
-                self._send_json({'error': 'Registration disabled'}, status=403)
-                return
-            except Exception as e:
-                try:
-                    conn.close()
-                except Exception:
-                    pass
-                self._send_json({'error': str(e)}, status=500)
-                return
-        if path == '/api/auth/login':
-            try:
-                data = self._read_body()
-                username = (data.get('username') or '').strip()
-                password = (data.get('password') or '').strip()
-                remember = bool(data.get('remember'))
-                conn = sqlite3.connect(DB_PATH)
-                cur = conn.cursor()
-                cur.execute('SELECT id, password_hash, salt FROM users WHERE username=?', (username,))
-                row = cur.fetchone()
-                if not row:
-                    conn.close()
-                    self._send_json({'error': 'Invalid credentials'}, status=401)
-                    return
-                uid, pwd_hash, salt = row
-                calc = hashlib.sha256((salt + password).encode('utf-8')).hexdigest()
-                if calc != pwd_hash:
-                    conn.close()
-                    self._send_json({'error': 'Invalid credentials'}, status=401)
-                    return
-                token = secrets.token_hex(24)
-                if remember:
-                    cur.execute('INSERT INTO sessions(token, user_id, created_at, expires_at) VALUES(?, ?, datetime("now"), datetime("now", "+30 days"))', (token, uid))
-                else:
-                    # Short session expiry; cookie is a session cookie
-                    cur.execute('INSERT INTO sessions(token, user_id, created_at, expires_at) VALUES(?, ?, datetime("now"), datetime("now", "+12 hours"))', (token, uid))
-                conn.commit()
-                conn.close()
-                self.send_response(200)
-                self._cors()
-                self._set_cookie('session', token, None if not remember else 2592000)
-                self.send_header('Content-Type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps({'success': True}).encode('utf-8'))
-                return
-            except Exception as e:
-                try:
-                    conn.close()
-                except Exception:
-                    pass
-                self._send_json({'error': str(e)}, status=500)
-                return
-        if path == '/api/auth/logout':
-            try:
-                # Remove session if present
-                cookie = self.headers.get('Cookie') or ''
-                token = None
-                for part in cookie.split(';'):
-                    kv = part.strip().split('=', 1)
-                    if len(kv) == 2 and kv[0] == 'session':
-                        token = kv[1]
-                        break
-                if token:
-                    conn = sqlite3.connect(DB_PATH)
-                    cur = conn.cursor()
-                    cur.execute('DELETE FROM sessions WHERE token=?', (token,))
-                    conn.commit()
-                    conn.close()
-                self.send_response(200)
-                self._cors()
-                self._clear_cookie('session')
-                self.send_header('Content-Type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps({'success': True}).encode('utf-8'))
-                return
-            except Exception as e:
-                try:
-                    conn.close()
-                except Exception:
-                    pass
-                self._send_json({'error': str(e)}, status=500)
-                return
-        # For non-auth endpoints, require session
-        if not path.startswith('/api/auth'):
-            uid = self._get_session_user()
-            if uid is None:
-                self._send_json({'error': 'Unauthorized'}, status=401)
-                return
-        # Admin: create users
-        if path == '/api/admin/users':
-            try:
-                # Ensure admin
-                conn = sqlite3.connect(DB_PATH)
-                cur = conn.cursor()
-                cur.execute('SELECT role FROM users WHERE id=?', (uid,))
-                row = cur.fetchone()
-                if not row or row[0] != 'admin':
-                    conn.close()
-                    self._send_json({'error': 'Forbidden'}, status=403)
-                    return
-                data = self._read_body() if data is None else data
-                username = (data.get('username') or '').strip()
-                password = (data.get('password') or '').strip()
-                role = (data.get('role') or 'user').strip().lower()
-                if not username or not password:
-                    conn.close()
-                    self._send_json({'error': 'Missing username or password'}, status=400)
-                    return
-                # Validate role
-                allowed_roles = {'user','viewer','editor','admin'}
-                if role not in allowed_roles:
-                    conn.close()
-                    self._send_json({'error': 'Invalid role'}, status=400)
-                    return
-                # Basic strong password check
-                has_letter = any(c.isalpha() for c in password)
-                has_digit = any(c.isdigit() for c in password)
-                if len(password) < 12 or not (has_letter and has_digit):
-                    conn.close()
-                    self._send_json({'error': 'Password must be at least 12 chars with letters and digits'}, status=400)
-                    return
-                # Create user
-                salt = secrets.token_hex(16)
-                pwd_hash = hashlib.sha256((salt + password).encode('utf-8')).hexdigest()
-                try:
-                    cur.execute('INSERT INTO users(username, password_hash, salt, role, created_at) VALUES(?,?,?,?,datetime("now"))',
-                                (username, pwd_hash, salt, role))
-                    new_id = cur.lastrowid
-                    conn.commit()
-                    conn.close()
-                    self._send_json({'success': True, 'user_id': new_id}, status=201)
-                    return
-                except sqlite3.IntegrityError:
-                    conn.close()
-                    self._send_json({'error': 'Username already exists'}, status=409)
-                    return
-            except Exception as e:
-                try:
-                    conn.close()
-                except Exception:
-                    pass
-                self._send_json({'error': str(e)}, status=500)
-                return
-        # Admin: list users
-        if path == '/api/admin/users/list':
-            try:
-                conn = sqlite3.connect(DB_PATH)
-                cur = conn.cursor()
-                cur.execute('SELECT role FROM users WHERE id=?', (uid,))
-                row = cur.fetchone()
-                if not row or row[0] != 'admin':
-                    conn.close()
-                    self._send_json({'error': 'Forbidden'}, status=403)
-                    return
-                cur.execute('SELECT id, username, role, created_at FROM users ORDER BY id ASC')
-                users = [{'id': r[0], 'username': r[1], 'role': r[2], 'created_at': r[3]} for r in cur.fetchall()]
-                conn.close()
-                self._send_json({'users': users})
-                return
-            except Exception as e:
-                try:
-                    conn.close()
-                except Exception:
-                    pass
-                self._send_json({'error': str(e)}, status=500)
-                return
-        if path == '/api/expenses':
-            try:
-                # Only editor or admin can add expenses
-                conn_role = sqlite3.connect(DB_PATH)
-                cur_role = conn_role.cursor()
-                cur_role.execute('SELECT role FROM users WHERE id=?', (uid,))
-                r = cur_role.fetchone()
-                conn_role.close()
-                if not r or r[0] not in ('editor','admin'):
-                    self._send_json({'error': 'Forbidden'}, status=403)
-                    return
-                if data is None:
-                    data = self._read_body()
-                desc = data.get('description')
-                amt = data.get('amount')
-                date = data.get('date')
-                cat = data.get('category')
-                payer = data.get('payer')
-                receipt_name = data.get('receipt_name')
-                receipt_base64 = data.get('receipt_base64')
-                items = data.get('items') or []
-                if not all([desc, amt is not None, date, cat, payer]):
-                    self._send_json({'error': 'Missing fields'}, status=400)
-                    return
-                month_key = f"{date[:7]}"
-                conn = sqlite3.connect(DB_PATH)
-                cur = conn.cursor()
-                receipt_path = None
-                # Save expense first to get ID
-                cur.execute('INSERT INTO expenses(description, amount, date, category, payer, month_key, receipt_path) VALUES(?,?,?,?,?,?,?)',
-                            (desc, float(amt), date, cat, payer, month_key, None))
-                new_id = cur.lastrowid
-                # Handle receipt if provided
-                if receipt_base64 and receipt_name:
-                    try:
-                        os.makedirs('receipts', exist_ok=True)
-                        safe_name = f"expense_{new_id}_" + os.path.basename(receipt_name)
-                        fpath = os.path.join('receipts', safe_name)
-                        with open(fpath, 'wb') as f:
-                            f.write(base64.b64decode(receipt_base64))
-                        receipt_path = safe_name
-                        cur.execute('UPDATE expenses SET receipt_path=? WHERE id=?', (receipt_path, new_id))
-                    except Exception as e:
-                        # If receipt fails, continue without blocking
-                        pass
-                # Insert items if any
-                for it in items:
-                    name = it.get('name')
-                    iam = it.get('amount')
-                    if name and iam is not None:
-                        cur.execute('INSERT INTO expense_items(expense_id, name, amount) VALUES(?,?,?)', (new_id, name, float(iam)))
-                conn.commit()
-                cur.execute('SELECT * FROM expenses WHERE id=?', (new_id,))
-                row = cur.fetchone()
-                conn.close()
-                exp = dictify_expense(row)
-                exp['items'] = items
-                self._send_json({'expense': exp}, status=201)
-                return
-            except Exception as e:
-                try:
-                    conn.close()
-                except Exception:
-                    pass
-                self._send_json({'error': str(e)}, status=500)
-                return
-        if path == '/api/balances':
-            try:
-                # Only admin can update starting balance
-                conn_role = sqlite3.connect(DB_PATH)
-                cur_role = conn_role.cursor()
-                cur_role.execute('SELECT role FROM users WHERE id=?', (uid,))
-                r = cur_role.fetchone()
-                conn_role.close()
-                if not r or r[0] != 'admin':
-                    self._send_json({'error': 'Forbidden'}, status=403)
-                    return
-                if data is None:
-                    data = self._read_body()
-                month_key = data.get('month_key')
-                starting_balance = data.get('starting_balance')
-                if month_key is None or starting_balance is None:
-                    self._send_json({'error': 'Missing fields'}, status=400)
-                    return
-                conn = sqlite3.connect(DB_PATH)
-                cur = conn.cursor()
-                # Portable upsert: update first, then insert if no row
-                cur.execute('UPDATE balances SET starting_balance=?, updated_at=datetime("now") WHERE month_key=?',
-                            (float(starting_balance), month_key))
-                if cur.rowcount == 0:
-                    cur.execute('INSERT INTO balances(month_key, starting_balance, updated_at) VALUES(?,?,datetime("now"))',
-                                (month_key, float(starting_balance)))
-                conn.commit()
-                cur.execute('SELECT starting_balance, updated_at FROM balances WHERE month_key=?', (month_key,))
-                row = cur.fetchone()
-                conn.close()
-                self._send_json({'month_key': month_key, 'starting_balance': row[0], 'updated_at': row[1]}, status=200)
-                return
-            except Exception as e:
-                try:
-                    conn.close()
-                except Exception:
-                    pass
-                self._send_json({'error': str(e)}, status=500)
-                return
-        if path == '/api/savings':
-            try:
-                # Only admin can create savings goals
-                conn_role = sqlite3.connect(DB_PATH)
-                cur_role = conn_role.cursor()
-                cur_role.execute('SELECT role FROM users WHERE id=?', (uid,))
-                r = cur_role.fetchone()
-                conn_role.close()
-                if not r or r[0] != 'admin':
-                    self._send_json({'error': 'Forbidden'}, status=403)
-                    return
-                if data is None:
-                    data = self._read_body()
-                name = data.get('name')
-                target = data.get('target')
-                if not name or target is None:
-                    self._send_json({'error': 'Missing fields'}, status=400)
-                    return
-                conn = sqlite3.connect(DB_PATH)
-                cur = conn.cursor()
-                cur.execute('INSERT INTO savings(name, target, current, created_at) VALUES(?,?,0,datetime("now"))',
-                            (name, float(target)))
-                new_id = cur.lastrowid
-                conn.commit()
-                cur.execute('SELECT id, name, target, current, created_at FROM savings WHERE id=?', (new_id,))
-                row = cur.fetchone()
-                conn.close()
-                self._send_json({'saving': {'id': row[0], 'name': row[1], 'target': row[2], 'current': row[3], 'created_at': row[4]}}, status=201)
-                return
-            except Exception as e:
-                try:
-                    conn.close()
-                except Exception:
-                    pass
-                self._send_json({'error': str(e)}, status=500)
-                return
-        if path == '/api/expense-items':
-            try:
-                # Only editor or admin can add items
-                conn_role = sqlite3.connect(DB_PATH)
-                cur_role = conn_role.cursor()
-                cur_role.execute('SELECT role FROM users WHERE id=?', (uid,))
-                r = cur_role.fetchone()
-                conn_role.close()
-                if not r or r[0] not in ('editor','admin'):
-                    self._send_json({'error': 'Forbidden'}, status=403)
-                    return
-                if data is None:
-                    data = self._read_body()
-                expense_id = int(data.get('expense_id'))
-                name = (data.get('name') or '').strip()
-                amount = float(data.get('amount'))
-                if not expense_id or not name or amount <= 0:
-                    self._send_json({'error': 'Invalid item payload'}, status=400)
-                    return
-                conn = sqlite3.connect(DB_PATH)
-                cur = conn.cursor()
-                cur.execute('INSERT INTO expense_items(expense_id, name, amount) VALUES(?,?,?)', (expense_id, name, amount))
-                item_id = cur.lastrowid
-                conn.commit()
-                conn.close()
-                self._send_json({'item': {'id': item_id, 'expense_id': expense_id, 'name': name, 'amount': amount}}, status=201)
-                return
-            except Exception as e:
-                try:
-                    conn.close()
-                except Exception:
-                    pass
-                self._send_json({'error': str(e)}, status=500)
-                return
-        if path.startswith('/api/savings/') and path.endswith('/contribute'):
-            try:
-                # Only admin can contribute to savings
-                conn_role = sqlite3.connect(DB_PATH)
-                cur_role = conn_role.cursor()
-                cur_role.execute('SELECT role FROM users WHERE id=?', (uid,))
-                r = cur_role.fetchone()
-                conn_role.close()
-                if not r or r[0] != 'admin':
-                    self._send_json({'error': 'Forbidden'}, status=403)
-                    return
-                if data is None:
-                    data = self._read_body()
-                parts = path.split('/')
-                # /api/savings/{id}/contribute
-                sid = int(parts[3])
-                amount = data.get('amount')
-                if amount is None:
-                    self._send_json({'error': 'Missing amount'}, status=400)
-                    return
-                conn = sqlite3.connect(DB_PATH)
-                cur = conn.cursor()
-                cur.execute('UPDATE savings SET current = current + ? WHERE id=?', (float(amount), sid))
-                if cur.rowcount == 0:
-                    conn.close()
-                    self._send_json({'error': 'Saving not found'}, status=404)
-                    return
-                conn.commit()
-                cur.execute('SELECT id, name, target, current, created_at FROM savings WHERE id=?', (sid,))
-                row = cur.fetchone()
-                conn.close()
-                self._send_json({'saving': {'id': row[0], 'name': row[1], 'target': row[2], 'current': row[3], 'created_at': row[4]}}, status=200)
-                return
-            except Exception as e:
-                try:
-                    conn.close()
-                except Exception:
-                    pass
-                self._send_json({'error': str(e)}, status=500)
-                return
-        self._send_json({'error': 'Not found'}, status=404)
+        def insert(cur):
+            cur.execute('INSERT INTO savings(name, target, current, created_at) VALUES(?,?,0,datetime("now"))',
+                        (name, target))
+            cur.execute('SELECT id, name, target, current, created_at FROM savings WHERE id=?', (cur.lastrowid,))
+            return cur.fetchone()
 
-    def do_DELETE(self):
-        parsed = urlparse(self.path)
-        # Require auth for deletions
-        uid = self._get_session_user()
-        if uid is None:
-            self._send_json({'error': 'Unauthorized'}, status=401)
+        row = writer.submit(insert)
+        data_versions.bump('savings')
+        events.publish('saving', 'created', row[0], roles=ADMIN_ROLES)
+        self._send_json({'saving': {'id': row[0], 'name': row[1], 'target': row[2], 'current': row[3], 'created_at': row[4]}}, status=201)
+
+    @router.route('POST', '/api/savings/{sid:int}/contribute', roles=ADMIN_ROLES, json_body=True)
+    def contribute(self, sid):
+        amount = self.body.get('amount')
+        if amount is None:
+            self._send_json({'error': 'Missing amount'}, status=400)
             return
-        if parsed.path.startswith('/api/expenses/'):
-            try:
-                expense_id = int(parsed.path.split('/')[-1])
-            except Exception:
-                self._send_json({'error': 'Invalid ID'}, status=400)
-                return
-            # Only editor or admin can delete expenses
-            conn_role = sqlite3.connect(DB_PATH)
-            cur_role = conn_role.cursor()
-            cur_role.execute('SELECT role FROM users WHERE id=?', (uid,))
-            r = cur_role.fetchone()
-            conn_role.close()
-            if not r or r[0] not in ('editor','admin'):
-                self._send_json({'error': 'Forbidden'}, status=403)
-                return
-            conn = sqlite3.connect(DB_PATH)
-            cur = conn.cursor()
-            cur.execute('DELETE FROM expenses WHERE id=?', (expense_id,))
-            conn.commit()
-            conn.close()
-            self._send_json({'success': True})
+        amount = float(amount)
+
+        def add(cur):
+            cur.execute('UPDATE savings SET current = current + ? WHERE id=?', (amount, sid))
+            if cur.rowcount == 0:
+                return None
+            cur.execute('SELECT id, name, target, current, created_at FROM savings WHERE id=?', (sid,))
+            return cur.fetchone()
+
+        row = writer.submit(add)
+        if row is None:
+            self._send_json({'error': 'Saving not found'}, status=404)
             return
-        if parsed.path.startswith('/api/expense-items/'):
-            parts = parsed.path.split('/')
-            try:
-                item_id = int(parts[-1])
-            except Exception:
-                self._send_json({'error': 'Invalid item ID'}, status=400)
-                return
-            # Only editor or admin can delete items
-            conn_role = sqlite3.connect(DB_PATH)
-            cur_role = conn_role.cursor()
-            cur_role.execute('SELECT role FROM users WHERE id=?', (uid,))
-            r = cur_role.fetchone()
-            conn_role.close()
-            if not r or r[0] not in ('editor','admin'):
-                self._send_json({'error': 'Forbidden'}, status=403)
+        data_versions.bump('savings')
+        events.publish('saving', 'updated', sid, roles=ADMIN_ROLES)
+        self._send_json({'saving': {'id': row[0], 'name': row[1], 'target': row[2], 'current': row[3], 'created_at': row[4]}}, status=200)
+
+    @router.route('DELETE', '/api/savings/{sid:int}', roles=ADMIN_ROLES)
+    def delete_saving(self, sid):
+        writer.submit(lambda cur: cur.execute('DELETE FROM savings WHERE id=?', (sid,)).rowcount)
+        data_versions.bump('savings')
+        events.publish('saving', 'deleted', sid, roles=ADMIN_ROLES)
+        self._send_json({'success': True})
+
+class PooledHTTPServer(HTTPServer):
+    """HTTPServer that hands accepted connections to a fixed pool of worker threads.
+
+    At most ``max_pending`` accepted connections wait for a free worker; beyond
+    that the server answers 503 straight away instead of queueing without bound.
+    """
+
+    BUSY_BODY = b'{"error": "Server busy"}'
+    # listen() backlog; socketserver's default of 5 drops SYNs when a burst of clients connects at once
+    request_queue_size = int(os.environ.get('SERVER_LISTEN_BACKLOG', '128'))
+
+    def __init__(self, server_address, handler_cls, workers=16, max_pending=64, shutdown_timeout=10.0,
+                 keepalive_timeout=5.0, keepalive_grace=0.05):
+        super().__init__(server_address, handler_cls)
+        self.shutdown_timeout = shutdown_timeout
+        self.keepalive_timeout = keepalive_timeout
+        self.keepalive_grace = keepalive_grace
+        self._closing = False
+        self._pending = queue.Queue(maxsize=max_pending)
+        self._workers = []
+        for i in range(workers):
+            t = threading.Thread(target=self._worker, name=f'http-worker-{i}', daemon=True)
+            t.start()
+            self._workers.append(t)
+
+    def process_request(self, request, client_address):
+        try:
+            self._pending.put_nowait((request, client_address))
+        except queue.Full:
+            self._reject_busy(request)
+
+    def keep_connections(self):
+        """Whether a response may keep its connection open; false while connections queue or at shutdown."""
+        return not self._closing and self._pending.empty()
+
+    def idle_timeout(self):
+        """How long a worker may wait on an idle keep-alive connection for its next request."""
+        if self.keep_connections():
+            return self.keepalive_timeout
+        # The last response promised keep-alive before the queue filled; a request the client
+        # already sent gets a short grace to arrive before the worker moves on to queued connections
+        return min(self.keepalive_timeout, self.keepalive_grace)
+
+    def _reject_busy(self, request):
+        try:
+            request.sendall(
+                b'HTTP/1.0 503 Service Unavailable\r\n'
+                b'Retry-After: 1\r\n'
+                b'Content-Type: application/json\r\n'
+                b'Content-Length: ' + str(len(self.BUSY_BODY)).encode('ascii') + b'\r\n'
+                b'Connection: close\r\n\r\n' + self.BUSY_BODY
+            )
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def _worker(self):
+        while True:
+            job = self._pending.get()
+            if job is None:
                 return
-            conn = sqlite3.connect(DB_PATH)
-            cur = conn.cursor()
-            cur.execute('DELETE FROM expense_items WHERE id=?', (item_id,))
-            conn.commit()
-            conn.close()
-            self._send_json({'success': True})
-            return
-        if parsed.path.startswith('/api/savings/'):
+            request, client_address = job
             try:
-                sid = int(parsed.path.split('/')[-1])
-                conn = sqlite3.connect(DB_PATH)
-                cur = conn.cursor()
-                # Only admin can delete savings
-                conn_role = sqlite3.connect(DB_PATH)
-                cur_role = conn_role.cursor()
-                cur_role.execute('SELECT role FROM users WHERE id=?', (uid,))
-                r = cur_role.fetchone()
-                conn_role.close()
-                if not r or r[0] != 'admin':
-                    conn.close()
-                    self._send_json({'error': 'Forbidden'}, status=403)
-                    return
-                cur.execute('DELETE FROM savings WHERE id=?', (sid,))
-                conn.commit()
-                conn.close()
-                self._send_json({'success': True})
-                return
-            except Exception as e:
-                try:
-                    conn.close()
-                except Exception:
-                    pass
-                self._send_json({'error': str(e)}, status=500)
-                return
-        self._send_json({'error': 'Not found'}, status=404)
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        # Stop accepting, then let workers finish whatever is already queued
+        self._closing = True
+        super().server_close()
+        for _ in self._workers:
+            self._pending.put(None)
+        # One deadline for the whole pool, so shutdown takes at most shutdown_timeout
+        deadline = time.monotonic() + self.shutdown_timeout
+        for t in self._workers:
+            t.join(max(0.0, deadline - time.monotonic()))
+
+
+def make_server(server_address):
+    mode = os.environ.get('SERVER_MODE', 'threads').strip().lower()
+    if mode == 'serial':
+        return HTTPServer(server_address, Handler)
+    if mode != 'threads':
+        raise ValueError(f'Unknown SERVER_MODE: {mode}')
+    return PooledHTTPServer(
+        server_address,
+        Handler,
+        workers=SERVER_WORKERS,
+        max_pending=int(os.environ.get('SERVER_MAX_PENDING', '64')),
+        shutdown_timeout=float(os.environ.get('SERVER_SHUTDOWN_TIMEOUT', '10')),
+        keepalive_timeout=float(os.environ.get('SERVER_KEEPALIVE_TIMEOUT', '5')),
+        keepalive_grace=float(os.environ.get('SERVER_KEEPALIVE_GRACE', '0.05')),
+    )
 
 def run():
     init_db()
+    if SERVE_STATIC:
+        for path in static_assets.load():
+            router.add(Route('GET', path, Handler.static_file, auth=False))
     port = int(os.environ.get('PORT', '5000'))
     host = os.environ.get('HOST', '0.0.0.0')
     server_address = (host, port)
-    httpd = HTTPServer(server_address, Handler)
+    httpd = make_server(server_address)
+
+    def _graceful_stop(signum, frame):
+        # shutdown() blocks until serve_forever returns, so it cannot run on the main thread
+        threading.Thread(target=httpd.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, _graceful_stop)
+    signal.signal(signal.SIGINT, _graceful_stop)
+    writer.start()
+    session_janitor.start()
     print(f'API server running on http://{host}:{port}')
-    httpd.serve_forever()
+    try:
+        httpd.serve_forever()
+    finally:
+        # Open event streams would otherwise hold workers until their next heartbeat
+        events.close()
+        httpd.server_close()
+        session_janitor.stop()
+        # After the workers are gone, so every accepted write is committed before exit
+        writer.stop()
+        db.close_all()
+        print('API server stopped')
+
+def rollups_command(action):
+    """Run ``rebuild-rollups`` or ``check-rollups`` against DB_PATH; returns the exit status."""
+    conn = db.connect()
+    try:
+        migrate(conn)
+        cur = conn.cursor()
+        if action == 'rebuild-rollups':
+            cur.execute('BEGIN IMMEDIATE')
+            rows = rebuild_rollups(cur)
+            conn.commit()
+            print(f'Rebuilt month_rollups: {rows} rows')
+            return 0
+        problems = check_rollups(cur)
+        for p in problems[:50]:
+            print(f"{p['month_key']} {p['dimension']}={p['key']!r}: expected {p['expected']}, found {p['actual']}")
+        if problems:
+            print(f'{len(problems)} month_rollups rows disagree with expenses; run rebuild-rollups')
+            return 1
+        print('month_rollups is consistent with expenses')
+        return 0
+    finally:
+        conn.close()
+
+def search_command(action):
+    """Run ``rebuild-search`` against DB_PATH; returns the exit status."""
+    conn = db.connect()
+    try:
+        migrate(conn)
+        cur = conn.cursor()
+        if not has_search_index(cur):
+            print('This SQLite build has no FTS5; search uses LIKE scans and has no index to rebuild')
+            return 1
+        cur.execute('BEGIN IMMEDIATE')
+        indexed = rebuild_search_index(cur)
+        conn.commit()
+        print(f'Rebuilt expense_search: {indexed} expenses')
+        return 0
+    finally:
+        conn.close()
+
+COMMANDS = {
+    'rebuild-rollups': rollups_command,
+    'check-rollups': rollups_command,
+    'rebuild-search': search_command,
+}
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        if sys.argv[1] not in COMMANDS:
+            sys.exit(f"usage: {sys.argv[0]} [{' | '.join(COMMANDS)}]")
+        sys.exit(COMMANDS[sys.argv[1]](sys.argv[1]))
     run()
\ No newline at end of file
@@ -0,0 +1,419 @@
+"""End-to-end tests: each test class starts server.py on a free port in a temporary directory.
+
+    python -m pytest -q tests
+"""
+import http.client
+import json
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+SERVER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'server.py')
+ADMIN_USER = 'Weasley'
+ADMIN_PASSWORD = '6FjVCVYLcpm3XAiJ81gQWd'
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class ServerTestCase(unittest.TestCase):
+    env = {}
+
+    @classmethod
+    def setUpClass(cls):
+        cls.workdir = tempfile.TemporaryDirectory()
+        cls.port = free_port()
+        env = dict(os.environ, PORT=str(cls.port), HOST='127.0.0.1', **cls.env)
+        cls.proc = subprocess.Popen([sys.executable, SERVER], cwd=cls.workdir.name, env=env,
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.time() + 15
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', cls.port), timeout=0.2).close()
+                break
+            except OSError:
+                if time.time() > deadline:
+                    cls.proc.kill()
+                    raise
+                time.sleep(0.05)
+        resp, _ = cls.request('POST', '/api/auth/login', {'username': ADMIN_USER, 'password': ADMIN_PASSWORD})
+        cls.cookie = resp.getheader('Set-Cookie').split(';')[0]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.proc.terminate()
+        cls.proc.wait(10)
+        cls.workdir.cleanup()
+
+    @classmethod
+    def request(cls, method, path, body=None, cookie=None, headers=None, raw=None):
+        conn = http.client.HTTPConnection('127.0.0.1', cls.port, timeout=30)
+        h = {'Content-Type': 'application/json'}
+        if cookie:
+            h['Cookie'] = cookie
+        h.update(headers or {})
+        conn.request(method, path, body=raw if raw is not None else (json.dumps(body) if body is not None else None),
+                     headers=h)
+        resp = conn.getresponse()
+        data = resp.read()
+        conn.close()
+        return resp, data
+
+    def api(self, method, path, body=None, **kwargs):
+        """Signed in as the admin; returns (status, parsed JSON body)."""
+        resp, data = self.request(method, path, body, cookie=self.cookie, **kwargs)
+        return resp.status, json.loads(data) if data else None
+
+
+class BulkImportTests(ServerTestCase):
+    def bulk(self, raw, content_type):
+        return self.api('POST', '/api/expenses/bulk', raw=raw, headers={'Content-Type': content_type})
+
+    def test_csv_headers_in_any_case_with_spaces(self):
+        status, result = self.bulk('Description, Amount ,DATE,Category,payer\n'
+                                   'Bread,2.5,2020-01-03,food,you\nBus,3,2020-01-04,transportation,spouse\n',
+                                   'text/csv')
+        self.assertEqual(status, 200, result)
+        self.assertEqual((result['inserted'], result['failed']), (2, 0))
+
+    def test_malformed_json_arrays_are_rejected(self):
+        row = json.dumps({'description': 'Tea', 'amount': 1, 'date': '2020-03-01', 'category': 'food', 'payer': 'you'})
+        for doc in (f'[{row} {row}]', f'[{row},,{row}]', f'[,{row}]', f'[{row}]garbage'):
+            with self.subTest(doc=doc):
+                status, result = self.bulk(doc, 'application/json')
+                self.assertEqual(status, 400, result)
+                self.assertEqual(result['inserted'], 0)
+        status, result = self.api('GET', '/api/summary?month=2020-03')
+        self.assertEqual(result['count'], 0)
+
+    def test_large_import_spans_writer_chunks(self):
+        rows = [{'description': f'Row {i}', 'amount': 1, 'date': '2020-06-01', 'category': 'food', 'payer': 'you',
+                 'items': [{'name': 'a', 'amount': 1}]} for i in range(2500)]
+        lines = [json.dumps(r) for r in rows]
+        lines[1500] = '{not json'
+        status, result = self.bulk('\n'.join(lines), 'application/x-ndjson')
+        self.assertEqual(status, 207, result)
+        self.assertEqual((result['inserted'], result['failed']), (2499, 1))
+        self.assertEqual(result['errors'][0]['row'], 1501)
+        status, summary = self.api('GET', '/api/summary?month=2020-06')
+        self.assertEqual(summary['count'], 2499)
+
+    def test_malformed_document_after_many_rows_inserts_nothing(self):
+        row = json.dumps({'description': 'Tea', 'amount': 1, 'date': '2020-07-01', 'category': 'food', 'payer': 'you'})
+        status, result = self.bulk('[' + ','.join([row] * 2500) + ',,]', 'application/json')
+        self.assertEqual(status, 400, result)
+        status, summary = self.api('GET', '/api/summary?month=2020-07')
+        self.assertEqual(summary['count'], 0)
+
+    def test_bad_rows_fail_alone(self):
+        good = {'description': 'Jam', 'amount': 2, 'date': '2020-05-01', 'category': 'food', 'payer': 'you'}
+        bad = [dict(good, date=20200501), dict(good, date='2020-5-1'), dict(good, amount='NaN'),
+               dict(good, amount='inf'), dict(good, amount=True), dict(good, category=['food']),
+               dict(good, items='bread'), dict(good, items=[{'name': 'x', 'amount': 'inf'}]),
+               dict(good, items=[{'name': ['x'], 'amount': 1}])]
+        status, result = self.bulk(json.dumps([good] + bad + [good]), 'application/json')
+        self.assertEqual(status, 207, result)
+        self.assertEqual((result['inserted'], result['failed']), (2, len(bad)))
+        status, summary = self.api('GET', '/api/summary?month=2020-05')
+        self.assertEqual((summary['count'], summary['total']), (2, 4))
+        for row in bad:
+            with self.subTest(row=row):
+                self.assertEqual(self.api('POST', '/api/expenses', row)[0], 400)
+
+    def test_create_expense_returns_validated_items(self):
+        status, result = self.api('POST', '/api/expenses', {
+            'description': 'Shop', 'amount': '3.5', 'date': '2020-05-02', 'category': 'food', 'payer': 'you',
+            'items': [{'name': 'milk', 'amount': '1.5'}, {'name': 'no amount'}]})
+        self.assertEqual(status, 201, result)
+        self.assertEqual(result['expense']['items'], [{'name': 'milk', 'amount': 1.5}])
+
+
+class RouterTests(ServerTestCase):
+    def test_int_path_params(self):
+        status, created = self.api('POST', '/api/expenses', {'description': 'Owl', 'amount': 7, 'date': '2021-05-01',
+                                                              'category': 'food', 'payer': 'you'})
+        self.assertEqual(status, 201)
+        expense_id = created['expense']['id']
+        for segment in ('abc', f'+{expense_id}', f'-{expense_id}', f'{expense_id}.0', '%31', f'{expense_id}/x', ''):
+            with self.subTest(segment=segment):
+                status, result = self.api('DELETE', f'/api/expenses/{segment}')
+                self.assertEqual((status, result), (404, {'error': 'Not found'}))
+        self.assertEqual(self.api('GET', '/api/summary?month=2021-05')[1]['count'], 1)
+        self.assertEqual(self.api('DELETE', f'/api/expenses/{expense_id}'), (200, {'success': True}))
+        self.assertEqual(self.api('GET', '/api/summary?month=2021-05')[1]['count'], 0)
+
+    def test_str_path_params_reach_their_handler(self):
+        # Percent-escapes are decoded into the parameter, so an escaped slash is the handler's to refuse
+        for segment in ('no%20such%20receipt.png', '..%2Fexpenses.db', '.hidden'):
+            with self.subTest(segment=segment):
+                self.assertEqual(self.api('GET', f'/api/receipts/{segment}'), (404, {'error': 'Receipt not found'}))
+        self.assertEqual(self.api('GET', '/api/receipts/'), (404, {'error': 'Not found'}))
+
+    def test_unknown_paths_and_methods(self):
+        for method, path in (('GET', '/api/nope'), ('GET', '/api/expenses/bulk'), ('DELETE', '/api/expenses'),
+                             ('POST', '/api/expenses/1'), ('GET', '/api/expenses/1'), ('GET', '/api/expenses/')):
+            with self.subTest(method=method, path=path):
+                self.assertEqual(self.api(method, path), (404, {'error': 'Not found'}))
+        # Routing comes before authentication, so unknown paths don't reveal whether a login is needed
+        resp, data = self.request('GET', '/api/nope')
+        self.assertEqual((resp.status, json.loads(data)), (404, {'error': 'Not found'}))
+        resp, _ = self.request('GET', '/api/expenses')
+        self.assertEqual(resp.status, 401)
+
+
+class ListExpensesTests(ServerTestCase):
+    def test_unknown_stream_format_is_rejected(self):
+        status, result = self.api('GET', '/api/expenses?stream=foo')
+        self.assertEqual(status, 400)
+        self.assertIn('error', result)
+        resp, _ = self.request('GET', '/api/expenses?stream=ndjson', cookie=self.cookie)
+        self.assertEqual(resp.status, 200)
+
+    def test_etag_is_only_valid_for_its_own_resource(self):
+        resp, _ = self.request('GET', '/api/expenses?month=2021-01', cookie=self.cookie)
+        etag = resp.getheader('ETag')
+        resp, _ = self.request('GET', '/api/expenses?month=2021-01', cookie=self.cookie,
+                               headers={'If-None-Match': etag})
+        self.assertEqual(resp.status, 304)
+        for path in ('/api/expenses?month=2021-02', '/api/summary?month=2021-01'):
+            with self.subTest(path=path):
+                resp, data = self.request('GET', path, cookie=self.cookie, headers={'If-None-Match': etag})
+                self.assertEqual(resp.status, 200)
+                self.assertTrue(data)
+
+
+class RollupTests(ServerTestCase):
+    def check_rollups(self):
+        proc = subprocess.run([sys.executable, SERVER, 'check-rollups'], cwd=self.workdir.name,
+                              capture_output=True, text=True, timeout=30)
+        self.assertEqual(proc.returncode, 0, proc.stdout)
+
+    def month_totals(self, month):
+        _, summary = self.api('GET', f'/api/summary?month={month}')
+        _, page = self.api('GET', f'/api/expenses?month={month}')
+        expected = sum(e['amount'] for e in page['expenses'])
+        return (summary['count'], round(summary['total'], 6)), (len(page['expenses']), round(expected, 6))
+
+    def test_rollups_follow_every_write(self):
+        created = []
+        for i, (category, payer) in enumerate([('food', 'you'), ('bills', 'spouse'), ('food', 'spouse')]):
+            status, result = self.api('POST', '/api/expenses', {'description': f'E{i}', 'amount': 10.25 + i,
+                                                                 'date': f'2021-03-0{i + 1}', 'category': category,
+                                                                 'payer': payer})
+            self.assertEqual(status, 201)
+            created.append(result['expense']['id'])
+        status, _ = self.api('POST', '/api/expenses/bulk', raw='description,amount,date,category,payer\n'
+                             'B1,4,2021-03-09,food,you\nB2,6.5,2021-04-01,fun,spouse\n',
+                             headers={'Content-Type': 'text/csv'})
+        self.assertEqual(status, 200)
+        self.check_rollups()
+        actual, expected = self.month_totals('2021-03')
+        self.assertEqual(actual, expected)
+        self.assertEqual(actual, (4, 37.75))
+        # Items don't change the expense amount, so the rollups must not move either
+        self.assertEqual(self.api('POST', '/api/expense-items', {'expense_id': created[0], 'name': 'x',
+                                                                 'amount': 1})[0], 201)
+        self.assertEqual(self.month_totals('2021-03'), (actual, expected))
+        for expense_id in created[:2]:
+            self.assertEqual(self.api('DELETE', f'/api/expenses/{expense_id}')[0], 200)
+        self.check_rollups()
+        actual, expected = self.month_totals('2021-03')
+        self.assertEqual(actual, expected)
+        self.assertEqual(actual, (2, 16.25))
+
+    def test_summary_indexes_are_dropped(self):
+        conn = sqlite3.connect(os.path.join(self.workdir.name, 'expenses.db'))
+        try:
+            names = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type='index'")}
+        finally:
+            conn.close()
+        self.assertIn('idx_expenses_month_date_id', names)
+        self.assertFalse(names & {'idx_expenses_month_category', 'idx_expenses_month_payer'})
+
+
+class SearchTests(ServerTestCase):
+    def found(self, q):
+        status, result = self.api('GET', f'/api/expenses/search?q={q}')
+        self.assertEqual(status, 200, result)
+        return [e['id'] for e in result['expenses']]
+
+    def test_index_follows_edits_and_deletes(self):
+        status, created = self.api('POST', '/api/expenses', {
+            'description': 'Ollivanders wand', 'amount': 7, 'date': '2021-09-01', 'category': 'school', 'payer': 'you',
+            'items': [{'name': 'holly', 'amount': 7}]})
+        self.assertEqual(status, 201)
+        expense_id = created['expense']['id']
+        self.assertEqual(self.found('ollivanders'), [expense_id])
+        self.assertEqual(self.found('holly'), [expense_id])
+        status, item = self.api('POST', '/api/expense-items', {'expense_id': expense_id, 'name': 'phoenix feather',
+                                                               'amount': 1})
+        self.assertEqual(status, 201)
+        self.assertEqual(self.found('phoenix'), [expense_id])
+        self.assertEqual(self.found('holly'), [expense_id])
+        self.assertEqual(self.api('DELETE', f"/api/expense-items/{item['item']['id']}")[0], 200)
+        self.assertEqual(self.found('phoenix'), [])
+        self.assertEqual(self.found('ollivanders'), [expense_id])
+        status, _ = self.api('POST', '/api/expenses/bulk', raw=json.dumps(
+            [{'description': 'Ollivanders repair', 'amount': 2, 'date': '2021-09-02', 'category': 'school',
+              'payer': 'you', 'items': [{'name': 'phoenix polish', 'amount': 2}]}]),
+            headers={'Content-Type': 'application/json'})
+        self.assertEqual(status, 200)
+        self.assertEqual(len(self.found('ollivanders')), 2)
+        self.assertEqual(len(self.found('phoenix')), 1)
+        self.assertEqual(self.api('DELETE', f'/api/expenses/{expense_id}')[0], 200)
+        self.assertNotIn(expense_id, self.found('ollivanders'))
+        self.assertEqual(self.found('holly'), [])
+
+
+class MetricsTests(ServerTestCase):
+    # Few workers, so warm-up requests open every connection and fill the session cache
+    env = {'SERVER_WORKERS': '2'}
+
+    def route_metrics(self, method, route, count):
+        # Requests are recorded after their response is sent, so the last one may lag a little
+        deadline = time.time() + 5
+        while True:
+            status, metrics = self.api('GET', '/api/admin/metrics?format=json')
+            self.assertEqual(status, 200)
+            found = [r for r in metrics['routes'] if (r['method'], r['route']) == (method, route)]
+            if (found and found[0]['count'] >= count) or time.time() > deadline:
+                return found[0]
+            time.sleep(0.05)
+
+    def set_balances(self, n):
+        for i in range(n):
+            status, _ = self.api('POST', '/api/balances', {'month_key': '2020-02', 'starting_balance': 100 + i})
+            self.assertEqual(status, 200)
+
+    def test_write_routes_report_their_queries(self):
+        self.set_balances(10)
+        before = self.route_metrics('POST', '/api/balances', 10)['db']
+        self.set_balances(10)
+        after = self.route_metrics('POST', '/api/balances', 20)['db']
+        # The upsert and commit run on the writer thread but belong to these requests
+        self.assertGreaterEqual(after['queries'] - before['queries'], 20)
+        self.assertGreater(after['seconds'], before['seconds'])
+
+
+class KeepAliveTests(ServerTestCase):
+    # More clients than workers, so connections queue while others sit in keep-alive
+    env = {'SERVER_WORKERS': '4'}
+
+    def test_busy_server_closes_keepalive_connections_cleanly(self):
+        errors = []
+
+        def client():
+            conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=30)
+            try:
+                for _ in range(30):
+                    # http.client reconnects by itself after a response that says Connection: close
+                    conn.request('GET', '/api/auth/me', headers={'Cookie': self.cookie})
+                    resp = conn.getresponse()
+                    resp.read()
+                    if resp.status != 200:
+                        errors.append(resp.status)
+            except (OSError, http.client.HTTPException) as e:
+                errors.append(repr(e))
+            finally:
+                conn.close()
+
+        threads = [threading.Thread(target=client) for _ in range(16)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+
+
+class PasswordTests(ServerTestCase):
+    # Two workers go to /api/events, so only one login may wait on a hash
+    env = {'SERVER_WORKERS': '4'}
+
+    def test_concurrent_logins_are_capped_by_free_workers(self):
+        statuses = []
+
+        def login():
+            resp, _ = self.request('POST', '/api/auth/login', {'username': ADMIN_USER, 'password': ADMIN_PASSWORD})
+            statuses.append(resp.status)
+
+        threads = [threading.Thread(target=login) for _ in range(6)]
+        for t in threads:
+            t.start()
+        status, _ = self.api('GET', '/api/auth/me')
+        self.assertEqual(status, 200)
+        for t in threads:
+            t.join()
+        self.assertLessEqual(set(statuses), {200, 503})
+        self.assertIn(200, statuses)
+        status, stats = self.api('GET', '/api/admin/db-stats')
+        self.assertEqual((stats['passwords']['max_pending'], stats['passwords']['pending']), (1, 0))
+
+
+class SignedSessionTests(ServerTestCase):
+    env = {'SESSION_MODE': 'signed'}
+
+    def login(self, username, password):
+        resp, _ = self.request('POST', '/api/auth/login', {'username': username, 'password': password})
+        self.assertEqual(resp.status, 200)
+        return resp.getheader('Set-Cookie').split(';')[0]
+
+    def test_login_right_after_role_change_is_accepted(self):
+        status, created = self.api('POST', '/api/admin/users', {'username': 'percy', 'password': 'prefect123456',
+                                                                 'role': 'viewer'})
+        self.assertEqual(status, 201, created)
+        old = self.login('percy', 'prefect123456')
+        for role in ('editor', 'user', 'viewer'):
+            with self.subTest(role=role):
+                status, _ = self.api('POST', '/api/admin/users/role', {'user_id': created['user_id'], 'role': role})
+                self.assertEqual(status, 200)
+                resp, _ = self.request('GET', '/api/auth/me', cookie=old)
+                self.assertEqual(resp.status, 401)
+                old = self.login('percy', 'prefect123456')
+                resp, data = self.request('GET', '/api/auth/me', cookie=old)
+                self.assertEqual((resp.status, json.loads(data)['user']['role']), (200, role))
+
+
+class ExpenseItemTests(ServerTestCase):
+    def test_create_item_validates_its_expense(self):
+        status, created = self.api('POST', '/api/expenses', {'description': 'Shop', 'amount': 5, 'date': '2020-04-01',
+                                                              'category': 'food', 'payer': 'you'})
+        self.assertEqual(status, 201)
+        expense_id = created['expense']['id']
+        for payload in ({'name': 'egg', 'amount': 1}, {'expense_id': 'abc', 'name': 'egg', 'amount': 1},
+                        {'expense_id': expense_id, 'name': 'egg', 'amount': 'x'}, {'expense_id': expense_id, 'amount': 1}):
+            with self.subTest(payload=payload):
+                self.assertEqual(self.api('POST', '/api/expense-items', payload)[0], 400)
+        status, _ = self.api('POST', '/api/expense-items', {'expense_id': expense_id + 1000, 'name': 'egg', 'amount': 1})
+        self.assertEqual(status, 404)
+        status, item = self.api('POST', '/api/expense-items', {'expense_id': expense_id, 'name': 'egg', 'amount': 1})
+        self.assertEqual(status, 201)
+        self.assertEqual(item['item']['expense_id'], expense_id)
+
+
+class AdminTests(ServerTestCase):
+    def test_change_role_validates_input(self):
+        status, created = self.api('POST', '/api/admin/users', {'username': 'ginny', 'password': 'quidditch12345',
+                                                                 'role': 'viewer'})
+        self.assertEqual(status, 201, created)
+        for payload in ({'role': 'admin'}, {'user_id': 'abc', 'role': 'admin'}, {'user_id': None, 'role': 'admin'},
+                        {'user_id': created['user_id'], 'role': 'wizard'}, {'user_id': created['user_id']}):
+            with self.subTest(payload=payload):
+                status, result = self.api('POST', '/api/admin/users/role', payload)
+                self.assertEqual(status, 400)
+                self.assertIn('error', result)
+        self.assertEqual(self.api('POST', '/api/admin/users/role', {'user_id': 999, 'role': 'admin'})[0], 404)
+        status, result = self.api('POST', '/api/admin/users/role', {'user_id': created['user_id'], 'role': 'user'})
+        self.assertEqual((status, result['role']), (200, 'user'))
+
+
+if __name__ == '__main__':
+    unittest.main()